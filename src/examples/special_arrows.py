@@ -28,8 +28,6 @@ class Tag(Statement):
     def __init__(self, entities: Entities, tag: str):
         super().__init__([CommandKeywordToken('tag'), entities, CommandKeywordToken('add'), tag])
 
-        # TODO could implement better global tagging system for reducing nbt checks
-
 # actual test code
 
 class SpecialArrow(type):
@@ -42,7 +40,8 @@ class SpecialArrow(type):
             @ticking  # TODO ideally should only add unique function names once
             def on_tick():
                 if class_dict.get('every_tick'):
-                    with Entities('e', type='arrow', nbt=JSON(item=JSON(components=JSON(**{'"minecraft:potion_contents"': JSON(custom_color=color)})))):
+                    # an arrow's item never changes, so each arrow's nbt only needs to be checked once
+                    with Entities('e', type='arrow', nbt=JSON(item=JSON(components=JSON(**{'"minecraft:potion_contents"': JSON(custom_color=color)}))), cache_nbt=True):
                         class_dict.get('every_tick')()
                 
                 if class_dict.get('on_land'):
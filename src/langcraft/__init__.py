@@ -16,10 +16,15 @@ from .base import Namespace, Pathspace, Statement, Pass, Debug, Fragment, \
                   Fun, TickingFun, PublicFun, Partial, fun, ticking, on_load, public, metafun, lambda_metafun
 
 from .mutables import Entities, Entity, SelfEntity, Summon
-from .control_flow import If, While, Do, Schedule, ScoreTree
+from .control_flow import If, While, Do, Schedule, TimeSliced, ScoreTree
 from .commands import Condition, Advancement, Teleport, Kill
 from .globals import GLOBALS
 from .compile import compile_all, compile_program
+from .cache import BuildCache
+from .report import BuildReport, enable_profiling
+from .analysis import analyze_costs
+from .lint import lint_selectors
+from .simulator import Simulator, SimEntity
 from .debug import display, display_all
 from .debug_utils import enable_verbose
 
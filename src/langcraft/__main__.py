@@ -1,4 +1,17 @@
+from sys import argv
+
 from .tests import run_tests
 
-run_tests()
+# python -m langcraft profile [module]
+if len(argv) > 1 and argv[1] == 'profile':
+    from runpy import run_module
+    from .report import enable_profiling
 
+    report = enable_profiling()
+    if len(argv) > 2:
+        run_module(argv[2], run_name='__main__')
+    else:
+        run_tests()
+    print(report)
+else:
+    run_tests()
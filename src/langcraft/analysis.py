@@ -0,0 +1,207 @@
+from itertools import product
+from math import ceil, log2
+from typing import Dict, List, Literal, Tuple
+import re
+
+from .globals import GLOBALS, Ref, RefFlags
+from .serialize import REMOVE_TOKEN_SEP, TOKEN_SEP, Choice, FunctionToken, MacroFunctionToken, Program, TokenBase, TokensContainer, TokensRef
+
+MAX_COMMAND_CHAIN_LENGTH = 65536  # gamerule maxCommandChainLength default
+MACRO_EXPANSION_COST = 2  # macro lines are re-parsed whenever their arguments change, roughly costing a couple of commands
+
+# commands that can end their function: the if branch of a single-eval If/Else or a ScoreTree level
+CONDITIONAL_RETURN_REGEX = re.compile(r'^execute .+? run return\b')
+
+type Command = Tuple[str, List[str], bool]  # (rendered command, paths of functions it runs, is a macro dispatch)
+
+def expand_container(container: TokensContainer) -> List[Command]:
+    """
+    Every command a container serializes to (one per Choice combination), with the functions each one calls
+    """
+    assignments = container.choice_assignments()
+    idents = list(assignments.keys())
+    commands: List[Command] = []
+    for combination in product(*assignments.values()):
+        tokens: List[TokenBase] = []
+        for token in container:
+            if isinstance(token, Choice):
+                tokens += combination[idents.index(token.ident)]
+            else:
+                tokens.append(token)
+        cmd = TOKEN_SEP.join(str(token) for token in tokens).replace(REMOVE_TOKEN_SEP + TOKEN_SEP, '').strip()
+        if cmd and not cmd.startswith('#'):
+            calls = [] if cmd.startswith('schedule ') else [
+                GLOBALS.get_function_path(token.namespace, token.path) for token in tokens if isinstance(token, FunctionToken)
+            ]
+            commands.append((cmd, calls, any(isinstance(token, MacroFunctionToken) for token in tokens)))
+    return commands
+
+def program_commands(program: Program) -> List[Command]:
+    commands = []
+    for cmd in program:
+        if cmd is None:
+            continue
+        for container in (cmd.resolve() if isinstance(cmd, TokensRef) else [cmd]):
+            commands += expand_container(container)
+    return commands
+
+class FunctionCost:
+    def __init__(self, path: str, commands: int):
+        self.path = path
+        self.commands = commands  # commands in the function itself, with Choices expanded
+        self.worst_case = commands  # commands executed transitively per invocation, capped at the chain limit
+        # deepest function call nesting, for reference: maxCommandChainLength limits worst_case, not the nesting
+        self.call_depth = 1
+        self.recursive = False
+
+    @property
+    def name(self):
+        namespace, _, *path = self.path.split('/')[1:]
+        return f'{namespace}:{"/".join(path)}'
+
+    def to_dict(self) -> dict:
+        return {'commands': self.commands, 'worst_case': self.worst_case, 'call_depth': self.call_depth, 'recursive': self.recursive}
+
+
+class CostReport:
+    """
+    Static worst-case command counts of compiled functions
+
+    Example usage:
+    compile_all()
+    costs = analyze_costs()
+    print(costs)
+    costs['$root/ns/function/main'].worst_case
+    """
+    def __init__(self, functions: Dict[str, FunctionCost], ref_graph: Dict[Ref, Dict[Ref, int]],
+                 limit: int = MAX_COMMAND_CHAIN_LENGTH):
+        self.functions = functions
+        self.ref_graph = ref_graph
+        self.limit = limit
+
+    def __getitem__(self, path: str) -> FunctionCost:
+        return self.functions[path]
+
+    def entry_points(self, hook: str = '#minecraft:tick') -> List[FunctionCost]:
+        """
+        Functions attached to hook, most expensive first
+        """
+        return sorted((self.functions[callee[1]] for callee in self.ref_graph.get(('$extern', hook), {})
+                       if callee[0] == 'function' and callee[1] in self.functions),
+                      key=lambda cost: -cost.worst_case)
+
+    def over_limit(self) -> List[FunctionCost]:
+        return [cost for cost in self.functions.values() if cost.worst_case >= self.limit]
+
+    def to_dict(self) -> dict:
+        return {
+            'limit': self.limit,
+            'functions': {path: cost.to_dict() for path, cost in self.functions.items()},
+            'tick': [cost.path for cost in self.entry_points()],
+        }
+
+    def __str__(self):
+        lines = [f'{"function":<48}{"commands":>10}{"worst case":>12}{"call depth":>12}']
+        for cost in sorted(self.functions.values(), key=lambda cost: -cost.worst_case):
+            worst_case = f'{cost.worst_case}{"+" if cost.recursive or cost.worst_case >= self.limit else ""}'
+            lines.append(f'{cost.name:<48}{cost.commands:>10}{worst_case:>12}{cost.call_depth:>12}')
+        tick = self.entry_points()
+        if tick:
+            lines.append(f'tick entry points: {sum(cost.worst_case for cost in tick)} commands/tick worst case')
+            lines += [f'  {cost.name}: {cost.worst_case} ({100 * cost.worst_case / self.limit:.1f}% of maxCommandChainLength)'
+                      for cost in tick]
+        return '\n'.join(lines)
+
+
+def analyze_costs(programs: Dict[str, Program] | None = None,
+                  ref_graph: Dict[Ref, Dict[Ref, int]] | None = None,
+                  limit: int = MAX_COMMAND_CHAIN_LENGTH) -> CostReport:
+    """
+    Worst-case commands executed per invocation of every used function, to run after compile_all
+    Both branches of if/unless pairs count, as the if branch can change the condition; a command that can return
+    (single-eval If/Else, ScoreTree) counts either its callees or the rest of the function
+    Recursive calls are assumed to hit the limit
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    if ref_graph is None:
+        ref_graph = GLOBALS.ref_graph
+
+    commands = {path: program_commands(program) for path, program in programs.items() if program.used}
+    functions = {path: FunctionCost(path, len(cmds)) for path, cmds in commands.items()}
+    done = set()
+    visiting = set()
+
+    def macro_callees(path: str) -> List[str]:
+        return [callee[1] for callee, flags in ref_graph.get(('function', path), {}).items()
+                if flags & RefFlags.MACRO and callee[1] in functions]
+
+    def callees(path: str) -> List[str]:
+        return [callee for _, calls, macro in commands[path] for callee in (macro_callees(path) if macro else calls)
+                if callee in functions]
+
+    def calls_worst_case(path: str, calls: List[str], macro: bool) -> int:
+        cost = functions[path]
+        worst_case = 0
+        if macro:
+            # only one of the functions a macro line can pick runs
+            calls = sorted(macro_callees(path), key=lambda callee: -functions[callee].worst_case)[:1]
+            worst_case = MACRO_EXPANSION_COST
+        for callee in calls:
+            if callee not in functions:
+                continue
+            if callee in visiting:
+                cost.recursive = True
+                worst_case = limit
+                continue
+            callee_cost = functions[callee]
+            cost.recursive |= callee_cost.recursive
+            cost.call_depth = max(cost.call_depth, callee_cost.call_depth + 1)
+            worst_case += callee_cost.worst_case
+        return min(worst_case, limit)
+
+    def finish(path: str):
+        # every callee is done, or visiting if the call is recursive
+        worst_case = 0
+        # from the last command back, so commands that can return know what runs after them
+        for cmd, calls, macro in reversed(commands[path]):
+            callees_worst_case = calls_worst_case(path, calls, macro)
+            if cmd.startswith('return'):
+                worst_case = 1 + callees_worst_case
+            elif CONDITIONAL_RETURN_REGEX.match(cmd):
+                worst_case = 1 + max(callees_worst_case, worst_case)
+            else:
+                worst_case += 1 + callees_worst_case
+            worst_case = min(worst_case, limit)
+        functions[path].worst_case = worst_case
+        visiting.remove(path)
+        done.add(path)
+
+    # callees before callers, iteratively as call chains can be deeper than python's recursion limit
+    for root in functions:
+        if root in done:
+            continue
+        visiting.add(root)
+        stack = [(root, iter(callees(root)))]
+        while stack:
+            path, it = stack[-1]
+            callee = next(it, None)
+            if callee is None:
+                stack.pop()
+                finish(path)
+            elif callee not in done and callee not in visiting:
+                visiting.add(callee)
+                stack.append((callee, iter(callees(callee))))
+
+    return CostReport(functions, ref_graph, limit)
+
+
+def score_tree_dispatch_cost(leaves: int, dispatch: Literal['tree', 'macro']) -> int:
+    """
+    Worst-case commands (as counted by analyze_costs) a ScoreTree executes to reach a leaf, excluding the leaf itself
+    """
+    if dispatch == 'macro':
+        # function <tree>, store score to storage, function <tree>/dispatch with storage, macro line
+        return 4 + MACRO_EXPANSION_COST
+    # function <tree>, then a returning if and the call of the upper half per level
+    return 1 + 2 * ceil(log2(max(leaves, 1)))
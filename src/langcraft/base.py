@@ -82,11 +82,14 @@ class Args:
         return self.args.__iter__()
 
 class MetaArg(TokenBase):
+    __slots__ = ('id', 'val')
+
     def __init__(self, id: int):
         self.id = id
 
     def assign(self, val):
         self.val = val
+        invalidate_renders()
 
     def __str__(self):
         if hasattr(self, 'val'):
@@ -0,0 +1,53 @@
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+import tracemalloc
+
+from ..report import ACTIVE_REPORTS, BuildReport
+from . import generators
+
+type Scenario = Tuple[str, Callable[[], generators.Files]]
+
+def scenarios(full=False) -> List[Scenario]:
+    """
+    (name, run) pairs; full includes the largest sizes, which take minutes
+    """
+    tree_sizes = [10**2, 10**3, 10**4] + ([10**5] if full else [])
+    if_depths = [10, 50, 200]
+    metafun_counts = [100, 1000] + ([5000] if full else [])
+    function_counts = [10**4] + ([10**5] if full else [])
+    return [
+        *((f'score_tree_{n}', lambda n=n: generators.score_tree(n)) for n in tree_sizes),
+        *((f'nested_if_{n}', lambda n=n: generators.nested_if(n)) for n in if_depths),
+        *((f'metafuns_{n}', lambda n=n: generators.metafuns(n)) for n in metafun_counts),
+        *((f'functions_{n}', lambda n=n: generators.functions(n)) for n in function_counts),
+        ('tracks', generators.tracks),
+    ]
+
+def run_scenario(run: Callable[[], generators.Files]) -> Dict:
+    """
+    Measures total time (DSL + compile_all), compile_all time alone, tracemalloc peak, memory still held once the
+    build returns (mostly the programs' token objects) and the resulting datapack size
+    """
+    # without trace_memory the report leaves tracemalloc's peak alone, so it covers the whole run and not only the
+    # build's last phase
+    report = BuildReport(trace_memory=False)
+    ACTIVE_REPORTS.append(report)
+    tracemalloc.start()
+    try:
+        start = perf_counter()
+        files = run()
+        total_time = perf_counter() - start
+        retained_memory, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        ACTIVE_REPORTS.remove(report)
+
+    return {
+        'total_time': total_time,
+        'compile_time': sum(stats.wall_time for stats in report.phases.values()),
+        'peak_memory': peak_memory,
+        'retained_memory': retained_memory,
+        'files': len(files),
+        'bytes': sum(len(content.encode()) for content in files.values()),
+        'phases': {name: stats.wall_time for name, stats in report.phases.items()},
+    }
@@ -0,0 +1,33 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from subprocess import run
+import json
+import platform
+import sys
+
+from . import run_scenario, scenarios
+
+# python -m langcraft.bench [-o results.json] [--full] [scenario ...]
+parser = ArgumentParser(prog='python -m langcraft.bench', description='Compile synthetic datapacks and record their cost')
+parser.add_argument('scenarios', nargs='*', help='scenario names to run (default: all)')
+parser.add_argument('-o', '--out', default='bench_results.json', help='JSON file to write results to')
+parser.add_argument('--full', action='store_true', help='include the largest scenario sizes')
+args = parser.parse_args()
+
+selected = [(name, run_) for name, run_ in scenarios(full=args.full) if not args.scenarios or name in args.scenarios]
+
+# deep If/Else chains recurse through traverse once per nesting level
+sys.setrecursionlimit(max(sys.getrecursionlimit(), 10_000))
+
+commit = run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+results = {'commit': commit or None, 'python': platform.python_version(), 'scenarios': {}}
+for name, run_ in selected:
+    result = run_scenario(run_)
+    results['scenarios'][name] = result
+    print(f'{name:<20}{result["total_time"]:>9.3f}s total{result["compile_time"]:>9.3f}s compile'
+          f'{result["peak_memory"] / 2**20:>9.1f} MiB peak{result["retained_memory"] / 2**20:>9.1f} MiB held'
+          f'{result["files"]:>8} files{result["bytes"]:>11} bytes')
+
+with open(args.out, 'w') as f:
+    json.dump(results, f, indent=2)
+print(f'wrote {args.out}')
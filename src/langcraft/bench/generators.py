@@ -0,0 +1,118 @@
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from runpy import run_module
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+import os
+import random
+import sys
+
+from langcraft import *
+
+type Files = dict[str, str]
+
+def compile_files(**kwargs) -> Files:
+    """
+    compile_all(write=True) but collecting the datapack files in memory instead of saving them
+    """
+    files: Files = {}
+    compile_all(write=True, root_dir='bench', save_strategy=lambda root_dir, write_files: files.update(write_files), **kwargs)
+    return files
+
+
+def score_tree(leaves: int) -> Files:
+    GLOBALS.reset('bench')
+
+    @public
+    def main():
+        with ScoreTree('i'):
+            for i in range(leaves):
+                Statement(f'say {i}')
+
+    return compile_files()
+
+
+def nested_if(depth: int) -> Files:
+    GLOBALS.reset('bench')
+    score = Score('depth')
+
+    def level(i: int) -> If:
+        if i == depth:
+            return If(score.in_range(i, i))(Statement(f'say {i}'))
+        return If(score.in_range(i, i))(
+            Statement(f'say {i}'),
+            Statement(f'scoreboard players add @s depth 1'),
+        ).Else(
+            Statement(f'say not {i}'),
+            level(i + 1),
+        )
+
+    @public
+    def main():
+        level(0)
+
+    return compile_files()
+
+
+def metafuns(instances: int) -> Files:
+    GLOBALS.reset('bench')
+
+    @metafun()
+    def segment(i):
+        with Entities('e', type='arrow', tag=f't{i % 16}'):
+            Statement(f'say {i}')
+            Statement(f'setblock ~ ~{i % 16} ~ stone')
+
+    @public
+    def main():
+        for i in range(instances):
+            segment(i)
+
+    return compile_files()
+
+
+def functions(n: int) -> Files:
+    """
+    n small distinct functions, mostly made of the tokens every build repeats (execute, if, score, run, ...)
+    """
+    GLOBALS.reset('bench')
+    score = Score('i')
+
+    @public
+    def main():
+        for i in range(n):
+            with Fun() as f:
+                If(score.in_range(i, i))(
+                    Statement(f'say {i}'),
+                    Statement('scoreboard players add @s i 1'),
+                )
+                Statement(f'tp @s ~ ~{i % 8} ~')
+            f()
+
+    return compile_files()
+
+
+def tracks() -> Files:
+    """
+    Runs examples/tracks.py unmodified in a scratch directory and reads back the datapack it writes
+    """
+    src_dir = str(Path(__file__).parents[2])
+    cwd = os.getcwd()
+    with TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir) / 'work'
+        work_dir.mkdir()
+        os.chdir(work_dir)
+        sys.path.insert(0, src_dir)
+        try:
+            GLOBALS.reset('main')
+            # the example builds random tracks (and can fail on some draws), so pin them for comparable results
+            random.seed(0)
+            with redirect_stdout(StringIO()):
+                run_module('examples.tracks', run_name='__main__')
+        finally:
+            sys.path.remove(src_dir)
+            os.chdir(cwd)
+
+        with ZipFile(Path(tmp_dir) / 'datapacks' / 'track_elements.zip') as zipf:
+            return {name: zipf.read(name).decode() for name in zipf.namelist()}
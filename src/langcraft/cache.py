@@ -0,0 +1,114 @@
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Tuple
+import json
+
+from .debug_utils import print_debug, print_warn
+from .globals import Ref
+from .serialize import Choice, FunctionToken, JSONRefToken, Program, TokenBase, TokensContainer, TokensRef
+
+CACHE_VERSION = 1
+
+class BuildCache:
+    """
+    Persistent on-disk cache of serialized functions, keyed by a content hash of each Program's token stream
+    (and the ref-graph edges it depends on), so unchanged functions skip serialization on rebuilds
+
+    Example usage:
+    cache = BuildCache('.langcraft_cache')
+    compile_all(write=True, cache=cache)
+    print(cache.hits, cache.misses)
+    """
+    def __init__(self, cache_dir: str | Path = '.langcraft_cache', name: str = 'functions'):
+        self.path = Path(cache_dir) / f'{name}.json'
+        self.entries: Dict[str, str] = {}
+        self.used_keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open() as f:
+                cached = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print_warn(f'ignoring unreadable build cache {self.path}: {e}')
+            return
+        if cached.get('version') == CACHE_VERSION:
+            self.entries = cached['entries']
+        else:
+            print_debug(f'build cache {self.path} has outdated version, ignoring')
+
+    def save(self):
+        # only keep entries referenced by the latest build so the cache doesn't grow unbounded
+        entries = {key: val for key, val in self.entries.items() if key in self.used_keys}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('w') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': entries}, f)
+
+    def reset_stats(self):
+        self.used_keys = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str | None:
+        self.used_keys.add(key)
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, serialized: str):
+        self.used_keys.add(key)
+        self.entries[key] = serialized
+
+    @staticmethod
+    def program_key(program: Program,
+                    ref_edges: Iterable[Tuple[Ref, int]],
+                    validate_fun: Callable = lambda namespace, path: True,
+                    validate_json: Callable = lambda namespace, path: True,
+                    debug=False,
+                    color=False) -> str:
+        h = sha256(f'{CACHE_VERSION}|{debug}|{color}|{debug and not program.used}'.encode())
+
+        def render(t: TokenBase) -> str:
+            if debug:
+                return t.debug_str()
+            elif color:
+                return t.color_str()
+            return str(t)
+
+        def hash_token(t: TokenBase):
+            h.update(b'\x1f' + type(t).__name__.encode() + b'\x1e' + render(t).encode())
+            if isinstance(t, FunctionToken):
+                h.update(b'1' if validate_fun(t.namespace, t.path) else b'0')
+            elif isinstance(t, JSONRefToken):
+                h.update(b'1' if validate_json(t.namespace, t.path) else b'0')
+
+        for cmd in program:
+            if cmd is None:
+                continue
+            h.update(b'\x1d')
+            for container in (cmd.resolve() if isinstance(cmd, TokensRef) else [cmd]):
+                container: TokensContainer
+                h.update(b'\x1c')
+                choice_idents = {}
+                for token in container:
+                    if isinstance(token, Choice):
+                        # choices are grouped by ident when serializing, so only the grouping (not the uuid) matters
+                        idx = choice_idents.setdefault(token.ident, len(choice_idents))
+                        h.update(f'\x1fChoice{idx}'.encode())
+                        for choice in token.choices:
+                            h.update(b'\x1a')
+                            for choice_token in choice:
+                                hash_token(choice_token)
+                    else:
+                        hash_token(token)
+
+        for (ref_type, ref_path), ref_flags in sorted(ref_edges):
+            h.update(f'\x19{ref_type}:{ref_path}:{int(ref_flags)}'.encode())
+
+        return h.hexdigest()
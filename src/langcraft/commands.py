@@ -39,6 +39,15 @@ class _ConditionType(Enum):
     # SCORE = auto()
 
 
+# relative cost of each execute if/unless condition type (a score check being 1) unless it checks nbt
+CONDITION_COSTS = {
+    'entity': 4,
+    'predicate': 4,
+    'items': 4,
+    'blocks': 8,
+    'data': 2,
+}
+
 class Condition:
     @overload
     def __init__(self, value: str): ...
@@ -69,6 +78,26 @@ class Condition:
     def always_false(self):
         return self.condition_type == _ConditionType.FALSE
 
+    @property
+    def cost(self) -> int:
+        """
+        Rough relative cost of evaluating the condition, e.g. a score check is 1 and an entity nbt check is 16
+        """
+        match self.condition_type:
+            case _ConditionType.TRUE | _ConditionType.FALSE:
+                return 0
+            case _ConditionType.ALL:
+                return sum(sub_condition.cost for sub_condition in self.value)
+            case _ConditionType.OR | _ConditionType.ANY:
+                return sum(sub_condition.cost for sub_condition in self.value) + 1
+            case _ConditionType.STR:
+                s = self.value
+            case _:
+                s = TOKEN_SEP.join(str(token) for token in self.value.sub_tokenize())
+        if 'nbt=' in s or s.startswith('data entity') or s.startswith('data block'):
+            return 16
+        return CONDITION_COSTS.get(s.split(' ')[0], 1)
+
     def __invert__(self) -> Self:
         inv_self = deepcopy(self)
 
@@ -265,14 +294,19 @@ class ExecuteSub:
 # special commands:
 
 class _ExecuteContainer(TokensContainer):
+    __slots__ = ('_block_tokens',)
+
     def __init__(self, tokens: List[Token], block_tokens: List[Token]):
         super().__init__(*tokens)
-        self._block_tokens = block_tokens
+        self._block_tokens = tuple(block_tokens)
 
     @property
     def tokens(self):
         return self._tokens + self._block_tokens
 
+    def _stamp(self) -> tuple:
+        return *super()._stamp(), self._block_tokens
+
     def get_fun_token(self) -> FunctionToken | None:
         if len(self._block_tokens) == 2:
             run_token, fun_token = self._block_tokens
@@ -1,19 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 from zipfile import ZipFile
+from contextlib import nullcontext
 from random import randint
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Set, Tuple
+import gc
 import json
 
-from .globals import GLOBALS, DATAPACK_ROOT, RefFlags
-from .debug_utils import print_debug, print_warn, print_debug_colorful
+from .globals import GLOBALS, DATAPACK_ROOT
+from .debug_utils import print_debug, print_warn, print_debug_colorful, print_info
 from .json_utils import JSON
-from .serialize import REMOVE_TOKEN_SEP, TOKEN_SEP, Program, serialize_function_name
-from .base import Fun, FunStatement, Namespace, WithStatement
-from .commands import _ExecuteContainer, RawExecute
+from .serialize import FLAG_OBJECTIVE, REMOVE_TOKEN_SEP, TOKEN_SEP, Program, ProgramSnapshot, invalidate_renders, \
+                       serialize_function_name
+from .base import Fun, Namespace
 from .load import load
-
-PRUNE_INLINE = False  # TODO need to update optim
-PRUNE_INLINE_EXECUTE = False
+from .flags import allocate_flag_slots
+from .inline import INLINE_MAX_SIZE, _containers, inline_functions
+from .dedup import dedup_functions
+from .factor import FACTOR_CALL_COST, factor_execute_prefixes
+from .lint import lint_selectors
+from .nbt_cache import prepare_nbt_caches
+from .dispatch import dispatch_tick_scans
+from .cache import BuildCache
+from .report import BuildReport, active_report, path_namespace
 
 def compile_program(program: Program, debug=True, **serialize_kwargs):
     if debug:
@@ -22,6 +32,49 @@ def compile_program(program: Program, debug=True, **serialize_kwargs):
     s = s.replace(REMOVE_TOKEN_SEP + TOKEN_SEP, '')
     return s
 
+def ref_validators(valid_fun_refs: Set[str], valid_json_refs: Set[str]) -> Tuple[Callable, Callable]:
+    """
+    (validate_fun, validate_json) serialize checks references against, which turn references to anything that isn't
+    built red
+    """
+    def validate_fun_ref(namespace: str, path: List[str]):
+        return GLOBALS.get_function_path(namespace, path) in valid_fun_refs
+
+    def validate_json_ref(namespace: str, path: List[str]):
+        return GLOBALS.get_json_path(namespace, path) in valid_json_refs
+
+    return validate_fun_ref, validate_json_ref
+
+# worker processes' validators, see compile_programs_parallel
+_worker_validators: Tuple[Callable, Callable] | None = None
+
+def _init_worker(valid_fun_refs: Set[str], valid_json_refs: Set[str]):
+    global _worker_validators
+    _worker_validators = ref_validators(valid_fun_refs, valid_json_refs)
+
+def _compile_snapshot(snapshot: ProgramSnapshot, debug: bool, color: bool) -> str:
+    validate_fun, validate_json = _worker_validators
+    return compile_program(snapshot.restore(), debug=debug, color=color, validate_fun=validate_fun, validate_json=validate_json)
+
+def compile_programs_parallel(programs: Dict[str, Program], jobs: int, valid_fun_refs: Set[str], valid_json_refs: Set[str],
+                              debug=False, color=False) -> Dict[str, str]:
+    """
+    Serializes programs across a process pool: each worker is sent the programs' tokens (see Program.snapshot) and
+    renders them like compile_program, with validators rebuilt from the valid references
+    """
+    # the token graph is large, collecting it while the snapshots are built and pickled costs as much as pickling
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        snapshots = [program.snapshot() for program in programs.values()]
+        chunksize = max(1, len(snapshots) // (4 * jobs))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(valid_fun_refs, valid_json_refs)) as executor:
+            serialized = executor.map(_compile_snapshot, snapshots, repeat(debug), repeat(color), chunksize=chunksize)
+            return dict(zip(programs.keys(), serialized))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
 Ref = Tuple[str, str]
 
 def ref_to_program(ref: Ref) -> Program | None:
@@ -33,88 +86,21 @@ def ref_to_program(ref: Ref) -> Program | None:
 def fun_path_to_ref(fun_path: str):
     return 'function', fun_path
 
-def traverse(source: Ref, discovered=None, discovered_and_removed=None, depth=0):
-    if discovered_and_removed is None:
-        discovered_and_removed = set()
+def traverse(source: Ref, discovered=None, depth=0):
+    """
+    Marks every program reachable from source as used
+    """
     if discovered is None:
         discovered = set()
-    source_children = GLOBALS.ref_graph.get(source, {})
-    source_program = ref_to_program(source)
-
     print_debug_colorful('|   '*(depth - 1) + ('|---' if depth > 0 else '') + source[1].replace('$root/', ''), 'blue')
 
-    children_removed = True
-    for u in source_children:
-        if u in discovered:
-            children_removed |= u in discovered_and_removed
-        else:
+    for u in GLOBALS.ref_graph.get(source, {}):
+        if u not in discovered:
             discovered.add(u)
-            remove_u = traverse(u, discovered, discovered_and_removed, depth=depth+1)
-            if remove_u:
-                discovered_and_removed.add(remove_u)
-            children_removed |= remove_u
-    
-    if children_removed:
-        removable = PRUNE_INLINE
-        unwrap_single_line = False
-        for parent, parent_type in GLOBALS.backwards_ref_graph[source].items():
-            print_debug_colorful('|   '*depth + r'\___' + parent[1].replace('$root/', '') + '   \t' + str(parent_type), 'light_grey')
-            parent_program = ref_to_program(parent)
-            if not parent_program:
-                if parent[0] not in {'$extern'}:
-                    print_warn(f'unable to find {parent} as funct from ref_graph')
-                removable = False
-            elif not (parent_type ^ RefFlags.NONE):
-                pass  # nothing to do here
-            elif PRUNE_INLINE_EXECUTE and not (parent_type ^ RefFlags.EXECUTE) or not (parent_type ^ RefFlags.WITH_BLOCK):
-                n_lines = len(source_program.serialize().split('\n'))
-                if n_lines == 1:
-                    unwrap_single_line = True
-                if n_lines > 1:
-                    removable = False
-            else:
-                removable = False
-            
-        if removable:
-            for parent, parent_type in GLOBALS.backwards_ref_graph[source].items():
-                parent_program = ref_to_program(parent)  # cannot be None
-                j = 0
-                for i, cmd in enumerate(parent_program.cmds):
-                    if isinstance(cmd, FunStatement):
-                        fun_cmds = GLOBALS.programs[GLOBALS.get_function_path(cmd.fun.namespace, cmd.fun.path)].cmds
-                        parent_program.unwrap_to(i + j, fun_cmds)
-                        j += len(fun_cmds) - 1
-                    elif unwrap_single_line and isinstance(cmd, WithStatement):
-                        if not cmd._unwrapped:
-                            fun_cmd, = source_program.cmds
-                            # cmd._unwrap_statement(source, fun_cmd.tokenize(), _ExecuteContainer=_ExecuteContainer)
-                            single_line_tokens = fun_cmd.tokenize()
-                            for cmd_ in cmd.cmds:
-                                if isinstance(cmd_, _ExecuteContainer):
-                                    fun_token = cmd_.get_fun_token()
-                                    if fun_token is None:
-                                        print_warn(f'already unwrapped {source}')
-                                    else:
-                                        fun_path = GLOBALS.get_function_path(fun_token.namespace, fun_token.path)
-                                        if fun_path == source[1]:
-                                            assert cmd_._block_tokens != []
-                                            cmd_._block_tokens[1:] = single_line_tokens
-                                            cmd._unwrapped = True
-                    elif unwrap_single_line and isinstance(cmd, RawExecute):
-                        fun_cmd, = source_program.cmds
-                        execute_container: _ExecuteContainer = cmd._get_cmds()[-1]
-                        execute_container._block_tokens[1:] = fun_cmd.tokenize()
-                    else:
-                        print_debug(f'ignoring cmd in unwrap: {cmd} {type(cmd)}')
-    else:
-        removable = False
-
-    print_debug_colorful('|   '*(depth - 1) + ('|---' if depth > 0 else '') + source[1].replace('$root/', ''), ('red' if removable else 'green'))
-    
+            traverse(u, discovered, depth=depth+1)
+
     if source_program := ref_to_program(source):
-        source_program.used = not removable
-    
-    return removable
+        source_program.used = True
 
 def save_files(root_dir: str, write_files: dict):
     for file_full_path, file_contents in write_files.items():
@@ -139,78 +125,213 @@ def compile_all(programs: Dict[str, Program] | None = None,
                 color=False,
                 debug=False,
                 optim=True,
-                save_strategy: Callable[[str, dict[str, str]], None] = save_files_to_zip
+                save_strategy: Callable[[str, dict[str, str]], None] = save_files_to_zip,
+                cache: BuildCache | str | None = None,
+                jobs: int = 1,
+                report: BuildReport | None = None,
+                score_flags=False,
+                inline=False,
+                inline_max_size: int = INLINE_MAX_SIZE,
+                dedup=False,
+                factor_execute=False,
+                factor_call_cost: int = FACTOR_CALL_COST,
+                tick_dispatch=False,
+                lint=False
                 ) -> Dict[str, str]:
+    """
+    cache: a BuildCache (or directory path for one) reused across builds so unchanged functions skip serialization
+    jobs: number of worker processes to serialize functions with; output is identical to the serial path
+    report: a BuildReport to record per-phase/per-namespace timings and allocations into (see enable_profiling)
+    score_flags: keep control flow flags in fake scoreboard players (sharing slots between flags that are never live
+                 at once) instead of storage, which is cheaper to set and check
+    inline: inline functions with a single call site or at most inline_max_size commands into their callers
+            (requires optim), see inline.inline_functions
+    dedup: merge functions with identical bodies into one file (requires optim), see dedup.dedup_functions
+    factor_execute: hoist context subcommands shared by consecutive execute commands into one execute running a new
+                    function, when that saves more than factor_call_cost selector scans (requires optim)
+                    see factor.factor_execute_prefixes for when this is safe
+    tick_dispatch: merge the `execute as @e[type=...]` scans of #minecraft:tick functions into one scan per entity type
+                   (requires optim), see dispatch.dispatch_tick_scans
+    lint: print warnings about @e[nbt=...] scans in #minecraft:tick functions, see lint.lint_selectors (a report
+          always records them)
+    """
     if programs is None:
         programs = GLOBALS.programs
     if jsons is None:
         jsons = GLOBALS.jsons
+    if isinstance(cache, str):
+        cache = BuildCache(cache)
+    if cache is not None:
+        cache.reset_stats()
+    if report is None:
+        report = active_report()
+    if report is not None:
+        report.start()
 
+    def phase(name: str):
+        return report.phase(name) if report is not None else nullcontext()
 
-    root_dir = root_dir.replace('$rand', hex(randint(0, 65535)))
-    data_dir = 'data'
+    def namespace(phase_name: str, path: str):
+        return report.namespace(phase_name, path_namespace(path)) if report is not None else nullcontext()
 
-    # prune refs
-    for hook, hooked_funs in GLOBALS.fun_hooks.items():
-        hook: str
-        hooked_funs: Fun
-        if hook[0] == '#':
-            namespace, tag_path = hook[1:].split(':')
-            with Namespace(name=namespace, full_path=tag_path.split('/')):
-                hooked_fun_names = [serialize_function_name(hooked_fun.namespace, hooked_fun.path) for hooked_fun in hooked_funs]
-                GLOBALS.add_to_function_tag(None, hooked_fun_names)
+    try:
+        root_dir = root_dir.replace('$rand', hex(randint(0, 65535)))
+        data_dir = 'data'
 
-    if optim:
-        for program in programs.values():
-            program.optimize()
-
-        for caller, callees in GLOBALS.ref_graph.items():
-            match caller:
-                case ('$extern', _):
-                    for callee in callees:
-                        traverse(callee)
-        
-        for program in programs.values():
-            program.optimize()
-    else:
-        for program in programs.values():
-            program.used = True
+        with phase('setup'):
+            if GLOBALS.nbt_caches:
+                prepare_nbt_caches(programs)
+            if score_flags:
+                GLOBALS.add_setup(('score', FLAG_OBJECTIVE, 'dummy'))
+            if GLOBALS.setups:
+                load(GLOBALS.setups)
+                GLOBALS.setups = []
 
-    valid_fun_refs = [path for path, program in programs.items() if program.used]
-    valid_json_refs = [path for path, _ in jsons.items()]
+        # prune refs
+        with phase('hooks'):
+            for hook, hooked_funs in GLOBALS.fun_hooks.items():
+                hook: str
+                hooked_funs: Fun
+                if hook[0] == '#':
+                    tag_namespace, tag_path = hook[1:].split(':')
+                    with Namespace(name=tag_namespace, full_path=tag_path.split('/')):
+                        hooked_fun_names = [serialize_function_name(hooked_fun.namespace, hooked_fun.path) for hooked_fun in hooked_funs]
+                        GLOBALS.add_to_function_tag(None, hooked_fun_names)
 
-    def validate_fun_ref(namespace: str, path: List[str]):
-        return GLOBALS.get_function_path(namespace, path) in valid_fun_refs
+        if optim:
+            with phase('optimize'):
+                for file_path, program in programs.items():
+                    with namespace('optimize', file_path):
+                        program.optimize()
 
-    def validate_json_ref(namespace: str, path: List[str]):
-        return GLOBALS.get_json_path(namespace, path) in valid_json_refs
+            with phase('traverse'):
+                for caller, callees in GLOBALS.ref_graph.items():
+                    match caller:
+                        case ('$extern', _):
+                            for callee in callees:
+                                with namespace('traverse', callee[1]):
+                                    traverse(callee)
+
+            with phase('optimize:post'):
+                for file_path, program in programs.items():
+                    with namespace('optimize:post', file_path):
+                        program.optimize()
+
+            if tick_dispatch:
+                with phase('dispatch'):
+                    dispatchers = dispatch_tick_scans(programs)
+                    print_debug(f'merged tick scans into {len(dispatchers)} dispatchers')
+
+            if inline:
+                with phase('inline'):
+                    removed = inline_functions(programs, max_size=inline_max_size)
+                    print_debug(f'inlined {len(removed)} functions away')
+
+            if factor_execute:
+                with phase('factor'):
+                    created = factor_execute_prefixes(programs, call_cost=factor_call_cost)
+                    print_debug(f'factored execute prefixes into {len(created)} functions')
+
+            if dedup:
+                with phase('dedup'):
+                    merged = dedup_functions(programs, jsons)
+                    print_debug(f'merged {len(merged)} duplicate functions')
+        else:
+            for program in programs.values():
+                program.used = True
+
+        slotted_flags = []
+        if score_flags:
+            with phase('flags'):
+                slotted_flags = allocate_flag_slots(programs)
+                print_debug(f'allocated {len(slotted_flags)} flags to {len({flag.slot for flag in slotted_flags})} score slots')
+
+        if lint or report is not None:
+            with phase('lint'):
+                for warning in lint_selectors(programs):
+                    if lint:
+                        print_warn(warning)
+                    if report is not None:
+                        report.warnings.append(warning)
+
+        valid_fun_refs = {path for path, program in programs.items() if program.used}
+        valid_json_refs = set(jsons)
+        validate_fun_ref, validate_json_ref = ref_validators(valid_fun_refs, valid_json_refs)
+
+        out_files: Dict[str, str] = {}
+        write_files: Dict[str, str] = {'pack.mcmeta': json.dumps({
+            "pack": {
+                "description": "Autogenerated by langcraft v0.1",
+                "pack_format": 47
+            }
+        })}
+        # pack.mcmeta
+
+        # json
+        with phase('serialize:json'):
+            for file_path, json_ in jsons.items():
+                with namespace('serialize:json', file_path):
+                    out_files[file_path] = json_.serialize(debug=debug, color=color, validate_fun=validate_fun_ref, validate_json=validate_json_ref)
+                if write:
+                    file_full_path = file_path.replace(DATAPACK_ROOT, data_dir) + '.json'
+                    write_files[file_full_path] = out_files[file_path]
+        # TODO nbt structures
+                    
+        # function:serialize
+        with phase('serialize:function'):
+            pending_programs: Dict[str, Program] = {}
+            cache_keys: Dict[str, str] = {}
+            for file_path, program in programs.items():
+                if program.used:
+                    out_files[file_path] = None
+                    if cache is not None:
+                        ref_edges = GLOBALS.ref_graph.get(fun_path_to_ref(file_path), {}).items()
+                        cache_keys[file_path] = cache.program_key(program, ref_edges, validate_fun=validate_fun_ref, validate_json=validate_json_ref, debug=debug, color=color)
+                        out_files[file_path] = cache.get(cache_keys[file_path])
+                    if out_files[file_path] is None:
+                        pending_programs[file_path] = program
+
+            if jobs > 1 and len(pending_programs) > 1:
+                serialized = compile_programs_parallel(pending_programs, jobs, valid_fun_refs, valid_json_refs, debug=debug, color=color)
+            else:
+                serialized = {}
+                for file_path, program in pending_programs.items():
+                    with namespace('serialize:function', file_path):
+                        serialized[file_path] = compile_program(program, color=color, debug=debug, validate_fun=validate_fun_ref, validate_json=validate_json_ref)
+
+            for file_path, serialized_file in serialized.items():
+                out_files[file_path] = serialized_file
+                if cache is not None:
+                    cache.set(cache_keys[file_path], serialized_file)
 
-    out_files: Dict[str, str] = {}
-    write_files: Dict[str, str] = {'pack.mcmeta': json.dumps({
-        "pack": {
-            "description": "Autogenerated by langcraft v0.1",
-            "pack_format": 47
-        }
-    })}
-    # pack.mcmeta
-
-    # json
-    for file_path, json_ in jsons.items():
-        out_files[file_path] = json_.serialize(debug=debug, color=color, validate_fun=validate_fun_ref, validate_json=validate_json_ref)
         if write:
-            file_full_path = file_path.replace(DATAPACK_ROOT, data_dir) + '.json'
-            write_files[file_full_path] = out_files[file_path]
-    # TODO nbt structures
-                
-    # function:serialize
-    for file_path, program in programs.items():
-        if program.used:
-            out_files[file_path] = compile_program(program, color=color, debug=debug, validate_fun=validate_fun_ref, validate_json=validate_json_ref)
-            if write:
-                file_full_path = file_path.replace(DATAPACK_ROOT, data_dir) + '.mcfunction'
-                write_files[file_full_path] = out_files[file_path]
-
-    if write:
-        save_strategy(root_dir, write_files)
-
-    return out_files
+            for file_path, program in programs.items():
+                if program.used:
+                    file_full_path = file_path.replace(DATAPACK_ROOT, data_dir) + '.mcfunction'
+                    write_files[file_full_path] = out_files[file_path]
+
+        if cache is not None:
+            cache.save()
+            print_info(f'build cache: {cache.hits} hits, {cache.misses} misses')
+            if report is not None:
+                report.cache_stats['hits'] = report.cache_stats.get('hits', 0) + cache.hits
+                report.cache_stats['misses'] = report.cache_stats.get('misses', 0) + cache.misses
+
+        if write:
+            with phase('save'):
+                save_strategy(root_dir, write_files)
+
+        # renders are only reused within a build (the validators differ between builds), so don't hold on to them
+        for program in programs.values():
+            for container in _containers(program):
+                container.clear_render_cache()
+
+        if slotted_flags:
+            for flag in slotted_flags:
+                flag.slot = None
+            invalidate_renders()
+
+        return out_files
+    finally:
+        if report is not None:
+            report.stop()
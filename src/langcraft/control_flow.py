@@ -1,18 +1,41 @@
-from typing import Literal, Self, List, Tuple
+from bisect import bisect_left
+from itertools import accumulate
+from pathlib import Path
+from typing import Dict, Literal, Self, List, Sequence, Tuple
+import json
+import re
 
-from .base import Statement, Fun, Block, FunStatement, WithStatement
-from .commands import Condition, RawExecute, _ConditionArgType
+from .analysis import score_tree_dispatch_cost
+from .base import Statement, Fun, Block, FunStatement, WithStatement, Pathspace
+from .commands import Condition, ExecuteSub, RawExecute, Teleport, _ConditionArgType, _ConditionType, _ExecuteContainer
+from .globals import GLOBALS, RefFlags
+from .inline import _container_tokens
+from .serialize import CommandKeywordToken, CommandNameToken, FunctionToken, MacroFunctionToken, MiscToken, RawToken, \
+                       TokensContainer
 from .scores import Score
-from .serialize_types import _Days, _Seconds
+from .serialize_types import _Days, _Seconds, _SelectorBase, Pos
 from .debug_utils import print_warn
 
+# commands single_eval adds (the function call and the if branch's return), in Condition.cost units
+SINGLE_EVAL_COST = 2
+RETURN_REGEX = re.compile(r'(^|\brun )return\b')
+
 class If(WithStatement):
-    def __init__(self, condition: _ConditionArgType, add=True):
+    def __init__(self, condition: _ConditionArgType, single_eval: bool | None = None, add=True):
+        """
+        single_eval: with an Else, evaluate the condition once: both branches move into a function where the if branch
+                     returns once it ran, instead of the else branch evaluating the negated condition again (which the
+                     if branch could also have changed); costs a function call
+                     None: when evaluating the condition again costs more than the call (see Condition.cost), so not
+                     for plain score or literal checks, nor when a branch returns, which would only leave the function
+        """
         super().__init__([], add=add)
 
         self.condition = condition if isinstance(condition, Condition) else (Condition(condition) if isinstance(condition, str) else Condition(str(condition)))
+        self.single_eval = single_eval
         self.if_block = Block()
         self.else_block = Block()
+        self._if_cmds = []
 
     def __call__(self, *statements: Statement | str) -> Self:
         self.if_block = Block(*statements)
@@ -20,7 +43,8 @@ class If(WithStatement):
         if self.condition.always_true:
             self.cmds = self.if_block._get_cmds()
         elif not self.condition.always_false:
-            self.cmds += RawExecute.as_cmds(subs=[self.condition], run_statements=self.if_block.statements)
+            self._if_cmds = RawExecute.as_cmds(subs=[self.condition], run_statements=self.if_block.statements)
+            self.cmds += self._if_cmds
         return self
     
     def Else(self, *statements: Statement | str) -> Self:
@@ -29,9 +53,41 @@ class If(WithStatement):
         if self.condition.always_false:
             self.tokens = self.else_block._get_cmds()
         elif not self.condition.always_true:
-            self.cmds += RawExecute.as_cmds(subs=[~self.condition], run_statements=self.else_block.statements)
+            if self._use_single_eval():
+                self.cmds[:] = [TokensContainer(self._single_eval_fun())]
+            else:
+                self.cmds += RawExecute.as_cmds(subs=[~self.condition], run_statements=self.else_block.statements)
         return self
 
+    def _use_single_eval(self) -> bool:
+        # ANY conditions run the if branch once per matching sub condition, returning after the first would skip the rest
+        if self.condition.condition_type == _ConditionType.ANY or len(self._if_cmds) == 0:
+            return False
+        if self.single_eval is not None:
+            return self.single_eval
+        return self.condition.cost > SINGLE_EVAL_COST and not self._branches_return()
+
+    def _branches_return(self) -> bool:
+        """
+        Whether a branch returns from the function it runs in (branches of several statements already get their own)
+        """
+        containers = [TokensContainer(*self._if_cmds[-1]._block_tokens)]
+        if len(self.else_block.statements) == 1:
+            containers += self.else_block.statements[0]._get_cmds()
+        return any(isinstance(token, CommandNameToken | CommandKeywordToken) and str(token) == 'return'
+                   or isinstance(token, RawToken) and RETURN_REGEX.search(str(token))
+                   for container in containers for token in _container_tokens(container))
+
+    def _single_eval_fun(self) -> FunctionToken:
+        """
+        Function running the if branch and returning, or else the else branch
+        Nothing is stored outside the function's own run, so the branches can run it again (e.g. as another entity)
+        """
+        *setup_cmds, execute_container = self._if_cmds
+        returning = _ExecuteContainer(list(execute_container._tokens),
+                                      [CommandKeywordToken('run'), CommandKeywordToken('return'), *execute_container._block_tokens])
+        return Fun._wrap_statements([Statement([*setup_cmds, returning], add=False), *self.else_block.statements])
+
 class While(WithStatement):
     def __init__(self, condition: Condition, add=True):
         super().__init__([], add=add)
@@ -65,10 +121,16 @@ class Do(Statement):
 
 
 class Schedule(WithStatement):
-    def __init__(self, time: int | float, time_type: None | Literal['s'] | Literal['d'] = None, add=True):
+    def __init__(self, time: int | float, time_type: None | Literal['t'] | Literal['s'] | Literal['d'] = None,
+                 mode: Literal['replace', 'append'] = 'replace', add=True):
+        """
+        Runs the block (or a Fun) in its own function, time ticks later (or seconds/days with time_type)
+        mode: replace moves an already scheduled run of the same function, append schedules another one
+        """
         super().__init__([], add=add)
 
         assert time > 0
+        self.mode = mode
         if time_type:
             self.time_type = time_type
             self.time = time
@@ -80,20 +142,177 @@ class Schedule(WithStatement):
             self.time_type = 's'
         else:
             self.time = time
-            self.time_type = ''
+            self.time_type = 't'
 
-    def __call__(self, *statements: Statement) -> Self:
-        Fun()(statement for statement in statements)
-        self.cmds = []
-        # TODO
+    def __call__(self, *statements: Statement | str | Fun) -> Self:
+        if len(statements) == 1 and isinstance(statements[0], Fun):
+            fun, = statements
+            fun._attach_fun_ref(path=GLOBALS.get_function_path(), ref_type=RefFlags.EXECUTE)
+            fun_token = FunctionToken(fun.namespace, fun.path)
+        else:
+            block = Block(*statements)
+            block.clear()
+            fun_token = Fun._wrap_statements(block.statements)
+        self.cmds = [TokensContainer(CommandNameToken('schedule'), fun_token, MiscToken(f'{self.time}{self.time_type}'),
+                                     CommandKeywordToken(self.mode))]
+        return self
+
+
+SLICE_OBJECTIVE = '_lc'
+
+class TimeSliced(WithStatement):
+    def __init__(self, per_tick: int, iterations: int | None = None, while_: _ConditionArgType | None = None,
+                 step: Pos | None = None, on_stop: Fun | None = None, add=True):
+        """
+        Repeats the block iterations times and/or while the condition holds (checked before each run), running it
+        at most per_tick times per tick (shared by every running instance) and continuing on the following ticks
+        The block runs as and at a marker summoned where the TimeSliced statement runs, which keeps the loop's state
+        between ticks: the remaining iterations in its SLICE_OBJECTIVE score, and its position and rotation, moved
+        by step after each run (e.g. Pos.angular(forward=1)) or by teleporting @s in the block
+        on_stop runs (as and at the marker) when the loop ends
+        """
+        super().__init__([], add=add)
+        assert per_tick > 0, 'TimeSliced needs to run at least once per tick'
+        assert iterations is not None or while_ is not None, 'TimeSliced needs iterations or a while_ condition to stop'
+        self.per_tick = per_tick
+        self.iterations = iterations
+        if while_ is not None and not isinstance(while_, Condition):
+            while_ = Condition(while_ if isinstance(while_, str) else str(while_))
+        self.condition = while_
+        self.step = step
+        self.on_stop = on_stop
+
+    def __call__(self, *statements: Statement | str) -> Self:
+        block = Block(*statements)
+        block.clear()
+        name = GLOBALS.gen_name('time_sliced')
+        tag = f'lc_slice_{name}'
+        budget = f'$slice_{name} {SLICE_OBJECTIVE}'
+        GLOBALS.add_setup(('score', SLICE_OBJECTIVE, 'dummy'))
+
+        def tail_call(fun: Fun, subs) -> Statement:
+            fun._attach_fun_ref(path=GLOBALS.get_function_path(), ref_type=RefFlags.EXECUTE)
+            return RawExecute(subs, [Statement([CommandKeywordToken('return'), CommandKeywordToken('run'),
+                                                FunctionToken(fun.namespace, fun.path)], add=False)])
+
+        with Fun() as stop:
+            if self.on_stop is not None:
+                self.on_stop()
+            Statement('kill @s')
+
+        with Fun() as loop:
+            # out of runs for this tick, the next step continues
+            Statement(f'execute unless score {budget} matches 1.. run return 0')
+            if self.iterations is not None:
+                tail_call(stop, [Condition(f'score @s {SLICE_OBJECTIVE} matches ..0')])
+            if self.condition is not None:
+                tail_call(stop, [~self.condition])
+            for statement in block.statements:
+                GLOBALS.add_statement(statement)
+            if self.iterations is not None:
+                Statement(f'scoreboard players remove @s {SLICE_OBJECTIVE} 1')
+            Statement(f'scoreboard players remove {budget} 1')
+            if self.step is not None:
+                Teleport(_SelectorBase(), self.step)
+            RawExecute.conditional_fun([ExecuteSub.at(_SelectorBase())], loop)
+
+        with Fun() as step:
+            Statement(f'scoreboard players set {budget} {self.per_tick}')
+            RawExecute.conditional_fun([ExecuteSub.as_(_SelectorBase('e', type='marker', tag=tag)), ExecuteSub.at(_SelectorBase())], loop)
+            If(f'entity @e[type=marker,tag={tag}]')(
+                Schedule(1)(step)
+            )
+
+        with Fun() as init:
+            Statement('tp @s ~ ~ ~ ~ ~')  # take the rotation of the TimeSliced statement's context
+            Statement(f'tag @s add {tag}')
+            if self.iterations is not None:
+                Statement(f'scoreboard players set @s {SLICE_OBJECTIVE} {self.iterations}')
+            Schedule(1)(step)
+
+        self.cmds = RawExecute.as_cmds([ExecuteSub.summon('marker')], [FunStatement(init, attach_local_refs=True, ref_type=RefFlags.EXECUTE)])
+        return self
+
+
+OPTIMAL_TREE_MAX_LEAVES = 512  # above this, weighted trees use the weight-balanced approximation instead of the O(n^2) DP
+
+def optimal_splits(weights: Sequence[float]) -> Dict[Tuple[int, int], int]:
+    """
+    Order-preserving binary tree over leaves with the given weights minimizing sum(weight * depth)
+    (optimal alphabetic tree, Knuth's O(n^2) DP), as {(first leaf, n leaves): n leaves in the left subtree}
+    """
+    n = len(weights)
+    prefix = [0, *accumulate(weights)]
+    cost = [[0.] * n for _ in range(n)]
+    root = [[i] * n for i in range(n)]  # root[i][j] = last leaf of the left subtree over leaves i..j
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            lo, hi = root[i][j - 1], root[i + 1][j] if length > 2 else i
+            best_k, best_cost = lo, None
+            for k in range(lo, min(hi, j - 1) + 1):
+                c = cost[i][k] + cost[k + 1][j]
+                if best_cost is None or c < best_cost:
+                    best_k, best_cost = k, c
+            cost[i][j] = best_cost + prefix[j + 1] - prefix[i]
+            root[i][j] = best_k
+    return {(i, j - i + 1): root[i][j] - i + 1 for i in range(n) for j in range(i + 1, n)}
+
+def weight_balanced_splits(weights: Sequence[float]) -> Dict[Tuple[int, int], int]:
+    """
+    Same as optimal_splits but splitting each range where its weight halves, within 2 checks of optimal
+    """
+    prefix = [0, *accumulate(weights)]
+    splits = {}
+
+    def split(i: int, n: int):
+        if n <= 1:
+            return
+        half = (prefix[i] + prefix[i + n]) / 2
+        k = bisect_left(prefix, half, i + 1, i + n) - i
+        # take whichever side of the halfway point is closer, keeping both subtrees nonempty
+        if k > 1 and half - prefix[i + k - 1] < prefix[i + k] - half:
+            k -= 1
+        k = min(max(k, 1), n - 1)
+        splits[(i, n)] = k
+        split(i, k)
+        split(i + k, n - k)
+
+    split(0, len(weights))
+    return splits
 
 
 class ScoreTree(WithStatement):
-    def __init__(self, score_key: str, cmds_per_score: int = 1, *, leafs_terminal=False, add=True):
+    DISPATCH_STORAGE = '_internal:dispatch'
+    MACRO_LEAF_PREFIX = 'leaf_'
+
+    def __init__(self, score_key: str, cmds_per_score: int = 1, *, leafs_terminal=False,
+                 dispatch: Literal['tree', 'macro', 'auto'] = 'tree',
+                 weights: Sequence[float] | None = None, profile: str | Path | None = None, add=True):
+        """
+        dispatch:
+            tree: binary tree of `execute if score ... matches` functions, ~2*log2(n) commands per dispatch
+            macro: stores the score and jumps straight to `leaf_<score>` with a function macro (1.20.2+),
+                   a constant number of commands but one function file per leaf; scores out of range run nothing
+            auto: whichever score_tree_dispatch_cost estimates to be cheaper
+        weights: relative frequency of each score value (statement group), to shape the tree so frequent values
+                 take fewer checks
+        profile: JSON file of observed score values ({score_key: {value: count}}, see Simulator.write_profile)
+                 to take the weights from
+        """
         super().__init__([], add=add)
         self.score = Score(objective=score_key)
         self.cmds_per_score = cmds_per_score
         self.leafs_terminal = leafs_terminal
+        self.dispatch = dispatch
+        if profile is not None:
+            with open(profile) as f:
+                counts = json.load(f).get(score_key, {})
+            if not counts:
+                print_warn(f'profile {profile} has no samples for {score_key}')
+            weights = [counts.get(str(i), 0) for i in range(max(map(int, counts), default=-1) + 1)]
+        self.weights = weights
+        self._splits: Dict[Tuple[int, int], int] = {}
 
     def __call__(self, *statements: Statement):
         n = len(statements)            
@@ -103,13 +322,50 @@ class ScoreTree(WithStatement):
         if len(grouped_statements) == 1:
             print_warn("Likely misuse of ScoreTree with singuar statement group")
             Fun._wrap_statements(*grouped_statements)
+            return
+
+        dispatch = self.dispatch
+        if dispatch == 'auto':
+            n = len(grouped_statements)
+            dispatch = 'macro' if score_tree_dispatch_cost(n, 'macro') < score_tree_dispatch_cost(n, 'tree') else 'tree'
+        if dispatch == 'macro':
+            self._generate_macro_dispatch(grouped_statements)
         else:
+            if self.weights is not None:
+                weights = list(self.weights[:len(grouped_statements)])
+                weights += [0] * (len(grouped_statements) - len(weights))
+                if len(weights) <= OPTIMAL_TREE_MAX_LEAVES:
+                    self._splits = optimal_splits(weights)
+                else:
+                    self._splits = weight_balanced_splits(weights)
             self._generate_tree(grouped_statements)
 
+    def _generate_macro_dispatch(self, grouped_statements):
+        with Fun() as f:
+            key = '_'.join([f.namespace, *f.path])
+            Statement(TokensContainer(
+                CommandNameToken('execute'), CommandKeywordToken('store'), CommandKeywordToken('result'),
+                MiscToken(f'storage {self.DISPATCH_STORAGE} {key}.id int 1'), CommandKeywordToken('run'),
+                CommandNameToken('scoreboard'), CommandKeywordToken('players'), CommandKeywordToken('get'),
+                self.score.target, self.score.objective
+            ))
+            with Fun('dispatch') as dispatch:
+                Statement(MacroFunctionToken(f.namespace, f.path + [self.MACRO_LEAF_PREFIX], 'id'))
+            Statement([FunctionToken(dispatch.namespace, dispatch.path), CommandKeywordToken('with'),
+                       MiscToken(f'storage {self.DISPATCH_STORAGE} {key}')])
+            GLOBALS.ref_call(f.ref, dispatch.ref)
+
+            for i, statements in enumerate(grouped_statements):
+                with Pathspace(f'{self.MACRO_LEAF_PREFIX}{i}'):
+                    for statement in statements:
+                        GLOBALS.add_statement(statement)
+                    GLOBALS.ref_call(dispatch.ref, Fun._gen_ref(), ref_type=RefFlags.MACRO)
+        f()
+
     def _generate_tree(self, grouped_statements, a=0) -> Tuple[Statement]:
         if len(grouped_statements) == 1:
             return grouped_statements[0]
-        n2 = len(grouped_statements) // 2
+        n2 = self._splits.get((a, len(grouped_statements)), len(grouped_statements) // 2)
         with Fun() as f:
             if self.leafs_terminal:
                 If(self.score.in_range(a, a + n2 - 1))(
@@ -117,11 +373,16 @@ class ScoreTree(WithStatement):
                 )
                 self._generate_tree(grouped_statements[n2:], a + n2)
             else:
-                If(self.score.in_range(a, a + n2 - 1))(
-                    *self._generate_tree(grouped_statements[:n2], a)
-                ).Else(
-                    *self._generate_tree(grouped_statements[n2:], a + n2)
-                )
+                # the lower half returns once it ran, so a leaf changing the score can't run the upper half as well
+                lower = Block(*self._generate_tree(grouped_statements[:n2], a))
+                lower.clear()
+                lower_tokens = (lower.statements[0].single_line_tokenize() if len(lower) == 1 else None) \
+                    or [Fun._wrap_statements(lower.statements)]
+                RawExecute([self.score.in_range(a, a + n2 - 1)],
+                           [Statement([CommandKeywordToken('return'), CommandKeywordToken('run'), *lower_tokens], add=False)])
+                upper = Block(*self._generate_tree(grouped_statements[n2:], a + n2))
+                upper.clear()
+                upper.cmds_to_global()
         return (f(),)
 
 type start = int
@@ -23,4 +23,7 @@ def print_debug(msg):
 
 def print_debug_colorful(msg, c='green'):
     if DEBUG:
-        cprint(f'debug: {msg}', c)
\ No newline at end of file
+        cprint(f'debug: {msg}', c)
+
+def print_info(msg):
+    cprint(f'info: {msg}', 'cyan')
@@ -0,0 +1,127 @@
+from hashlib import sha256
+from typing import Dict, List, Set
+import re
+
+from .debug_utils import print_debug
+from .globals import GLOBALS, DATAPACK_ROOT, RefFlags
+from .inline import _container_tokens, _containers
+from .json_utils import JSON
+from .serialize import CommandNameToken, FunctionToken, Program, RawToken, invalidate_renders, serialize_function_name
+
+FUNCTION_TAG_REGEX = re.compile(rf'^{re.escape(DATAPACK_ROOT)}/[^/]+/tags/function/')
+
+def function_name(path: str) -> str:
+    """
+    $root/<namespace>/function/<path> -> <namespace>:<path>
+    """
+    _, namespace, _, *fun_path = path.split('/')
+    return serialize_function_name(namespace, fun_path)
+
+def _pinned(path: str, used: Dict[str, Program], raw_text: str) -> bool:
+    """
+    Whether path has to keep its name: it's hooked, referenced from JSON, picked by a macro or named in a raw command
+    """
+    for caller, ref_type in GLOBALS.backwards_ref_graph.get(('function', path), {}).items():
+        if caller[0] != 'function' or caller[1] not in used or ref_type & RefFlags.MACRO:
+            return True
+    return function_name(path) in raw_text
+
+def _scheduled(used: Dict[str, Program]) -> Set[str]:
+    """
+    Functions named by schedule commands, which keep their name: schedule replaces (or clears) the pending run of the
+    same function, so two scheduled functions merged into one would run once instead of twice
+    """
+    scheduled = set()
+    for program in used.values():
+        for container in _containers(program):
+            tokens = list(_container_tokens(container))
+            if any(isinstance(token, CommandNameToken) and str(token) == 'schedule' for token in tokens):
+                scheduled |= {GLOBALS.get_function_path(token.namespace, token.path)
+                              for token in tokens if isinstance(token, FunctionToken)}
+    return scheduled
+
+def dedup_functions(programs: Dict[str, Program] | None = None,
+                    jsons: Dict[str, JSON] | None = None) -> Dict[str, str]:
+    """
+    Merges used functions with identical serialized bodies into one canonical function (the first one in programs,
+    or the one that has to keep its name: hooked, scheduled or named in raw commands), rewriting every FunctionToken
+    and function tag referencing the others
+    Repeats until no more functions merge, as merging callees can make their callers identical
+    Returns {merged path: canonical path}
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    if jsons is None:
+        jsons = GLOBALS.jsons
+    used = {path: program for path, program in programs.items() if program.used}
+    tags = {path: json_ for path, json_ in jsons.items() if FUNCTION_TAG_REGEX.match(path)}
+    raw_text = '\n'.join(str(token) for program in used.values() for container in _containers(program)
+                         for token in _container_tokens(container) if isinstance(token, RawToken))
+    pinned = {path for path in used if _pinned(path, used, raw_text)} | (_scheduled(used) & used.keys())
+
+    # tags running each function, as merging two functions sharing a tag would run it once instead of twice
+    function_tags: Dict[str, Set[str]] = {}
+    for tag_path, tag in tags.items():
+        for name in tag.obj.get('values', []):
+            function_tags.setdefault(name, set()).add(tag_path)
+
+    merged: Dict[str, str] = {}
+    changed = True
+    while changed:
+        changed = False
+        canonical: Dict[str, str] = {}
+        remap: Dict[str, str] = {}
+        for path, program in used.items():
+            if path in merged:
+                continue
+            key = sha256(program.serialize().encode()).hexdigest()
+            if key not in canonical:
+                canonical[key] = path
+                continue
+            target = canonical[key]
+            if path in pinned:
+                if target in pinned:
+                    continue
+                # the pinned function keeps its name, the earlier one merges into it
+                canonical[key], path, target = path, target, path
+            target_tags = function_tags.get(function_name(target), set())
+            if target_tags & function_tags.get(function_name(path), set()):
+                continue
+            function_tags[function_name(target)] = target_tags | function_tags.get(function_name(path), set())
+            remap[path] = target
+        if not remap:
+            break
+
+        # merging a into b then b into c leaves a -> c
+        for path, target in remap.items():
+            while target in remap:
+                target = remap[target]
+            remap[path] = target
+            print_debug(f'merged duplicate function {path} into {target}')
+            merged[path] = target
+            used[path].used = False
+            changed = True
+        for path, target in merged.items():
+            if target in remap:
+                merged[path] = remap[target]
+
+        for program in used.values():
+            for container in _containers(program):
+                for token in _container_tokens(container):
+                    if isinstance(token, FunctionToken) and \
+                            (target := remap.get(GLOBALS.get_function_path(token.namespace, token.path))) is not None:
+                        _, token.namespace, _, *token.path = target.split('/')
+        invalidate_renders()
+
+        for path, target in remap.items():
+            path_ref, target_ref = ('function', path), ('function', target)
+            for caller, ref_type in GLOBALS.backwards_ref_graph.pop(path_ref, {}).items():
+                GLOBALS.ref_graph.get(caller, {}).pop(path_ref, None)
+                GLOBALS.ref_call(caller, target_ref, ref_type)
+
+    renamed = {function_name(path): function_name(target) for path, target in merged.items()}
+    for tag in tags.values():
+        values: List[str] = tag.obj.get('values', [])
+        if any(name in renamed for name in values):
+            tag.obj['values'] = list(dict.fromkeys(renamed.get(name, name) for name in values))
+    return merged
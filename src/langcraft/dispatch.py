@@ -0,0 +1,191 @@
+from typing import Dict, List, Set, Tuple
+import re
+
+from .base import Namespace
+from .debug_utils import print_debug
+from .factor import _factorable
+from .globals import GLOBALS, RefFlags
+from .inline import _callees, _container_tokens, _containers
+from .lint import TICK_HOOK
+from .nbt_cache import CachedSelectorToken
+from .serialize import CommandKeywordToken, CommandNameToken, FunctionToken, Program, RawToken, SelectorToken, \
+                       TokensContainer, serialize_function_name
+from .serialize_types import _SelectorBase
+from .commands import _ExecuteContainer
+
+DISPATCH_NAMESPACE = '_internal'
+# selector arguments that pick among the matches, so they can't be checked one entity at a time
+UNDISPATCHABLE_ARGS = {'limit', 'sort'}
+
+
+def _scan(container: TokensContainer) -> Tuple[str, SelectorToken] | None:
+    """
+    (entity type, selector) of an `execute as @e[type=...] ... run ...` command
+    """
+    if not _factorable(container) or len(container._tokens) < 3 or str(container._tokens[1]) != 'as':
+        return None
+    selector = container._tokens[2]
+    if isinstance(selector, _SelectorBase):
+        selector = selector.token
+    if not isinstance(selector, SelectorToken) or selector.s != 'e' or 'type' not in selector.kwargs \
+            or UNDISPATCHABLE_ARGS & selector.kwargs.keys():
+        return None
+    return _entity_type(selector.kwargs['type']), selector
+
+def _entity_type(type_arg) -> str:
+    """
+    A type selector argument as one spelling per type: the minecraft: namespace is implied, ! and # are kept
+    """
+    type_arg = str(type_arg)
+    name = type_arg.lstrip('!#')
+    return type_arg[:len(type_arg) - len(name)] + (name if ':' in name else f'minecraft:{name}')
+
+def _dispatched(container: _ExecuteContainer, selector: SelectorToken) -> TokensContainer:
+    """
+    The command run by each entity of the merged scan
+    """
+    kwargs = {key: val for key, val in selector.kwargs.items() if key != 'type'}
+    subs = list(container._tokens[3:])
+    if isinstance(selector, CachedSelectorToken):
+        subs = [CommandKeywordToken('if'), CommandKeywordToken('entity'), CachedSelectorToken('s', selector.cache, **kwargs), *subs]
+    elif kwargs:
+        subs = [CommandKeywordToken('if'), CommandKeywordToken('entity'), SelectorToken('s', **kwargs), *subs]
+    if not subs:
+        return TokensContainer(*container._block_tokens[1:])
+    return _ExecuteContainer([container._tokens[0], *subs], list(container._block_tokens))
+
+def _dispatcher_name(entity_type: str, taken: Set[str]) -> str:
+    """
+    Name of the dispatcher function of entity_type, not in taken
+    """
+    name = re.sub(r'[^a-z0-9_]', '_', entity_type.replace('minecraft:', '', 1).lower())
+    unique = name
+    i = 1
+    while unique in taken:
+        unique = f'{name}_{i}'
+        i += 1
+    return unique
+
+def _hook_only(path: str, hook: str, raw_text: str) -> bool:
+    """
+    Whether the function only runs from hook: no other function, hook or raw command references it
+    """
+    if any(caller != ('$extern', hook) for caller in GLOBALS.backwards_ref_graph.get(('function', path), {})):
+        return False
+    _, namespace, _, *fun_path = path.split('/')
+    return serialize_function_name(namespace, fun_path) not in raw_text
+
+def _unhook(path: str, hook: str, replacement: str | None = None):
+    """
+    Removes path from hook's function tag and ref edges, hooking replacement in its place
+    """
+    hook_ref = ('$extern', hook)
+    ref_type = GLOBALS.ref_graph.get(hook_ref, {}).pop(('function', path), RefFlags.NONE)
+    GLOBALS.backwards_ref_graph.get(('function', path), {}).pop(hook_ref, None)
+    _, namespace, _, *fun_path = path.split('/')
+    name = serialize_function_name(namespace, fun_path)
+    tag_namespace, tag_path = hook[1:].split(':')
+    tag = GLOBALS.jsons.get(GLOBALS.get_json_path('tags/function', namespace=tag_namespace, path=tag_path.split('/')))
+    if replacement is None:
+        if tag is not None:
+            tag.values = [value for value in tag.values if value != name]
+        return
+    GLOBALS.ref_call(hook_ref, ('function', replacement), ref_type)
+    if tag is not None:
+        _, namespace, _, *fun_path = replacement.split('/')
+        tag.values = [serialize_function_name(namespace, fun_path) if value == name else value for value in tag.values]
+
+
+def dispatch_tick_scans(programs: Dict[str, Program] | None = None, hook: str = TICK_HOOK) -> Dict[str, str]:
+    """
+    Merges the `execute as @e[type=<type>,...] ... run ...` commands of the used functions hooked to hook into one
+    `execute as @e[type=<type>] run function <dispatcher>` per entity type scanned more than once, whose dispatcher
+    runs each command's remaining filters (as `if entity @s[...]`) and subcommands for the entity
+    The merged scans run after every hooked function (from the _internal:tick function appended to the hook) and
+    one entity at a time, so they shouldn't depend on the other commands of the hooked functions in the same tick
+    Hooked functions only run from hook lose their scans (and their file if nothing is left); the hook runs a copy
+    without the scans (_internal:tick/hooked/<namespace>/<path>) of functions that are also run from elsewhere
+    Returns {entity type, with its namespace: dispatcher path}
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    hooked = [callee[1] for callee in GLOBALS.ref_graph.get(('$extern', hook), {})
+              if callee[0] == 'function' and callee[1] in programs and programs[callee[1]].used]
+
+    scans: Dict[str, List[Tuple[str, _ExecuteContainer, SelectorToken]]] = {}
+    for path in hooked:
+        for container in _containers(programs[path]):
+            if (scan := _scan(container)) is not None:
+                entity_type, selector = scan
+                scans.setdefault(entity_type, []).append((path, container, selector))
+    scans = {entity_type: type_scans for entity_type, type_scans in scans.items() if len(type_scans) > 1}
+    if not scans:
+        return {}
+
+    # functions also run from elsewhere keep their scans, the hook runs a copy without them instead
+    raw_text = '\n'.join(str(token) for program in programs.values() if program.used for container in _containers(program)
+                         for token in _container_tokens(container) if isinstance(token, RawToken))
+    moved = {id(container) for type_scans in scans.values() for _, container, _ in type_scans}
+    for path in hooked:
+        containers = _containers(programs[path])
+        if not any(id(container) in moved for container in containers):
+            continue
+        kept = [container for container in containers if id(container) not in moved]
+        if _hook_only(path, hook, raw_text):
+            if kept:
+                programs[path].cmds = kept
+            else:
+                programs[path].used = False
+                _unhook(path, hook)
+            continue
+        if not kept:
+            _unhook(path, hook)
+            continue
+        _, namespace, _, *fun_path = path.split('/')
+        copy_path = GLOBALS.get_function_path(DISPATCH_NAMESPACE, ['tick', 'hooked', namespace, *fun_path])
+        copy = Program(*kept)
+        copy.used = True
+        programs[copy_path] = copy
+        callee_refs = GLOBALS.ref_graph.get(('function', path), {})
+        for container in kept:
+            for callee in _callees(container):
+                callee_ref = ('function', callee)
+                GLOBALS.ref_call(('function', copy_path), callee_ref, callee_refs.get(callee_ref, RefFlags.NONE))
+        _unhook(path, hook, replacement=copy_path)
+        print_debug(f'{path} is not only run from {hook}, hooked {copy_path} without its scans instead')
+
+    tick_path = GLOBALS.get_function_path(DISPATCH_NAMESPACE, ['tick'])
+    tick_ref = ('function', tick_path)
+    tick_cmds = []
+    dispatchers: Dict[str, str] = {}
+    names: Set[str] = set()
+    for entity_type, type_scans in scans.items():
+        name = _dispatcher_name(entity_type, names)
+        names.add(name)
+        dispatcher_path = GLOBALS.get_function_path(DISPATCH_NAMESPACE, ['tick', name])
+        dispatcher_ref = ('function', dispatcher_path)
+        dispatcher = Program(*(_dispatched(container, selector) for _, container, selector in type_scans))
+        dispatcher.used = True
+        programs[dispatcher_path] = dispatcher
+        dispatchers[entity_type] = dispatcher_path
+        for path, container, _ in type_scans:
+            callee_refs = GLOBALS.ref_graph.get(('function', path), {})
+            for callee in _callees(container):
+                callee_ref = ('function', callee)
+                GLOBALS.ref_call(dispatcher_ref, callee_ref, callee_refs.get(callee_ref, RefFlags.NONE))
+        GLOBALS.ref_call(tick_ref, dispatcher_ref, RefFlags.EXECUTE)
+        tick_cmds.append(_ExecuteContainer(
+            [CommandNameToken('execute'), CommandKeywordToken('as'), SelectorToken('e', type=type_scans[0][2].kwargs['type'])],
+            [CommandKeywordToken('run'), FunctionToken(DISPATCH_NAMESPACE, ['tick', name])]
+        ))
+        print_debug(f'merged {len(type_scans)} {hook} scans of @e[type={entity_type}] into {dispatcher_path}')
+
+    tick = programs.setdefault(tick_path, Program())
+    tick.cmds += tick_cmds
+    tick.used = True
+    if tick_ref not in GLOBALS.ref_graph.get(('$extern', hook), {}):
+        GLOBALS.ref_call(('$extern', hook), tick_ref)
+        tag_namespace, tag_path = hook[1:].split(':')
+        with Namespace(name=tag_namespace, full_path=tag_path.split('/')):
+            GLOBALS.add_to_function_tag(None, [serialize_function_name(DISPATCH_NAMESPACE, ['tick'])])
+    return dispatchers
@@ -0,0 +1,141 @@
+from typing import Dict, List, Set, Tuple
+
+from .debug_utils import print_debug
+from .globals import GLOBALS, RefFlags
+from .inline import UNINLINABLE_REGEX, _callees, _containers
+from .serialize import Choice, CommandKeywordToken, CommandNameToken, FunctionToken, MacroFunctionToken, Program, \
+                       TokenBase, TokensContainer
+from .commands import _ExecuteContainer
+
+FACTOR_CALL_COST = 1  # cost of the added `function` call, in selector scans
+
+# subcommands that only change the executing context, with their number of arguments
+# (positioned/rotated take one more after `as`/`over`)
+CONTEXT_SUBCOMMANDS = {'as': 1, 'at': 1, 'in': 1, 'anchored': 1, 'align': 1, 'on': 1, 'positioned': 1, 'rotated': 1}
+
+type Sub = Tuple[TokenBase, ...]
+
+
+def _context_subs(container: _ExecuteContainer) -> Tuple[List[Sub], List[TokenBase]]:
+    """
+    Splits an execute's subcommands into its leading context subcommands and the rest
+    """
+    tokens = container._tokens[1:]
+    subs: List[Sub] = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if not isinstance(token, CommandKeywordToken) or str(token) not in CONTEXT_SUBCOMMANDS:
+            break
+        n = CONTEXT_SUBCOMMANDS[str(token)]
+        if i + 1 < len(tokens) and str(token) in ('positioned', 'rotated') and str(tokens[i + 1]) in ('as', 'over'):
+            n += 1
+        sub = tuple(tokens[i:i + 1 + n])
+        if len(sub) != 1 + n or any(isinstance(token_, Choice) for token_ in sub):
+            break
+        subs.append(sub)
+        i += 1 + n
+    return subs, list(tokens[i:])
+
+def _scans(subs: List[Sub]) -> int:
+    """
+    Selectors the subcommands evaluate, other than the executing entity
+    """
+    return sum(1 for sub in subs for token in sub if str(token).startswith('@') and str(token) != '@s')
+
+def _common(subs0: List[Sub], subs1: List[Sub]) -> List[Sub]:
+    common = []
+    for sub0, sub1 in zip(subs0, subs1):
+        if tuple(map(str, sub0)) != tuple(map(str, sub1)):
+            break
+        common.append(sub0)
+    return common
+
+def _factorable(container: TokensContainer) -> bool:
+    if not isinstance(container, _ExecuteContainer) or len(container._block_tokens) < 2 or \
+            str(container._block_tokens[0]) != 'run':
+        return False
+    if any(isinstance(token, MacroFunctionToken) for token in container):
+        return False
+    return not any(UNINLINABLE_REGEX.search(line) for line in str(container).split('\n'))
+
+
+def _gen_path(caller: str, programs: Dict[str, Program]) -> str:
+    for i in range(1 << 16):
+        candidate = f'{caller}/p{hex(i)[2:]}'
+        if candidate not in programs:
+            return candidate
+    assert False, f'Ran out of function names under {caller}'
+
+
+def factor_execute_prefixes(programs: Dict[str, Program] | None = None, call_cost: int = FACTOR_CALL_COST) -> Set[str]:
+    """
+    Hoists context subcommands (as, at, positioned, ...) shared by consecutive execute commands of a used function
+    into a single `execute <shared> run function <new>`, whose body runs the remaining subcommands
+    Only applied when the selector scans saved outnumber call_cost
+    This runs the commands one entity at a time instead of each command over every entity, so it assumes the
+    commands don't change which entities the shared selectors match, or read state another entity's commands write
+    Returns the paths of the new functions
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    created: Set[str] = set()
+    for path, program in list(programs.items()):
+        if not program.used:
+            continue
+        containers = _containers(program)
+        new_containers: List[TokensContainer] = []
+        changed = False
+        i = 0
+        while i < len(containers):
+            if not _factorable(containers[i]):
+                new_containers.append(containers[i])
+                i += 1
+                continue
+            prefix, _ = _context_subs(containers[i])
+            scans = _scans(prefix)
+            j = i + 1
+            while j < len(containers) and _factorable(containers[j]):
+                common = _common(prefix, _context_subs(containers[j])[0])
+                if not common or _scans(common) < scans:
+                    break
+                prefix = common
+                j += 1
+            if (j - i - 1) * scans <= call_cost:
+                new_containers.append(containers[i])
+                i += 1
+                continue
+
+            body: List[TokensContainer] = []
+            for container in containers[i:j]:
+                subs, rest = _context_subs(container)
+                suffix = [token for sub in subs[len(prefix):] for token in sub] + rest
+                if suffix:
+                    body.append(_ExecuteContainer([container._tokens[0], *suffix], list(container._block_tokens)))
+                else:
+                    body.append(TokensContainer(*container._block_tokens[1:]))
+            new_path = _gen_path(path, programs)
+            new_program = Program(*body)
+            new_program.used = True
+            programs[new_path] = new_program
+            created.add(new_path)
+
+            caller_ref, new_ref = ('function', path), ('function', new_path)
+            GLOBALS.ref_call(caller_ref, new_ref, RefFlags.EXECUTE)
+            callee_refs = GLOBALS.ref_graph.get(caller_ref, {})
+            for callee in dict.fromkeys(callee for container in body for callee in _callees(container)):
+                callee_ref = ('function', callee)
+                GLOBALS.ref_call(new_ref, callee_ref, callee_refs.get(callee_ref, RefFlags.NONE))
+
+            _, namespace, _, *fun_path = new_path.split('/')
+            new_containers.append(_ExecuteContainer(
+                [CommandNameToken('execute'), *(token for sub in prefix for token in sub)],
+                [CommandKeywordToken('run'), FunctionToken(namespace, fun_path)]
+            ))
+            print_debug(f'factored {len(body)} commands sharing `execute {" ".join(map(str, (token for sub in prefix for token in sub)))}` '
+                        f'out of {path} into {new_path}')
+            changed = True
+            i = j
+        if changed:
+            program.cmds = new_containers
+    return created
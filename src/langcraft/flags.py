@@ -0,0 +1,96 @@
+from typing import Dict, List, Set, Tuple
+
+from .globals import GLOBALS, Ref, RefFlags
+from .inline import _container_tokens
+from .serialize import CheckFlagToken, Flag, FunctionToken, MacroFunctionToken, Program, ResetFlagToken, \
+                       SetFlagToken, TokenBase, TokensRef, invalidate_renders
+
+FLAG_TOKENS = (ResetFlagToken, SetFlagToken, CheckFlagToken)
+
+def _scan_program(path: str, program: Program, ref_graph: Dict[Ref, Dict[Ref, RefFlags]], flags: Dict[str, List[Flag]]) \
+        -> Tuple[Dict[str, Tuple[int, int]], List[Set[str]]]:
+    """
+    (flag name -> first and last command index it's used at, functions called by each command)
+    Flag tokens get copied along with their statements, so flags are identified by name and collected into flags
+    """
+    ranges: Dict[str, Tuple[int, int]] = {}
+    calls: List[Set[str]] = []
+    macro_callees = {callee[1] for callee, flags in ref_graph.get(('function', path), {}).items() if flags & RefFlags.MACRO}
+    i = 0
+    for cmd in program:
+        if cmd is None:
+            continue
+        for container in (cmd.resolve() if isinstance(cmd, TokensRef) else [cmd]):
+            cmd_calls = set()
+            for token in _container_tokens(container):
+                token: TokenBase
+                if isinstance(token, FLAG_TOKENS):
+                    name = token.flag.name
+                    lo, hi = ranges.get(name, (i, i))
+                    ranges[name] = (min(lo, i), max(hi, i))
+                    flags.setdefault(name, []).append(token.flag)
+                elif isinstance(token, FunctionToken):
+                    cmd_calls.add(GLOBALS.get_function_path(token.namespace, token.path))
+                elif isinstance(token, MacroFunctionToken):
+                    cmd_calls |= macro_callees
+            calls.append(cmd_calls)
+            i += 1
+    return ranges, calls
+
+def allocate_flag_slots(programs: Dict[str, Program], ref_graph: Dict[Ref, Dict[Ref, RefFlags]] | None = None) -> List[Flag]:
+    """
+    Assigns every flag used by the used programs a scoreboard slot (rendered as `#f<slot>` on FLAG_OBJECTIVE),
+    sharing slots between flags whose lifetimes never overlap
+    A flag is live from its first to its last use in a function, including everything called in between
+    Returns the flags that got a slot
+    """
+    if ref_graph is None:
+        ref_graph = GLOBALS.ref_graph
+
+    flags: Dict[str, List[Flag]] = {}
+    scans = {path: _scan_program(path, program, ref_graph, flags) for path, program in programs.items() if program.used}
+
+    # flags used by each function or anything it (transitively) calls
+    flags_below: Dict[str, Set[str]] = {path: set(ranges) for path, (ranges, _) in scans.items()}
+    callees: Dict[str, Set[str]] = {path: set().union(*calls) & scans.keys() for path, (_, calls) in scans.items()}
+    changed = True
+    while changed:
+        changed = False
+        for path, path_callees in callees.items():
+            below = flags_below[path]
+            n = len(below)
+            for callee in path_callees:
+                below |= flags_below[callee]
+            changed |= len(below) != n
+
+    interference: Dict[str, Set[str]] = {}
+    for path, (ranges, calls) in scans.items():
+        for flag, (lo, hi) in ranges.items():
+            neighbors = interference.setdefault(flag, set())
+            for other, (other_lo, other_hi) in ranges.items():
+                if other != flag and lo <= other_hi and other_lo <= hi:
+                    neighbors.add(other)
+            for i in range(lo, hi + 1):
+                for callee in calls[i] & scans.keys():
+                    neighbors |= flags_below[callee]
+            neighbors.discard(flag)
+    for flag, neighbors in list(interference.items()):
+        for neighbor in neighbors:
+            interference.setdefault(neighbor, set()).add(flag)
+
+    # greedy coloring, most constrained flags first
+    slots: Dict[str, int] = {}
+    for flag in sorted(interference, key=lambda flag: -len(interference[flag])):
+        taken = {slots.get(neighbor) for neighbor in interference[flag]}
+        slot = 0
+        while slot in taken:
+            slot += 1
+        slots[flag] = slot
+
+    slotted_flags = []
+    for name, slot in slots.items():
+        for flag in flags[name]:
+            flag.slot = slot
+            slotted_flags.append(flag)
+    invalidate_renders()
+    return slotted_flags
@@ -2,6 +2,7 @@ from enum import IntEnum
 from typing import Optional, Callable, Set, Tuple, List, Dict, Literal
 import random
 import string
+import sys
 
 from .base_types import ObjectiveName, ScoreCriterion
 from .json_utils import JSON, FunctionJSON
@@ -14,9 +15,11 @@ class RefFlags(IntEnum):
     NONE = 0b0
     WITH_BLOCK = 0b1
     EXECUTE = 0b10
+    MACRO = 0b100  # callee picked at runtime by a macro line
 
 type ScoreSetup = Tuple[Literal['score'], ObjectiveName, ScoreCriterion]
-type Setup = ScoreSetup
+type ScheduleSetup = Tuple[Literal['schedule'], str, int]  # function name, ticks
+type Setup = ScoreSetup | ScheduleSetup
 
 class Globals:
     def __init__(self, namespace='main'):
@@ -32,6 +35,7 @@ class Globals:
         self.in_with = False
 
         self.setups: List[Setup] = []
+        self.nbt_caches: Dict[str, 'NbtCache'] = {}  # match tag -> cache, see nbt_cache
 
         self.backwards_ref_graph: Dict[Ref, Dict[Ref, RefFlags]] = {}  # GLOBALS.ref_graph[callee_ref] = {caller_ref for caller_ref in caller_refs}
         self.ref_graph: Dict[Ref, Dict[Ref, RefFlags]] = {}  # GLOBALS.ref_graph[caller_ref] = {callee_ref for callee_ref in callee_refs}
@@ -110,7 +114,8 @@ class Globals:
             namespace = self.namespace
         if path is None:
             path = self.path
-        return '/'.join([DATAPACK_ROOT, namespace, 'function'] + path)
+        # interned, as the same path is kept by the ref graphs, programs and every statement's index
+        return sys.intern('/'.join([DATAPACK_ROOT, namespace, 'function'] + path))
     
     # get_structure_path
 
@@ -230,6 +235,13 @@ class Globals:
         else:
             self.jsons[path].strict_add(json)
 
+    def add_setup(self, setup: Setup):
+        """
+        Registers a setup instruction (e.g. a scoreboard objective) to emit into the load function, see load.load
+        """
+        if setup not in self.setups:
+            self.setups.append(setup)
+
     # TAGS
     def add_to_function_tag(self, name: Optional[str], function_names: List[str]):
         self.strict_add_json('tags/function', name, FunctionJSON(function_names), base=FunctionJSON)
@@ -0,0 +1,186 @@
+from typing import Dict, List, Set
+import re
+
+from .debug_utils import print_debug
+from .globals import GLOBALS, RefFlags
+from .serialize import Choice, FunctionToken, MacroFunctionToken, Program, RawToken, TokenBase, TokensContainer, \
+                       TokensRef, serialize_function_name
+from .commands import _ExecuteContainer
+
+INLINE_MAX_SIZE = 3  # callees with at most this many commands are inlined at every call site
+
+# commands that behave differently once moved out of their function
+UNINLINABLE_REGEX = re.compile(r'^\$|^return\b|\brun return\b')
+STORE_REGEX = re.compile(r'\bstore\b')
+
+
+def _containers(program: Program) -> List[TokensContainer]:
+    return [container for cmd in program if cmd is not None
+            for container in (cmd.resolve() if isinstance(cmd, TokensRef) else [cmd])]
+
+def _copy_container(container: TokensContainer) -> TokensContainer:
+    if isinstance(container, _ExecuteContainer):
+        return _ExecuteContainer(list(container._tokens), list(container._block_tokens))
+    return TokensContainer(*container.tokens)
+
+def _container_tokens(container: TokensContainer):
+    for token in container:
+        if isinstance(token, Choice):
+            for choice in token.choices:
+                yield from choice
+        else:
+            yield token
+
+def _callees(container: TokensContainer) -> List[str]:
+    return [GLOBALS.get_function_path(token.namespace, token.path) for token in _container_tokens(container)
+            if isinstance(token, FunctionToken)]
+
+def _plain_call(container: TokensContainer) -> str | None:
+    """
+    Callee of a bare `function <callee>` command, which runs in the caller's context
+    """
+    if isinstance(container, _ExecuteContainer) or len(container.tokens) != 1:
+        return None
+    token, = container.tokens
+    if isinstance(token, FunctionToken):
+        return GLOBALS.get_function_path(token.namespace, token.path)
+    return None
+
+def _execute_call(container: TokensContainer) -> str | None:
+    """
+    Callee of an `execute ... run function <callee>` command that doesn't store the function's result
+    """
+    if not isinstance(container, _ExecuteContainer):
+        return None
+    fun_token = container.get_fun_token()
+    if fun_token is None or STORE_REGEX.search(' '.join(str(token) for token in container._tokens
+                                                        if not isinstance(token, Choice))):
+        return None
+    return GLOBALS.get_function_path(fun_token.namespace, fun_token.path)
+
+
+class _Body:
+    def __init__(self, containers: List[TokensContainer]):
+        rendered = [str(container).strip() for container in containers]
+        self.containers = [container for container, s in zip(containers, rendered) if s]
+        self.commands = sum(s.count('\n') + 1 for s in rendered if s and not s.startswith('#'))
+        self.inlinable = not any(
+            UNINLINABLE_REGEX.search(line) for s in rendered for line in s.split('\n')
+        ) and not any(isinstance(token, MacroFunctionToken) for container in containers for token in container)
+
+    @property
+    def single_command(self) -> List[TokenBase] | None:
+        """
+        Tokens of the body's only command, if it has exactly one
+        """
+        if self.commands != 1 or len(self.containers) != 1:
+            return None
+        container, = self.containers
+        if any(isinstance(token, Choice) for token in container):
+            return None
+        return list(container.tokens)
+
+
+def inline_functions(programs: Dict[str, Program] | None = None, max_size: int = INLINE_MAX_SIZE) -> Set[str]:
+    """
+    Inlines the used functions called from a single site, or with at most max_size commands, into their callers
+    Bodies are only spliced into bare `function` commands, which keep the caller's @s and position;
+    `execute ... run function` calls only get single-command bodies, as every spliced line would re-evaluate
+    the execute's selectors and conditions
+    Recursive functions, macro functions and functions using `return` are never inlined
+    Returns the paths of the functions that no longer need their own file (they are marked unused)
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    used = {path: program for path, program in programs.items() if program.used}
+
+    calls = {path: [callee for container in _containers(program) for callee in _callees(container)]
+             for path, program in used.items()}
+    sites: Dict[str, int] = {}
+    for callees in calls.values():
+        for callee in callees:
+            sites[callee] = sites.get(callee, 0) + 1
+
+    # callees before callers, so inlined bodies are already final
+    order: List[str] = []
+    recursive: Set[str] = set()
+    state: Dict[str, int] = {}  # 1 while visiting, 2 when done
+    for root in used:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(calls[root]))]
+        while stack:
+            path, it = stack[-1]
+            callee = next(it, None)
+            if callee is None:
+                stack.pop()
+                state[path] = 2
+                order.append(path)
+            elif callee in used:
+                if state.get(callee) == 1:
+                    recursive |= {p for p, _ in stack[[p for p, _ in stack].index(callee):]}
+                elif callee not in state:
+                    state[callee] = 1
+                    stack.append((callee, iter(calls[callee])))
+
+    bodies: Dict[str, _Body] = {}
+    inlined: Set[str] = set()
+
+    def inlinable(callee: str) -> _Body | None:
+        if callee not in used or callee in recursive:
+            return None
+        body = bodies[callee]
+        if body.inlinable and (sites[callee] == 1 or body.commands <= max_size):
+            return body
+        return None
+
+    for path in order:
+        program = used[path]
+        containers = _containers(program)
+        new_containers: List[TokensContainer] = []
+        changed = False
+        for container in containers:
+            if (callee := _plain_call(container)) is not None and (body := inlinable(callee)) is not None:
+                new_containers += [_copy_container(callee_container) for callee_container in body.containers]
+            elif (callee := _execute_call(container)) is not None and (body := inlinable(callee)) is not None \
+                    and (tokens := body.single_command) is not None:
+                new_containers.append(_ExecuteContainer(list(container._tokens), [container._block_tokens[0], *tokens]))
+            else:
+                new_containers.append(container)
+                continue
+            print_debug(f'inlined {callee} into {path}')
+            changed = True
+            inlined.add(callee)
+            caller_ref = ('function', path)
+            for callee_callee, ref_type in GLOBALS.ref_graph.get(('function', callee), {}).items():
+                GLOBALS.ref_call(caller_ref, callee_callee, ref_type)
+        if changed:
+            program.cmds = new_containers
+        bodies[path] = _Body(new_containers if changed else containers)
+
+    # drop the files of inlined functions nothing references anymore
+    raw_text = '\n'.join(str(token) for program in used.values() for container in _containers(program)
+                         for token in _container_tokens(container) if isinstance(token, RawToken))
+
+    def externally_referenced(path: str) -> bool:
+        for caller, ref_type in GLOBALS.backwards_ref_graph.get(('function', path), {}).items():
+            if caller[0] != 'function' or caller[1] not in used or ref_type & RefFlags.MACRO:
+                return True
+        _, namespace, _, *fun_path = path.split('/')
+        return serialize_function_name(namespace, fun_path) in raw_text
+
+    candidates = {path for path in inlined if not externally_referenced(path)}
+    removed: Set[str] = set()
+    changed = True
+    while changed:
+        changed = False
+        referenced = {callee for path, program in used.items() if path not in removed
+                      for container in _containers(program) for callee in _callees(container)}
+        for path in candidates - removed - referenced:
+            removed.add(path)
+            used[path].used = False
+            changed = True
+    for path in removed:
+        print_debug(f'removed inlined function {path}')
+    return removed
@@ -28,6 +28,15 @@ class JSON:
             return self.obj[name]
         except KeyError:
             raise AttributeError
+
+    # pickling sets the slots directly, as __setattr__/__getattr__ go through obj
+    def __getstate__(self):
+        return self.obj, self.template
+
+    def __setstate__(self, state):
+        obj, template = state
+        super().__setattr__('obj', obj)
+        super().__setattr__('template', template)
         
     def __repr__(self) -> str:
         return 'JSON(' + ', '.join(f'{key}={repr(val)}' for key, val in self.obj.items()) +')'
@@ -1,7 +1,7 @@
 from langcraft import *
 from typing import Callable
 
-__all__ = ('line',)
+__all__ = ('line', 'sliced_line')
 
 @metafun()
 def line(each_block: Callable, continue_condition, max_len: int, final_block: Callable = lambda: None, step_dist = 1.):
@@ -16,3 +16,15 @@ def line(each_block: Callable, continue_condition, max_len: int, final_block: Ca
     
     Statement(f'scoreboard players set @s i {max_len}')
     f()
+
+
+@metafun()
+def sliced_line(each_block: Callable, continue_condition, max_len: int, per_tick: int, final_block: Callable = lambda: None, step_dist = 1.):
+    """
+    line spread over as many ticks as it takes to run each_block at most per_tick times per tick
+    each_block and final_block run as a marker, and final_block also runs when max_len is reached
+    """
+    with Fun() as final:
+        final_block()
+    with TimeSliced(per_tick, iterations=max_len, while_=continue_condition, step=Pos.angular(forward=step_dist), on_stop=final):
+        each_block()
@@ -0,0 +1,98 @@
+import re
+from typing import Dict, Iterator, List, Set, Tuple
+
+from .dedup import function_name
+from .globals import GLOBALS, Ref, RefFlags
+from .inline import _container_tokens, _containers
+from .serialize import DebugToken, JoinToken, Program, RawToken, SelectorToken, StrToken
+from .serialize_types import _SelectorBase
+from .nbt_cache import CachedSelectorToken
+
+TICK_HOOK = '#minecraft:tick'
+# tokens whose text can hold selectors written out by hand, e.g. Statement('execute as @e[nbt=...] run ...')
+RAW_TOKENS = (RawToken, DebugToken, JoinToken, StrToken)
+RAW_SELECTOR_REGEX = re.compile(r'@e\[')
+ARG_NAME_REGEX = re.compile(r'\s*(\w+)\s*=')
+
+
+def reachable_functions(hook: str = TICK_HOOK, programs: Dict[str, Program] | None = None,
+                        ref_graph: Dict[Ref, Dict[Ref, RefFlags]] | None = None) -> List[str]:
+    """
+    Used functions run (directly or through other functions) by hook
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    if ref_graph is None:
+        ref_graph = GLOBALS.ref_graph
+    reached: Set[str] = set()
+    order: List[str] = []
+    stack: List[Ref] = [('$extern', hook)]
+    while stack:
+        for callee in ref_graph.get(stack.pop(), {}):
+            if callee[0] != 'function' or callee[1] in reached or not (callee[1] in programs and programs[callee[1]].used):
+                continue
+            reached.add(callee[1])
+            order.append(callee[1])
+            stack.append(callee)
+    return order
+
+def raw_selectors(text: str) -> Iterator[Tuple[str, Set[str]]]:
+    """
+    @e[...] selectors written in command text, with the names of their arguments
+    """
+    for match in RAW_SELECTOR_REGEX.finditer(text):
+        args: Set[str] = set()
+        depth = 0
+        quote = None
+        i = match.end() - 1
+        while i < len(text):
+            c = text[i]
+            if quote:
+                if c == '\\':
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif c in '"\'':
+                quote = c
+            elif c in '[{':
+                depth += 1
+            elif c in ']}':
+                depth -= 1
+                if depth == 0:
+                    break
+            if depth == 1 and c in '[,' and not quote and (arg := ARG_NAME_REGEX.match(text, i + 1)):
+                args.add(arg.group(1))
+            i += 1
+        yield text[match.start():i + 1], args
+
+def lint_selectors(programs: Dict[str, Program] | None = None, hook: str = TICK_HOOK) -> List[str]:
+    """
+    Warnings for @e[nbt=...] selectors (including ones written out in command text) in functions run every tick:
+    nbt filters serialize every candidate entity, so narrow the selector with type/tag/scores/distance, track the
+    state in a tag or score instead, or cache the match with Entities(cache_nbt=True) if the nbt doesn't change
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    # the nbt caches' own checks only run on entities that weren't checked yet
+    refresh_tags = {f'!{cache.seen_tag}' for cache in GLOBALS.nbt_caches.values()}
+    warnings = []
+    for path in reachable_functions(hook, programs):
+        seen = set()
+        for container in _containers(programs[path]):
+            for token in _container_tokens(container):
+                if isinstance(token, _SelectorBase):
+                    token = token.token
+                if isinstance(token, SelectorToken):
+                    scans = [(str(token), set(token.kwargs))] \
+                        if not isinstance(token, CachedSelectorToken) and token.s == 'e' and 'nbt' in token.kwargs \
+                           and token.kwargs.get('tag') not in refresh_tags else []
+                elif isinstance(token, RAW_TOKENS):
+                    scans = [(selector, args) for selector, args in raw_selectors(str(token)) if 'nbt' in args]
+                else:
+                    scans = []
+                for selector, args in scans:
+                    if selector not in seen:
+                        seen.add(selector)
+                        narrowed = '' if 'type' in args or 'tag' in args else ' without a type or tag'
+                        warnings.append(f'{hook} runs {function_name(path)}, which scans {selector}{narrowed}')
+    return warnings
@@ -1,8 +1,7 @@
 from typing import List
 
-from .commands import RawCommand
-from .base import Namespace, OnLoadFun, Debug
-from .globals import Setup, ScoreSetup
+from .base import Namespace, OnLoadFun, Debug, Statement
+from .globals import Setup
 from .debug_utils import print_warn
 
 def legacy_init(namespace=None):
@@ -15,12 +14,16 @@ def legacy_init(namespace=None):
             Debug(f'langcraft datapack ON', include_selector=False)
 
 def load(setups: List[Setup]):
-    with OnLoadFun():
-        for setup in setups:
-            if isinstance(setup, ScoreSetup):
-                RawCommand
-            else:
-                print_warn(f'UNKOWN SETUP INSTRUCTION {setup}')
-        Debug(f'load complete', include_selector=False)
-    
-
+    """
+    Emits setup instructions into _internal:load, which runs on #minecraft:load
+    """
+    with Namespace('_internal', []):
+        with OnLoadFun('load'):
+            for setup in setups:
+                match setup:
+                    case ('score', objective, criterion):
+                        Statement(f'scoreboard objectives add {objective} {criterion}')
+                    case ('schedule', function_name, ticks):
+                        Statement(f'schedule function {function_name} {ticks}t replace')
+                    case _:
+                        print_warn(f'UNKOWN SETUP INSTRUCTION {setup}')
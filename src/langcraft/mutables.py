@@ -13,6 +13,7 @@ from .serialize_types import _SelectorType, _Relation, Dimension, _SelectorBase,
 from .commands import RawExecute, ExecuteSub, Teleport, Kill
 from .minecraft_builtins import EntityType
 from .dimension import _Dimension
+from .nbt_cache import CachedSelectorToken, get_nbt_cache
 
 class _RelativeFromEntity(_Relative):
     def __init__(self, entity):
@@ -38,8 +39,15 @@ class Entities(_SelectorBase):
                  sort: Literal['nearest', 'furthest', 'random', 'arbitrary'] | None = None,
                  level: _SliceType | None = None,
                  gamemode: Literal['spectator', 'survival', 'creative', 'adventure'] | None = None,
-                 advancements: Dict[ResourceLocation, bool | Dict[str, bool]] | None = None
+                 advancements: Dict[ResourceLocation, bool | Dict[str, bool]] | None = None,
+                 cache_nbt: bool = False,
+                 revalidate: int | None = None
                  ):
+        """
+        cache_nbt: check each entity's nbt once and remember matches in a tag shared by the namespace's functions
+                   (for nbt that doesn't change, e.g. an arrow's item), see nbt_cache.NbtCache
+        revalidate: with cache_nbt, recheck every entity's nbt every revalidate ticks
+        """
         scores = None if scores is None else ('{' + ','.join(f'{k}={v}' for k, v in scores.items()) + '}' if isinstance(scores, dict) else scores)
         if selected_item:
             assert nbt is None, "Cannot define Entities object with both kwargs selected_item and nbt (instead put selected_item in JSON of nbt)"
@@ -61,6 +69,10 @@ class Entities(_SelectorBase):
                          level=level,
                          gamemode=gamemode,
                          advancements=advancements)
+        if cache_nbt:
+            assert 'nbt' in self.token.kwargs, "Cannot cache the nbt of an Entities object without nbt or selected_item"
+            cache = get_nbt_cache(self.token.kwargs.get('type'), self.token.kwargs['nbt'], revalidate)
+            self.token = CachedSelectorToken(self.token.s, cache, **self.token.kwargs)
         self.as_selector: Literal['self'] | _SelectorBase | None = 'self'
         self.at_target: _SelectorBase | Pos | Rot | None = _SelectorBase()
         self.positioned = self.rotated = self.dimension = None
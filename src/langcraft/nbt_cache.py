@@ -0,0 +1,124 @@
+from hashlib import sha256
+from typing import Dict, List
+
+from .debug_utils import print_debug
+from .globals import GLOBALS
+from .inline import _container_tokens
+from .json_utils import JSON
+from .serialize import CommandKeywordToken, CommandNameToken, FunctionToken, MiscToken, Program, SelectorToken, \
+                       TokensContainer, TokensRef, serialize_function_name
+from .serialize_types import _SelectorBase
+
+
+class NbtCache:
+    """
+    Entities of a type matching an nbt filter, remembered in entity tags shared by every function of a namespace:
+    each entity's nbt is checked once (the first time a function using the cache runs after it spawned),
+    then the cached selectors only filter on tag=<match_tag>
+    With revalidate, the tags are cleared every revalidate ticks so entities whose nbt changed get checked again
+    """
+    __slots__ = ('namespace', 'type', 'nbt', 'match_tag', 'seen_tag', 'revalidate')
+
+    def __init__(self, namespace: str, type: str | None, nbt: JSON | str, revalidate: int | None = None):
+        self.namespace = namespace
+        self.type = type
+        self.nbt = nbt
+        digest = sha256(f'{namespace}|{type}|{nbt}'.encode()).hexdigest()[:8]
+        self.match_tag = f'{namespace}.nbt_{digest}'
+        self.seen_tag = f'{self.match_tag}.seen'
+        self.revalidate = revalidate
+
+    def selector(self, **kwargs) -> SelectorToken:
+        return SelectorToken('e', **({'type': self.type} if self.type else {}), **kwargs)
+
+    def refresh(self) -> List[TokensContainer]:
+        """
+        Tags the entities that weren't checked yet
+        """
+        return [
+            TokensContainer(CommandNameToken('tag'), self.selector(tag=f'!{self.seen_tag}', nbt=self.nbt),
+                            CommandKeywordToken('add'), MiscToken(self.match_tag)),
+            TokensContainer(CommandNameToken('tag'), self.selector(tag=f'!{self.seen_tag}'),
+                            CommandKeywordToken('add'), MiscToken(self.seen_tag)),
+        ]
+
+    @property
+    def revalidate_path(self) -> List[str]:
+        return ['_nbt_cache', self.match_tag.rsplit('_', 1)[1]]
+
+
+def get_nbt_cache(type: str | None, nbt: JSON | str, revalidate: int | None = None) -> NbtCache:
+    """
+    The current namespace's cache for (type, nbt), revalidating at the shortest interval any selector asked for
+    """
+    cache = NbtCache(GLOBALS.namespace, type, nbt, revalidate)
+    cache = GLOBALS.nbt_caches.setdefault(cache.match_tag, cache)
+    if revalidate is not None and (cache.revalidate is None or revalidate < cache.revalidate):
+        cache.revalidate = revalidate
+    return cache
+
+
+class CachedSelectorToken(SelectorToken):
+    """
+    Selector whose nbt filter is replaced with its NbtCache's tag
+    """
+    __slots__ = ('cache',)
+
+    def __init__(self, s: str, cache: NbtCache, **kwargs):
+        super().__init__(s, **kwargs)
+        self.cache = cache
+
+    def __str__(self):
+        kwargs = [(key, val) for key, val in self.kwargs.items() if key != 'nbt']
+        i = next((i for i, (key, _) in enumerate(kwargs) if key not in ('type', 'tag')), len(kwargs))
+        kwargs.insert(i, ('tag', self.cache.match_tag))
+        return self.selector_str(kwargs)
+
+
+def _cached_selectors(container: TokensContainer) -> List[NbtCache]:
+    caches = []
+    for token in _container_tokens(container):
+        if isinstance(token, _SelectorBase):
+            token = token.token
+        if isinstance(token, CachedSelectorToken) and token.cache not in caches:
+            caches.append(token.cache)
+    return caches
+
+def prepare_nbt_caches(programs: Dict[str, Program] | None = None):
+    """
+    Refreshes the caches before every command using them, and adds the functions revalidating them
+    (started on load, then rescheduling themselves)
+    """
+    if programs is None:
+        programs = GLOBALS.programs
+    for path, program in list(programs.items()):
+        cmds = []
+        changed = False
+        for cmd in program:
+            if cmd is not None:
+                for container in (cmd.resolve() if isinstance(cmd, TokensRef) else [cmd]):
+                    for cache in _cached_selectors(container):
+                        refresh = cache.refresh()
+                        # already refreshed by an earlier build
+                        if [str(cmd_) for cmd_ in cmds[-len(refresh):]] != [str(cmd_) for cmd_ in refresh]:
+                            cmds += refresh
+                            changed = True
+            cmds.append(cmd)
+        if changed:
+            print_debug(f'refreshing nbt caches in {path}')
+            program.cmds = cmds
+
+    for cache in GLOBALS.nbt_caches.values():
+        path = GLOBALS.get_function_path(cache.namespace, cache.revalidate_path)
+        if cache.revalidate is None or path in programs:
+            continue
+        programs[path] = Program(
+            TokensContainer(CommandNameToken('tag'), SelectorToken('e', tag=cache.seen_tag),
+                            CommandKeywordToken('remove'), MiscToken(cache.seen_tag)),
+            TokensContainer(CommandNameToken('tag'), SelectorToken('e', tag=cache.match_tag),
+                            CommandKeywordToken('remove'), MiscToken(cache.match_tag)),
+            TokensContainer(CommandNameToken('schedule'), FunctionToken(cache.namespace, cache.revalidate_path),
+                            MiscToken(f'{cache.revalidate}t'), CommandKeywordToken('replace')),
+        )
+        GLOBALS.ref_call(('$extern', 'schedule'), ('function', path))
+        GLOBALS.add_setup(('schedule', serialize_function_name(cache.namespace, cache.revalidate_path), cache.revalidate))
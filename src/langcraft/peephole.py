@@ -0,0 +1,242 @@
+from abc import ABC, abstractmethod
+from typing import List, Sequence, Tuple
+import re
+
+from .base import Pass
+from .commands import _ExecuteContainer
+from .debug_utils import print_debug, print_warn
+from .serialize import Choice, CommandKeywordToken, CommandNameToken, CommandSepToken, IntToken, MiscToken, \
+                       RawToken, ResetFlagToken, TokensContainer, TokensRef
+
+type Cmd = TokensContainer | TokensRef
+
+MAX_SCORE = 2**31 - 1
+SCORE_ADD_REGEX = re.compile(r'^scoreboard players (add|remove) (\S+) (\S+) (\d+)$')
+# score holders that are the same entity every time they're resolved
+FIXED_HOLDER_REGEX = re.compile(r'^(@s|[^@\s]+)$')
+
+
+def single_container(cmd: Cmd) -> TokensContainer | None:
+    if isinstance(cmd, TokensContainer):
+        return cmd
+    containers = cmd.resolve()
+    if len(containers) == 1:
+        return containers[0]
+    return None
+
+def _simple_text(cmd: Cmd) -> str | None:
+    """
+    The command cmd renders to, if it's a single command without Choices
+    """
+    container = single_container(cmd)
+    if container is None or any(isinstance(token, Choice | CommandSepToken) for token in container):
+        return None
+    return str(container)
+
+
+class PeepholeRule(ABC):
+    """
+    Rewrites `width` adjacent commands of a function: apply returns their replacement, or None to keep them
+    Replacements must make the function strictly simpler, or optimization won't reach a fixpoint
+    """
+    width = 1
+
+    @abstractmethod
+    def apply(self, cmds: Sequence[Cmd]) -> List[Cmd] | None:
+        pass
+
+
+class JoinRule(PeepholeRule):
+    """
+    Statement-defined joins: cmd0.join_with_cmd(cmd1) or cmd1.right_join_with_cmd(cmd0), e.g. Teleport
+    """
+    width = 2
+
+    def apply(self, cmds):
+        cmd0, cmd1 = cmds
+        try:
+            if hasattr(cmd0, 'join_with_cmd'):
+                cmd01 = cmd0.join_with_cmd(cmd1)
+            elif hasattr(cmd1, 'right_join_with_cmd'):
+                cmd01 = cmd1.right_join_with_cmd(cmd0)
+            else:
+                return None
+        except TypeError as e:
+            print_warn(f'invalid types for optim: {e}')
+            return None
+        if cmd01:
+            return [cmd01]
+        return None
+
+
+class RemoveNoOpRule(PeepholeRule):
+    """
+    Drops Pass and other commands without any tokens
+    """
+    def apply(self, cmds):
+        cmd, = cmds
+        if isinstance(cmd, Pass):
+            return []
+        containers = [cmd] if isinstance(cmd, TokensContainer) else cmd.resolve()
+        if all(not container.tokens or (len(container.tokens) == 1 and isinstance(container.tokens[0], RawToken)
+                                        and not str(container.tokens[0]).strip())
+               for container in containers):
+            return []
+        return None
+
+
+class MergeExecuteRule(PeepholeRule):
+    """
+    execute <subs> run execute <subs1> ... -> execute <subs> <subs1> ...
+    """
+    def apply(self, cmds):
+        container = single_container(cmds[0])
+        if not isinstance(container, _ExecuteContainer) or len(container._block_tokens) < 2 or \
+                any(isinstance(token, CommandSepToken) for token in container._block_tokens):
+            return None
+        run, inner, *rest = container._block_tokens
+        if not (isinstance(run, CommandKeywordToken) and str(run) == 'run'):
+            return None
+        if isinstance(inner, CommandNameToken) and str(inner) == 'execute':
+            inner_tokens = rest
+        elif isinstance(inner, RawToken) and not rest and str(inner).startswith('execute '):
+            inner_tokens = [RawToken(str(inner)[len('execute '):])]
+        else:
+            return None
+        # keep the final `run ...` as the block, so later passes still see what the command runs
+        runs = [i for i, token in enumerate(inner_tokens) if isinstance(token, CommandKeywordToken) and str(token) == 'run']
+        split = runs[-1] if runs else len(inner_tokens)
+        return [_ExecuteContainer([*container._tokens, *inner_tokens[:split]], inner_tokens[split:])]
+
+
+class FoldScoreAddRule(PeepholeRule):
+    """
+    scoreboard players add|remove <holder> <objective> a, then b on the same holder -> one add|remove of the total
+    Only for holders that resolve to the same entity both times (fake players, names, @s)
+    A zero total still adds 0, which sets a missing score like the original commands did
+    """
+    width = 2
+
+    def apply(self, cmds):
+        texts = [_simple_text(cmd) for cmd in cmds]
+        if None in texts:
+            return None
+        match0, match1 = (SCORE_ADD_REGEX.match(text) for text in texts)
+        if not (match0 and match1 and match0.group(2, 3) == match1.group(2, 3) and FIXED_HOLDER_REGEX.match(match0.group(2))):
+            return None
+        total = sum(int(match.group(4)) * (1 if match.group(1) == 'add' else -1) for match in (match0, match1))
+        if abs(total) > MAX_SCORE:
+            return None
+        return [TokensContainer(CommandNameToken('scoreboard'), CommandKeywordToken('players'),
+                                CommandKeywordToken('add' if total >= 0 else 'remove'),
+                                MiscToken(match0.group(2)), MiscToken(match0.group(3)), IntToken(abs(total)))]
+
+
+class DedupFlagResetRule(PeepholeRule):
+    """
+    Resetting the same flag twice in a row
+    """
+    width = 2
+
+    def apply(self, cmds):
+        containers = [single_container(cmd) for cmd in cmds]
+        if all(container is not None and len(container.tokens) == 1 and isinstance(container.tokens[0], ResetFlagToken)
+               for container in containers) and containers[0].tokens[0].flag.name == containers[1].tokens[0].flag.name:
+            return [cmds[0]]
+        return None
+
+
+PEEPHOLE_RULES: List[PeepholeRule] = [JoinRule(), RemoveNoOpRule(), MergeExecuteRule(), FoldScoreAddRule(),
+                                      DedupFlagResetRule()]
+
+
+class _Node:
+    __slots__ = ('cmd', 'origin', 'prev', 'next')
+
+    def __init__(self, cmd: Cmd, origin: Tuple[TokensRef, int] | None = None):
+        self.cmd = cmd
+        self.origin = origin  # (multi-command statement, index) the command was split from
+        self.prev: '_Node | None' = None
+        self.next: '_Node | None' = None
+
+
+def peephole(cmds: List[Cmd | None], rules: List[PeepholeRule] | None = None) -> List[Cmd]:
+    """
+    Applies rules to every window of adjacent commands until none of them matches anymore
+    Commands are kept in a linked list, so each rewrite only costs its window; after a rewrite, the windows
+    overlapping the replacement are retried
+    Multi-command statements are split into their commands first, so rules can see across them; statements none of
+    whose commands were rewritten are put back together, other statements stay split into their (rewritten) commands
+    """
+    if rules is None:
+        rules = PEEPHOLE_RULES
+    head = _Node(None)  # sentinel
+    tail = head
+    for cmd in cmds:
+        if cmd is None:
+            continue
+        if isinstance(cmd, TokensContainer) or len(cmd.resolve()) <= 1:
+            split = [(cmd, None)]
+        else:
+            split = [(container, (cmd, i)) for i, container in enumerate(cmd.resolve())]
+        for cmd_, origin in split:
+            node = _Node(cmd_, origin)
+            node.prev, tail.next = tail, node
+            tail = node
+
+    max_width = max((rule.width for rule in rules), default=1)
+    max_rewrites = 16 * len(cmds) + 64
+    rewrites = 0
+    node = head.next
+    while node is not None and rewrites <= max_rewrites:
+        for rule in rules:
+            window = [node]
+            while len(window) < rule.width and window[-1].next is not None:
+                window.append(window[-1].next)
+            if len(window) < rule.width:
+                continue
+            replacement = rule.apply([node_.cmd for node_ in window])
+            if replacement is None:
+                continue
+            print_debug(f'peephole {type(rule).__name__}: {" || ".join(str(node_.cmd) for node_ in window)} --> '
+                        f'{" || ".join(str(cmd) for cmd in replacement)}')
+            before, after = window[0].prev, window[-1].next
+            for cmd in replacement:
+                new_node = _Node(cmd)
+                new_node.prev, before.next = before, new_node
+                before = new_node
+            before.next = after
+            if after is not None:
+                after.prev = before
+            # retry every window that now overlaps the replacement
+            node = window[0].prev.next or window[0].prev
+            for _ in range(max_width - 1):
+                if node.prev is None or node.prev is head:
+                    break
+                node = node.prev
+            if node is head:
+                node = head.next
+            rewrites += 1
+            break
+        else:
+            node = node.next
+    if rewrites > max_rewrites:
+        print_warn(f'peephole optimization stopped after {rewrites} rewrites, check rules only simplify')
+
+    optimized = []
+    node = head.next
+    while node is not None:
+        if node.origin is not None and node.origin[1] == 0:
+            statement = node.origin[0]
+            end = node
+            for i in range(1, len(statement.resolve())):
+                end = end.next
+                if end is None or end.origin is None or end.origin[0] is not statement or end.origin[1] != i:
+                    break
+            else:
+                optimized.append(statement)
+                node = end.next
+                continue
+        optimized.append(node.cmd)
+        node = node.next
+    return optimized
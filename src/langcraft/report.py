@@ -0,0 +1,151 @@
+from time import perf_counter
+from typing import Dict, List
+import tracemalloc
+
+from .globals import DATAPACK_ROOT
+
+ACTIVE_REPORTS: List['BuildReport'] = []
+
+def enable_profiling(trace_memory=True) -> 'BuildReport':
+    """
+    Makes every following compile_all call (that isn't given its own report) record into the returned BuildReport
+    """
+    report = BuildReport(trace_memory=trace_memory)
+    ACTIVE_REPORTS.append(report)
+    return report
+
+def active_report() -> 'BuildReport | None':
+    return ACTIVE_REPORTS[-1] if ACTIVE_REPORTS else None
+
+def path_namespace(path: str) -> str:
+    """
+    $root/<namespace>/function/... -> <namespace>
+    """
+    parts = path.split('/')
+    if len(parts) > 1 and parts[0] == DATAPACK_ROOT:
+        return parts[1]
+    return '?'
+
+
+class Stats:
+    __slots__ = ('wall_time', 'calls', 'peak_memory')
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.calls = 0
+        self.peak_memory = 0
+
+    def to_dict(self) -> dict:
+        return {'wall_time': self.wall_time, 'calls': self.calls, 'peak_memory': self.peak_memory}
+
+
+class _Measure:
+    def __init__(self, report: 'BuildReport', stats: Stats):
+        self.report = report
+        self.stats = stats
+
+    def __enter__(self):
+        self.report._push()
+        self.start = perf_counter()
+        return self.stats
+
+    def __exit__(self, *args):
+        self.stats.wall_time += perf_counter() - self.start
+        self.stats.calls += 1
+        self.stats.peak_memory = max(self.stats.peak_memory, self.report._pop())
+
+
+class BuildReport:
+    """
+    Wall time, call counts and tracemalloc peak (bytes above the allocations alive when the measurement started)
+    recorded per compile_all phase and per namespace within each phase
+    Peaks are only measured with trace_memory; without it the report leaves tracemalloc alone, so code tracing around
+    the build still sees its own peak
+
+    Example usage:
+    report = BuildReport()
+    compile_all(report=report)
+    print(report)
+    report.to_dict()
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.builds = 0
+        self.phases: Dict[str, Stats] = {}
+        self.namespaces: Dict[str, Dict[str, Stats]] = {}
+        self.cache_stats: Dict[str, int] = {}
+        self.warnings: List[str] = []  # see lint.lint_selectors
+        # highest traced memory (bytes) seen while measuring; measuring resets tracemalloc's peak, so read this (or
+        # the larger of it and tracemalloc's peak) instead
+        self.traced_peak = 0
+        # (traced memory at start, peak of the enclosing measurement so far) for every open measurement
+        self._stack: List[List[int]] = []
+        self._started_tracing = False
+
+    def start(self):
+        self.builds += 1
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def phase(self, name: str) -> _Measure:
+        return _Measure(self, self.phases.setdefault(name, Stats()))
+
+    def namespace(self, phase: str, namespace: str) -> _Measure:
+        return _Measure(self, self.namespaces.setdefault(phase, {}).setdefault(namespace, Stats()))
+
+    def _push(self):
+        if not (self.trace_memory and tracemalloc.is_tracing()):
+            # measuring would reset the peak of whoever else is tracing
+            self._stack.append([0, 0])
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak reached so far is lost by the reset, fold it into the enclosing measurement and traced_peak
+        self.traced_peak = max(self.traced_peak, peak)
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._stack.append([current, current])
+
+    def _pop(self) -> int:
+        start, peak = self._stack.pop()
+        if not (self.trace_memory and tracemalloc.is_tracing()):
+            return 0
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        self.traced_peak = max(self.traced_peak, peak)
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        return peak - start
+
+    def to_dict(self) -> dict:
+        return {
+            'builds': self.builds,
+            'phases': {name: stats.to_dict() for name, stats in self.phases.items()},
+            'namespaces': {phase: {namespace: stats.to_dict() for namespace, stats in namespaces.items()}
+                           for phase, namespaces in self.namespaces.items()},
+            'traced_peak': self.traced_peak,
+            'cache': dict(self.cache_stats),
+            'warnings': list(self.warnings),
+        }
+
+    def __str__(self):
+        lines = [f'build report ({self.builds} build{"s" if self.builds != 1 else ""})',
+                 f'{"phase":<32}{"time (ms)":>12}{"calls":>10}{"peak (KiB)":>12}']
+
+        def add_line(name: str, stats: Stats):
+            lines.append(f'{name:<32}{stats.wall_time * 1000:>12.2f}{stats.calls:>10}{stats.peak_memory / 1024:>12.1f}')
+
+        for name, stats in self.phases.items():
+            add_line(name, stats)
+            for namespace, namespace_stats in sorted(self.namespaces.get(name, {}).items(),
+                                                     key=lambda item: -item[1].wall_time):
+                add_line(f'  {namespace}', namespace_stats)
+        if self.cache_stats:
+            lines.append('cache: ' + ', '.join(f'{key} {val}' for key, val in self.cache_stats.items()))
+        lines += [f'warning: {warning}' for warning in self.warnings]
+        return '\n'.join(lines)
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Literal, Self, List, Dict
+from typing import Callable, Literal, NamedTuple, Self, List, Dict, Tuple
 from uuid import uuid4
 from itertools import product
+from math import prod
+from weakref import WeakValueDictionary
+import json
 
 from termcolor import colored
 
@@ -39,6 +42,7 @@ class _Colors:
 
 
 class TokenBase(ABC):
+    __slots__ = ()
     COLOR = _Colors.DEFAULT
     debug_info = None
 
@@ -76,7 +80,50 @@ class Serializable(TokenBase, ABC):
         return colored(self.__str__(), _Colors.SERIALIZABLE.get(self.__class__.__name__, _Colors.SERIALIZABLE_DEFAULT))
 
 
+# live instances of interned token classes by (class, typed constructor args)
+_INTERNED_TOKENS: WeakValueDictionary = WeakValueDictionary()
+_INTERNED_CLASSES = set()
+
+class _Interned:
+    """
+    Flyweight for immutable tokens: constructing an interned class (see interned) with the same positional arguments
+    as a live instance returns that instance, so the thousands of identical `execute`/`if`/`run`/... tokens of a
+    build share one object
+    Subclasses aren't interned unless registered themselves, as they may add mutable state
+    """
+    __slots__ = ('__weakref__',)
+
+    def __new__(cls, *args, **kwargs):
+        # no args: unpickling, the state is set afterwards
+        if kwargs or not args or cls not in _INTERNED_CLASSES:
+            return super().__new__(cls)
+        if len(args) == 1 and type(args[0]) is str:
+            key = (cls, args[0])
+        else:
+            # include types so e.g. IntToken(1) and IntToken(True) stay distinct
+            key = (cls, *((type(arg), arg) for arg in args))
+        try:
+            return _INTERNED_TOKENS[key]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable args
+            return super().__new__(cls)
+        token = super().__new__(cls)
+        _INTERNED_TOKENS[key] = token
+        return token
+
+def interned(cls: type) -> type:
+    """
+    Class decorator registering an immutable token class for interning, see _Interned
+    """
+    assert issubclass(cls, _Interned)
+    _INTERNED_CLASSES.add(cls)
+    return cls
+
+
 class RawToken(TokenBase):
+    __slots__ = ('s',)
+
     def __init__(self, s: str):
         self.s = s
 
@@ -89,6 +136,7 @@ class RawToken(TokenBase):
 
 
 class DebugToken(TokenBase):
+    __slots__ = ('s', 'debug_info')
     COLOR = 'dark_grey'
 
     def __init__(self, s: str, debug_info=None):
@@ -100,6 +148,8 @@ class DebugToken(TokenBase):
 
 
 class JoinToken(TokenBase):
+    __slots__ = ('tokens',)
+
     def __init__(self, *tokens: TokenBase | str):
         self.tokens = [token if isinstance(token, TokenBase) else RawToken(token) for token in tokens]
 
@@ -110,7 +160,9 @@ class JoinToken(TokenBase):
         return ''.join(t.color_str() for t in self.tokens)
 
 
-class StrToken(TokenBase):
+@interned
+class StrToken(_Interned, TokenBase):
+    __slots__ = ('s',)
     COLOR = _Colors.STR
 
     def __init__(self, s: str):
@@ -119,7 +171,9 @@ class StrToken(TokenBase):
     def __str__(self):
         return self.s
 
-class IntToken(TokenBase):
+@interned
+class IntToken(_Interned, TokenBase):
+    __slots__ = ('i',)
     COLOR = _Colors.MISC_LITERAL
 
     def __init__(self, i: int):
@@ -128,7 +182,9 @@ class IntToken(TokenBase):
     def __str__(self):
         return str(self.i)
 
-class FloatToken(TokenBase):
+@interned
+class FloatToken(_Interned, TokenBase):
+    __slots__ = ('f',)
     COLOR = _Colors.MISC_LITERAL
 
     def __init__(self, f: float):
@@ -137,7 +193,9 @@ class FloatToken(TokenBase):
     def __str__(self):
         return str(round(self.f, 8))
 
-class BoolToken(TokenBase):
+@interned
+class BoolToken(_Interned, TokenBase):
+    __slots__ = ('b',)
     COLOR = _Colors.MISC_LITERAL
 
     def __init__(self, b: bool):
@@ -147,14 +205,18 @@ class BoolToken(TokenBase):
         return ('true' if self.b else 'false')
 
 
+@interned
 class MiscToken(StrToken):
+    __slots__ = ()
     COLOR = _Colors.MISC
 
     def __init__(self, obj):
         super().__init__(str(obj))
 
 
+@interned
 class CommandNameToken(StrToken):
+    __slots__ = ()
     COLOR = _Colors.COMMAND
 
     def color_str(self) -> str:
@@ -162,7 +224,9 @@ class CommandNameToken(StrToken):
         return colored(self.__str__(), self.COLOR, attrs=['bold'])
 
 
+@interned
 class CommandKeywordToken(StrToken):
+    __slots__ = ()
     COLOR = _Colors.SUBCOMMAND
 
 
@@ -176,6 +240,8 @@ def serialize_function_name(namespace, path, color=False):
 
 
 class FunctionToken(TokenBase):
+    __slots__ = ('namespace', 'path')
+
     def __init__(self, namespace: str, path: List[str]):
         self.namespace = namespace
         self.path = path
@@ -189,11 +255,34 @@ class FunctionToken(TokenBase):
             colored(serialize_function_name(self.namespace, self.path), _Colors.FUNCTION, attrs=["underline"])
 
 
+class MacroFunctionToken(TokenBase):
+    """
+    Macro line calling the function picked by a macro argument, e.g. `$function ns:tree/leaf_$(id)`
+    Must be the only token of its command
+    """
+    __slots__ = ('namespace', 'path', 'key')
+
+    def __init__(self, namespace: str, path: List[str], key: str):
+        self.namespace = namespace
+        self.path = path  # last element is the prefix of the called function's name
+        self.key = key
+
+    def __str__(self):
+        return f'$function {serialize_function_name(self.namespace, self.path)}$({self.key})'
+
+    def color_str(self):
+        # noinspection PyTypeChecker
+        return colored('$function', _Colors.COMMAND, attrs=["bold"]) + ' ' + \
+            colored(serialize_function_name(self.namespace, self.path) + f'$({self.key})', _Colors.FUNCTION, attrs=["underline"])
+
+
 class TokenError(Exception):
     pass
 
 
 class ParseErrorToken(TokenBase):
+    __slots__ = ('err',)
+
     def __init__(self, err: str):
         print_err(f'parse error {err}')
         self.err = err
@@ -207,6 +296,8 @@ class ParseErrorToken(TokenBase):
 
 
 class SerializeErrorToken(TokenBase):
+    __slots__ = ('err',)
+
     def __init__(self, err):
         raise err
         print_err(f'serialize error {err}')
@@ -226,6 +317,8 @@ COMMAND_SEP = '\n'
 
 
 class CommandSepToken(TokenBase):
+    __slots__ = ()
+
     def __str__(self):
         return COMMAND_SEP + REMOVE_TOKEN_SEP
 
@@ -249,6 +342,7 @@ class Choice:
         [e, f]
     ]
     """
+    __slots__ = ('choices', 'ident', 'uuid')
 
     def __init__(self, *choices: TokenBase | List[TokenBase], ident=None):
         self.choices = tuple(([choice] if isinstance(choice, TokenBase) else choice) for choice in choices)
@@ -264,6 +358,8 @@ class Choice:
 
 
 class ArgToken(TokenBase):
+    __slots__ = ('ident',)
+
     def __init__(self, ident: int):
         self.ident = ident
 
@@ -271,61 +367,118 @@ class ArgToken(TokenBase):
         return f'$TODO $arg:{self.ident}'  # TODO
 
 
+FLAG_OBJECTIVE = '_lc'
+
 class Flag:
+    __slots__ = ('name', 'resource_loc', 'slot')
+
     def __init__(self, name=None, resource_loc='_internal:flags'):
         if name is None:
             name = uuid4().hex
         self.name = name
         self.resource_loc = resource_loc
+        self.slot: int | None = None  # set when compiling with score flags, see flags.allocate_flag_slots
+
+    @property
+    def holder(self) -> str:
+        return f'#f{self.slot}'
 
     def serialize(self):
         return f'storage {self.resource_loc} {self.name}'
 
 
 class ResetFlagToken(TokenBase):
+    __slots__ = ('flag',)
     COLOR = _Colors.FLAG
 
     def __init__(self, flag: Flag):
         self.flag = flag
 
     def __str__(self):
+        if self.flag.slot is not None:
+            return f'scoreboard players reset {self.flag.holder} {FLAG_OBJECTIVE}'
         return f'data remove {self.flag.serialize()}'
 
 
 class SetFlagToken(TokenBase):
+    __slots__ = ('flag',)
     COLOR = _Colors.FLAG
 
     def __init__(self, flag: Flag):
         self.flag = flag
 
     def __str__(self):
+        if self.flag.slot is not None:
+            return f'scoreboard players set {self.flag.holder} {FLAG_OBJECTIVE} 1'
         return f'data modify {self.flag.serialize()} set value 1'
 
 
 class CheckFlagToken(TokenBase):
+    __slots__ = ('flag',)
     COLOR = _Colors.FLAG
 
     def __init__(self, flag: Flag):
         self.flag = flag
 
     def __str__(self):
+        if self.flag.slot is not None:
+            return f'score {self.flag.holder} {FLAG_OBJECTIVE} matches 1'
         return f'data {self.flag.serialize()}'
 
 
-class SelectorToken(TokenBase):
+# selector arguments in the order they're rendered: cheap filters first, nbt (which serializes every candidate) last
+# the game applies every filter regardless of order, but checks them in the order given
+SELECTOR_ARG_ORDER = {key: i for i, key in enumerate((
+    'type', 'tag', 'team', 'name', 'scores', 'level', 'gamemode', 'x', 'y', 'z', 'distance', 'dx', 'dy', 'dz',
+    'x_rotation', 'y_rotation', 'sort', 'limit', 'advancements', 'predicate', 'nbt'
+))}
+
+def selector_arg_str(val) -> str:
+    """
+    A selector argument's value: JSON as SNBT, dicts (scores, advancements) as {key=value,...} and strings with spaces
+    quoted, after their ! if negated
+    """
+    if isinstance(val, JSON):
+        return val.selector_str()
+    if isinstance(val, dict):
+        return '{' + ','.join(f'{key}={selector_arg_str(sub_val)}' for key, sub_val in val.items()) + '}'
+    if isinstance(val, bool):
+        return str(val).lower()
+    val = str(val)
+    negation = '!' if val.startswith('!') else ''
+    val = val.removeprefix('!')
+    if any(c.isspace() for c in val) and not val.startswith(('"', '{', '[')):
+        val = json.dumps(val)
+    return negation + val
+
+@interned
+class SelectorToken(_Interned, TokenBase):
+    __slots__ = ('s', 'kwargs')
+
     def __init__(self, s: str = 's', **kwargs):
         # TODO structure kwargs by https://minecraft.wiki/w/Target_selectors
         self.s = s
+        if len(kwargs) > 1:
+            # unknown arguments go before the expensive ones
+            kwargs = dict(sorted(kwargs.items(), key=lambda item: SELECTOR_ARG_ORDER.get(item[0], SELECTOR_ARG_ORDER['limit'])))
         self.kwargs = kwargs
 
     def __str__(self):
-        if self.kwargs == {}:
+        return self.selector_str(self.kwargs.items())
+
+    def selector_str(self, args) -> str:
+        """
+        The selector with these (key, value) arguments
+        """
+        args = list(args)
+        if not args:
             return f'@{self.s}'
-        else:
-            return f'@{self.s}[{",".join(f"{key}={val.selector_str() if isinstance(val, JSON) else val}" for key, val in self.kwargs.items())}]'
+        return f'@{self.s}[{",".join(f"{key}={selector_arg_str(val)}" for key, val in args)}]'
 
 
 class ResourceLocToken(TokenBase):
+    __slots__ = ('namespace', 'path')
+
     def __init__(self, namespace: str, path: List[str]):
         self.namespace = namespace
         self.path = path
@@ -334,7 +487,10 @@ class ResourceLocToken(TokenBase):
         return self.namespace + ':' + '/'.join(p for p in self.path)
 
 
-class BuiltinResourceToken(TokenBase):
+@interned
+class BuiltinResourceToken(_Interned, TokenBase):
+    __slots__ = ('s',)
+
     def __init__(self, s: str):
         self.s = s
 
@@ -343,6 +499,7 @@ class BuiltinResourceToken(TokenBase):
         return self.s
 
 class BlockToken(TokenBase):
+    __slots__ = ('block_name',)
     # TODO color
 
     def __init__(self, block_name: BlockType):
@@ -352,6 +509,7 @@ class BlockToken(TokenBase):
         return self.block_name
     
 class ItemToken(TokenBase):
+    __slots__ = ('item_name', 'data_component_removed_defaults', 'data_components')
     # TODO color
 
     def __init__(self, item_name, *data_component_removed_defaults, **data_components):  # TODO add type ItemType
@@ -367,16 +525,117 @@ class ItemToken(TokenBase):
             return self.item_name + '[' + ','.join(['!' + removed_default for removed_default in self.data_component_removed_defaults] + [key + '=' + (val.selector_str() if isinstance(val, JSON) else str(val)) for key, val in self.data_components.items()]) + ']'
 
 class JSONRefToken(ResourceLocToken):
-    pass
+    __slots__ = ()
 
 
 Token = TokenBase | Choice
 
 
+def token_serializer(debug=False, color=False, force_color=None, validate_fun=lambda namespace, path: True,
+                     validate_json=lambda namespace, path: True) -> Callable[[TokenBase], str]:
+    # TokenBase is an ABC, so isinstance checks are slow; resolve the validator once per token class instead
+    validators: Dict[type, Callable | None] = {}
+
+    def validator(cls: type) -> Callable | None:
+        if issubclass(cls, FunctionToken):
+            return validate_fun
+        if issubclass(cls, JSONRefToken):
+            return validate_json
+        return None
+
+    def token_serialize(t: TokenBase) -> str:
+        cls = t.__class__
+        try:
+            validate = validators[cls]
+        except KeyError:
+            validate = validators[cls] = validator(cls)
+        if validate is not None and not validate(t.namespace, t.path):
+            return colored(str(t), 'red', 'on_black', attrs=['blink', 'bold'])
+
+        if force_color:
+            return colored(str(t), force_color)
+        elif debug:
+            return t.debug_str()
+        elif color:
+            return t.color_str()
+        else:
+            return str(t)
+    return token_serialize
+
+
+def serialize_choices(tokens: List[Token], assignments: Dict,
+                      token_serialize: Callable[[TokenBase], str], debug=False) -> str:
+    """
+    Expands every combination of Choice tokens (grouped by ident) into its own command
+    Every token and choice is rendered once, however many combinations it appears in
+    """
+    index = {ident: i for i, ident in enumerate(assignments)}
+    parts: List[str | int] = []  # rendered tokens, or the index of the Choice group filling that spot
+    for token in tokens:
+        if isinstance(token, Choice):
+            parts.append(index[token.ident])
+        elif isinstance(token, TokenBase):
+            parts.append(token_serialize(token))
+        else:
+            raise TypeError(f"Invalid token type: {type(token)}")
+    if not assignments:
+        return TOKEN_SEP.join(parts)
+
+    rendered_choices = [[[token_serialize(token_) for token_ in choice] for choice in choices]
+                        for choices in assignments.values()]
+    prefix = '  ' if debug and prod(map(len, rendered_choices)) > 1 else ''
+    command_choices: List[str] = []
+    for combination in product(*rendered_choices):
+        command_choice = []
+        for part in parts:
+            if isinstance(part, int):
+                command_choice += combination[part]
+            else:
+                command_choice.append(part)
+        command_choices.append(prefix + TOKEN_SEP.join(command_choice))
+    if debug:
+        return colored(' |\n', 'grey').join(command_choices)
+    else:
+        return COMMAND_SEP.join(command_choices)
+
+
+_render_generation = 0
+
+def invalidate_renders():
+    """
+    Drops every TokensContainer's cached render and Choice table, to call after mutating tokens in place
+    (e.g. retargeting a FunctionToken), as containers can't see that
+    """
+    global _render_generation
+    _render_generation += 1
+
+
 class TokensContainer:
+    __slots__ = ('_tokens', '_choice_table', '_render_cache')
+
     def __init__(self, *tokens: Token):
         assert all(isinstance(token, Token) for token in tokens), f"{[type(token) for token in tokens]}"
-        self._tokens = list(tokens)
+        self._tokens = tokens  # immutable, so changing a command means replacing the tuple, which _stamp notices
+        self._choice_table = None  # (stamp, Choice assignments, whether any token needs validating)
+        self._render_cache = None  # (stamp, render options, rendered) of the last serialize call
+
+    def _stamp(self) -> tuple:
+        """
+        Changes whenever the container may render differently: its token tuple is replaced, or invalidate_renders is
+        called (for tokens mutated in place)
+        """
+        return _render_generation, self._tokens
+
+    def _get_choice_table(self) -> tuple:
+        stamp = self._stamp()
+        if self._choice_table is None or self._choice_table[0] != stamp:
+            choices = [token for token in self if isinstance(token, Choice)]
+            validated = any(isinstance(token, FunctionToken | JSONRefToken)
+                            for token in self if not isinstance(token, Choice)) or \
+                any(isinstance(token, FunctionToken | JSONRefToken)
+                    for choice in choices for tokens in choice.choices for token in tokens)
+            self._choice_table = (stamp, {choice.ident: choice.choices for choice in set(choices)}, validated)
+        return self._choice_table
 
     @property
     def tokens(self):
@@ -388,54 +647,29 @@ class TokensContainer:
     def tokenize(self):
         return list(self.tokens)
 
+    def choice_assignments(self) -> Dict:
+        return self._get_choice_table()[1]
+
     def serialize(self, debug=False, color=False, force_color=None, validate_fun=lambda namespace, path: True,
                   validate_json=lambda namespace, path: True) -> str | SerializeErrorToken:
-        def token_serialize(t: TokenBase) -> str:
-            if isinstance(t, FunctionToken):
-                if not validate_fun(t.namespace, t.path):
-                    return colored(str(t), 'red', 'on_black', attrs=['blink', 'bold'])
-            if isinstance(t, JSONRefToken):
-                if not validate_json(t.namespace, t.path):
-                    return colored(str(t), 'red', 'on_black', attrs=['blink', 'bold'])
-
-            if force_color:
-                return colored(str(t), force_color)
-            elif debug:
-                return t.debug_str()
-            elif color:
-                return t.color_str()
-            else:
-                return str(t)
-
+        stamp, assignments, validated = self._get_choice_table()
+        # the validators only matter for containers with function or JSON references
+        options = (debug, color, force_color, validate_fun, validate_json) if validated else (debug, color, force_color)
+        if self._render_cache is not None and self._render_cache[0] == stamp and self._render_cache[1] == options:
+            return self._render_cache[2]
+
+        token_serialize = token_serializer(debug=debug, color=color, force_color=force_color,
+                                           validate_fun=validate_fun, validate_json=validate_json)
         try:
-            assignments = {
-                choice.ident: choice.choices
-                for choice in set(
-                    choice for choice in self if isinstance(choice, Choice)
-                )
-            }
-
-            combinations = list(product(*assignments.values()))
-
-            command_choices: List[str] = []
-            for combination in combinations:
-                command_choice = []
-                for token in self:
-                    if isinstance(token, Choice):
-                        index = list(assignments.keys()).index(token.ident)
-                        command_choice += [token_serialize(token_) for token_ in combination[index]]
-                    elif isinstance(token, TokenBase):
-                        command_choice.append(token_serialize(token))
-                    else:
-                        raise TypeError(f"Invalid token type: {type(token)}")
-                command_choices.append(
-                    ('  ' if debug and len(combinations) > 1 else '') + TOKEN_SEP.join(command_choice))
-            if debug:
-                return colored(' |\n', 'grey').join(command_choices)
-            else:
-                return COMMAND_SEP.join(command_choices)
+            rendered = serialize_choices(self.tokens, assignments, token_serialize, debug=debug)
         except Exception as e:
             return SerializeErrorToken(e)
+        self._render_cache = (stamp, options, rendered)
+        return rendered
+
+    def clear_render_cache(self):
+        self._choice_table = None
+        self._render_cache = None
 
     def __str__(self):
         return self.serialize()
@@ -509,25 +743,12 @@ class Program:
         """
         self.cmds = self.cmds[:i] + cmds + self.cmds[i + 1:]
 
-    def optimize(self):
-        i = 0
-        while i < len(self.cmds) - 1:
-            cmd0, cmd1 = self.cmds[i], self.cmds[i + 1]
-            try:
-                if hasattr(cmd0, 'join_with_cmd'):
-                    cmd01 = cmd0.join_with_cmd(cmd1)
-                elif hasattr(cmd1, 'right_join_with_cmd'):
-                    cmd01 = cmd1.right_join_with_cmd(cmd0)
-                else:
-                    cmd01 = None
-                if cmd01:
-                    print_debug(f'joined cmds: {cmd0} || {cmd1} --> {cmd01}')
-                    self.cmds[i] = cmd01
-                    del self.cmds[i + 1]
-                    i -= 1
-            except TypeError as e:
-                print_warn(f'invalid types for optim: {e}')
-            i += 1
+    def optimize(self, rules=None):
+        """
+        Runs the peephole rules (default peephole.PEEPHOLE_RULES) over the function to a fixpoint
+        """
+        from .peephole import peephole
+        self.cmds = peephole(self.cmds, rules)
 
     def serialize(self, debug=False, **kwargs):
         if debug:
@@ -539,3 +760,43 @@ class Program:
                 cmd.serialize(debug=debug, **kwargs) for cmd in self if cmd is not None
             ) if s != ''
         )
+
+    def snapshot(self) -> 'ProgramSnapshot':
+        """
+        Picklable copy of the token lists, e.g. for serializing in another process
+        """
+        def resolved_tokens(cmd: TokensContainer | TokensRef) -> List[Tuple[Token, ...]]:
+            # TokensRef.resolve without its (ABC, so slow) isinstance checks
+            if isinstance(cmd, TokensContainer):
+                return [tuple(cmd.tokens)]
+            return [tokens for cmd_ in cmd._get_cmds() for tokens in resolved_tokens(cmd_)]
+
+        return ProgramSnapshot(
+            cmds=tuple(
+                tuple(cmd.tokens) if isinstance(cmd, TokensContainer) else resolved_tokens(cmd)
+                for cmd in self.cmds if cmd is not None
+            ),
+            used=self.used
+        )
+
+
+class _ResolvedRef(TokensRef):
+    def __init__(self, cmds: List[TokensContainer]):
+        self.cmds = cmds
+
+    def _get_cmds(self) -> List[TokensContainer]:
+        return self.cmds
+
+
+class ProgramSnapshot(NamedTuple):
+    # per command, its tokens, or the tokens of each command a TokensRef resolved to
+    cmds: Tuple[Tuple[Token, ...] | List[Tuple[Token, ...]], ...]
+    used: bool
+
+    def restore(self) -> Program:
+        program = Program(*(
+            TokensContainer(*cmd) if isinstance(cmd, tuple) else _ResolvedRef([TokensContainer(*tokens) for tokens in cmd])
+            for cmd in self.cmds
+        ))
+        program.used = self.used
+        return program
@@ -282,7 +282,8 @@ class _SingleSelectorBase(_SelectorBase):
         if self.token.s not in {'p', 'r', 's', 'n'}:
             if 'limit' in self.token.kwargs and self.token.kwargs['limit'] != 1:
                 raise ValueError(f"Non-singular selector token @{self.token.s} with limit={self.token.kwargs['limit']}")
-            self.token.kwargs['limit'] = 1
+            # tokens can be interned or shared with another selector, so build a new one rather than mutating it
+            self.token = SelectorToken(self.token.s, **{**self.token.kwargs, 'limit': 1})
 
 class _PlayerSelectorBase(_SelectorBase):
     def __init__(self, s: str | _SelectorBase = 'a', **kwargs) -> None:
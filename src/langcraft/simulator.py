@@ -0,0 +1,553 @@
+from itertools import count
+from typing import Callable, Dict, List, Tuple
+import json
+import re
+
+from .debug_utils import print_warn
+from .globals import DATAPACK_ROOT
+from .analysis import MAX_COMMAND_CHAIN_LENGTH
+
+
+class SimulatorError(Exception):
+    pass
+
+
+class _ChainLimitReached(Exception):
+    pass
+
+
+class _Return(Exception):
+    def __init__(self, result: int | None):
+        self.result = result
+
+
+class SimEntity:
+    _ids = count()
+
+    def __init__(self, type: str = 'pig', tags=(), name: str | None = None, nbt=()):
+        self.id = next(SimEntity._ids)
+        self.type = type if ':' in type else f'minecraft:{type}'
+        self.tags = set(tags)
+        self.name = name
+        self.nbt = set(nbt)  # nbt filters (as rendered in selectors) the entity matches
+        self.alive = True
+
+    @property
+    def holder(self) -> str:
+        """
+        Score holder name: the player name, or a stand-in for the uuid
+        """
+        return self.name if self.type == 'minecraft:player' and self.name else f'$entity{self.id}'
+
+    def __repr__(self):
+        return f'SimEntity({self.type}, tags={sorted(self.tags)}, name={self.name})'
+
+
+def split_args(s: str, sep=' ') -> List[str]:
+    """
+    Splits a command on spaces (or sep) outside of brackets/braces/quotes
+    """
+    args, depth, quote, start = [], 0, None, 0
+    for i, c in enumerate(s):
+        if quote:
+            if c == quote and s[i - 1] != '\\':
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '[{(':
+            depth += 1
+        elif c in ']})':
+            depth -= 1
+        elif c == sep and depth == 0:
+            if i > start:
+                args.append(s[start:i])
+            start = i + 1
+    if start < len(s):
+        args.append(s[start:])
+    return args
+
+def in_range(val: int, match_range: str) -> bool:
+    if '..' in match_range:
+        low, high = match_range.split('..')
+        return (low == '' or val >= int(low)) and (high == '' or val <= int(high))
+    return val == int(match_range)
+
+def resource_name(name: str) -> str:
+    return name if ':' in name else f'minecraft:{name}'
+
+
+SCORE_OPERATIONS: Dict[str, Callable[[int, int], int]] = {
+    '=': lambda a, b: b,
+    '+=': lambda a, b: a + b,
+    '-=': lambda a, b: a - b,
+    '*=': lambda a, b: a * b,
+    '/=': lambda a, b: a // b if b else a,
+    '%=': lambda a, b: a % b if b else a,
+    '<': min,
+    '>': max,
+}
+
+SCORE_COMPARISONS: Dict[str, Callable[[int, int], bool]] = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '=': lambda a, b: a == b,
+    '>=': lambda a, b: a >= b,
+    '>': lambda a, b: a > b,
+}
+
+# argument counts of execute subcommands/conditions whose effect isn't modeled
+SKIPPED_SUBCOMMANDS = {'align': 1, 'anchored': 1, 'in': 1, 'on': 1}
+SKIPPED_CONDITIONS = {'block': 4, 'blocks': 10, 'biome': 4, 'predicate': 1, 'dimension': 1, 'loaded': 3, 'function': 1}
+
+TAGS_NBT_REGEX = re.compile(r'Tags:\s*\[([^\]]*)\]')
+MACRO_ARG_REGEX = re.compile(r'\$\(([A-Za-z0-9_]+)\)')
+
+type Context = SimEntity | None  # executing entity, None for the server
+
+
+class Simulator:
+    """
+    Deterministic interpreter for the subset of commands langcraft emits, standing in for a server when measuring how
+    many commands generated functions execute. Scoreboards, data storage, tags/types/names/scores of a mock entity
+    table, function calls, return and schedule are modeled; positions, blocks and the world are not, so any other
+    command is only counted and conditions on the world are answered by `condition`. Selector nbt filters are matched
+    verbatim against the filters each entity was given.
+
+    Example usage:
+    sim = Simulator(compile_all())
+    sim.add_entity('pig', tags=['a'])
+    sim.load()
+    counts = sim.run(20)  # commands executed in each of 20 ticks
+    sim.score('@s', 'i', sim.entities[0])
+    """
+    def __init__(self, files: Dict[str, str],
+                 condition: Callable[[List[str]], bool] = lambda args: True,
+                 max_chain: int = MAX_COMMAND_CHAIN_LENGTH):
+        self.functions: Dict[str, List[List[str]]] = {}
+        self.function_tags: Dict[str, List[str]] = {}
+        for path, content in files.items():
+            self._add_file(path, content)
+        self.condition = condition
+        self.max_chain = max_chain
+
+        self.entities: List[SimEntity] = []
+        self.objectives: Dict[str, Dict[str, int]] = {}
+        self.storage: Dict[str, Dict[str, str]] = {}
+        self.scheduled: List[Tuple[int, str]] = []  # (game time to run at, function), in scheduling order
+        self.output: List[str] = []  # say messages
+        self.game_time = 0
+        self.commands = 0  # commands executed in the current chain
+        self.function_counts: Dict[str, int] = {}  # function -> number of times run
+        self.score_samples: Dict[str, Dict[int, int]] = {}  # objective -> value -> ticks observed, see sample_scores
+
+    def _add_file(self, path: str, content: str):
+        parts = path.split('/')
+        if parts[0] in (DATAPACK_ROOT, 'data'):
+            parts = parts[1:]
+        if len(parts) < 3:
+            return
+        namespace, folder, *rest = parts
+        rest[-1] = rest[-1].removesuffix('.mcfunction').removesuffix('.json')
+        if folder == 'function':
+            self.functions[f'{namespace}:{"/".join(rest)}'] = [
+                split_args(line.strip()) for line in content.split('\n')
+                if line.strip() and not line.strip().startswith('#')
+            ]
+        elif folder == 'tags' and rest[0] == 'function':
+            self.function_tags[f'#{namespace}:{"/".join(rest[1:])}'] = [
+                value if isinstance(value, str) else value['id'] for value in json.loads(content)['values']
+            ]
+
+    # world state
+
+    def add_entity(self, type: str = 'pig', tags=(), name: str | None = None, nbt=()) -> SimEntity:
+        entity = SimEntity(type, tags, name, nbt)
+        self.entities.append(entity)
+        return entity
+
+    def score(self, holder: str, objective: str, context: Context = None) -> int | None:
+        holders = self._score_holders(holder, context)
+        if len(holders) != 1:
+            raise SimulatorError(f'{holder} matches {len(holders)} score holders')
+        return self.objectives.get(objective, {}).get(holders[0])
+
+    def _score_of(self, holder: str, objective: str, context: Context) -> int | None:
+        holders = self._score_holders(holder, context)
+        return self.objectives.get(objective, {}).get(holders[0]) if holders else None
+
+    def _score_holders(self, holder: str, context: Context) -> List[str]:
+        if holder == '*':
+            return sorted({name for scores in self.objectives.values() for name in scores})
+        if holder.startswith('@'):
+            return [entity.holder for entity in self.select(holder, context)]
+        return [holder]
+
+    def select(self, selector: str, context: Context) -> List[SimEntity]:
+        kind, args = selector[1], {}
+        if '[' in selector:
+            for arg in split_args(selector[3:-1], sep=','):
+                key, val = arg.split('=', 1)
+                args.setdefault(key, []).append(val)
+
+        if kind == 's':
+            candidates = [context] if context is not None and context.alive else []
+        elif kind in 'apr':
+            candidates = [entity for entity in self.entities if entity.alive and entity.type == 'minecraft:player']
+        else:  # e, n
+            candidates = [entity for entity in self.entities if entity.alive]
+
+        def matches(entity: SimEntity) -> bool:
+            for val in args.get('type', []):
+                if (entity.type != resource_name(val.removeprefix('!'))) != val.startswith('!'):
+                    return False
+            for val in args.get('tag', []):
+                if val == '':
+                    if entity.tags:
+                        return False
+                elif val == '!':
+                    if not entity.tags:
+                        return False
+                elif (val.removeprefix('!') in entity.tags) == val.startswith('!'):
+                    return False
+            for val in args.get('name', []):
+                if (entity.name == val.removeprefix('!').strip('"')) == val.startswith('!'):
+                    return False
+            for val in args.get('nbt', []):
+                if (val.removeprefix('!') in entity.nbt) == val.startswith('!'):
+                    return False
+            for val in args.get('scores', []):
+                for score_arg in val[1:-1].split(','):
+                    if not score_arg:
+                        continue
+                    objective, match_range = score_arg.split('=')
+                    score = self.objectives.get(objective, {}).get(entity.holder)
+                    if score is None or not in_range(score, match_range):
+                        return False
+            return True
+
+        selected = [entity for entity in candidates if matches(entity)]
+        limit = int(args['limit'][0]) if 'limit' in args else (1 if kind in 'pnr' else None)
+        return selected[:limit] if limit is not None else selected
+
+    # running
+
+    def call(self, function: str, context: Context = None) -> int:
+        """
+        Runs a function (or #tag) as a new command chain and returns the number of commands it executed
+        """
+        self.commands = 0
+        try:
+            self._run_function(function, context)
+        except _ChainLimitReached:
+            print_warn(f'{function} hit maxCommandChainLength ({self.max_chain}), aborted')
+        return self.commands
+
+    def sample_scores(self, *objectives: str):
+        """
+        Records the value distribution of these objectives at the start of every following tick, e.g. to build the
+        profile a weighted ScoreTree dispatching on them is shaped by
+        """
+        for objective in objectives:
+            self.score_samples.setdefault(objective, {})
+
+    def write_profile(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({objective: {str(val): n for val, n in sorted(samples.items())}
+                       for objective, samples in self.score_samples.items()}, f, indent=2)
+
+    def load(self) -> int:
+        return self.call('#minecraft:load') if '#minecraft:load' in self.function_tags else 0
+
+    def tick(self) -> int:
+        """
+        Runs due scheduled functions and #minecraft:tick, returning the number of commands executed this tick
+        """
+        for objective, samples in self.score_samples.items():
+            for val in self.objectives.get(objective, {}).values():
+                samples[val] = samples.get(val, 0) + 1
+
+        executed = 0
+        due = [function for time, function in self.scheduled if time <= self.game_time]
+        self.scheduled = [(time, function) for time, function in self.scheduled if time > self.game_time]
+        for function in due:
+            executed += self.call(function)
+        if '#minecraft:tick' in self.function_tags:
+            executed += self.call('#minecraft:tick')
+        self.game_time += 1
+        return executed
+
+    def run(self, ticks: int) -> List[int]:
+        return [self.tick() for _ in range(ticks)]
+
+    def _run_function(self, function: str, context: Context, macro_args: Dict[str, str] | None = None) -> int | None:
+        if function.startswith('#'):
+            result = None
+            for tagged_function in self.function_tags.get(function, []):
+                result = self._run_function(tagged_function, context)
+            return result
+        if function not in self.functions:
+            raise SimulatorError(f'unknown function {function}')
+        self.function_counts[function] = self.function_counts.get(function, 0) + 1
+        try:
+            for args in self.functions[function]:
+                if args[0].startswith('$'):
+                    if macro_args is None:
+                        raise SimulatorError(f'macro line in {function} run without arguments')
+                    try:
+                        line = MACRO_ARG_REGEX.sub(lambda match: macro_args[match.group(1)], ' '.join(args)[1:])
+                    except KeyError as e:
+                        raise SimulatorError(f'missing macro argument {e} for {function}')
+                    args = split_args(line)
+                    if args[0] == 'function' and len(args) == 2 and args[1] not in self.functions:
+                        # a macro-picked function that doesn't exist (e.g. ScoreTree dispatch out of range) just fails
+                        self.commands += 1
+                        continue
+                self._run_command(args, context)
+        except _Return as r:
+            return r.result
+        return None
+
+    def _run_command(self, args: List[str], context: Context) -> int | None:
+        """
+        Executes one command, returning its result (None on failure)
+        """
+        self.commands += 1
+        if self.commands > self.max_chain:
+            raise _ChainLimitReached()
+
+        match args:
+            case ['function', function]:
+                return self._run_function(function, context)
+            case ['function', function, 'with', 'storage', loc, path]:
+                prefix = path + '.'
+                macro_args = {key.removeprefix(prefix): val for key, val in self.storage.get(resource_name(loc), {}).items()
+                              if key.startswith(prefix)}
+                return self._run_function(function, context, macro_args)
+            case ['function', *_]:
+                raise SimulatorError(f'unsupported function call: {" ".join(args)}')
+            case ['return']:
+                raise _Return(0)
+            case ['return', 'fail']:
+                raise _Return(None)
+            case ['return', 'run', *cmd]:
+                raise _Return(self._run_command(cmd, context))
+            case ['return', val]:
+                raise _Return(int(val))
+            case ['execute', *subs]:
+                return self._run_execute(subs, [context])
+            case ['scoreboard', *cmd]:
+                return self._run_scoreboard(cmd, context)
+            case ['data', *cmd]:
+                return self._run_data(cmd, context)
+            case ['summon', entity_type, *rest]:
+                tags_match = TAGS_NBT_REGEX.search(' '.join(rest))
+                tags = [tag.strip().strip('"') for tag in tags_match.group(1).split(',')] if tags_match else []
+                self.add_entity(entity_type, tags=[tag for tag in tags if tag])
+                return 1
+            case ['kill']:
+                if context is not None:
+                    context.alive = False
+                return 1 if context is not None else None
+            case ['kill', selector]:
+                killed = self.select(selector, context)
+                for entity in killed:
+                    entity.alive = False
+                return len(killed) or None
+            case ['tag', selector, 'add' | 'remove' as action, tag]:
+                for entity in self.select(selector, context):
+                    if action == 'add':
+                        entity.tags.add(tag)
+                    else:
+                        entity.tags.discard(tag)
+                return 1
+            case ['schedule', 'function', function, time, *mode]:
+                ticks = int(time[:-1]) * {'t': 1, 's': 20, 'd': 24000}[time[-1]] if time[-1] in 'tsd' else int(time)
+                if mode != ['append']:
+                    # replace (the default) drops every pending run of the function
+                    self.scheduled = [(time, scheduled) for time, scheduled in self.scheduled if scheduled != function]
+                self.scheduled.append((self.game_time + ticks, function))
+                return 1
+            case ['schedule', 'clear', function]:
+                cleared = sum(scheduled == function for _, scheduled in self.scheduled)
+                self.scheduled = [(time, scheduled) for time, scheduled in self.scheduled if scheduled != function]
+                return cleared or None
+            case ['say', *msg]:
+                self.output.append(' '.join(msg))
+                return 1
+        # anything touching the world is only counted
+        return 1
+
+    def _run_execute(self, subs: List[str], contexts: List[Context]) -> int | None:
+        stores: List[Tuple[str, List[str]]] = []
+        i = 0
+        while i < len(subs):
+            sub = subs[i]
+            match sub:
+                case 'run':
+                    return self._run_forked(subs[i + 1:], contexts, stores)
+                case 'as':
+                    contexts = [entity for context in contexts for entity in self.select(subs[i + 1], context)]
+                    i += 2
+                case 'at':
+                    contexts = [context for context in contexts for _ in self.select(subs[i + 1], context)]
+                    i += 2
+                case 'positioned' | 'rotated':
+                    if subs[i + 1] == 'as':
+                        contexts = [context for context in contexts for _ in self.select(subs[i + 2], context)]
+                        i += 3
+                    elif subs[i + 1] == 'over':
+                        i += 3
+                    else:
+                        i += 4 if sub == 'positioned' else 3
+                case 'facing':
+                    if subs[i + 1] == 'entity':
+                        contexts = [context for context in contexts for _ in self.select(subs[i + 2], context)]
+                        i += 4
+                    else:
+                        i += 4
+                case 'summon':
+                    contexts = [self.add_entity(subs[i + 1]) for _ in contexts]
+                    i += 2
+                case 'store':
+                    # store result|success score <holder> <objective> / storage <loc> <path> <type> <scale>
+                    n = 5 if subs[i + 2] == 'score' else 7
+                    stores.append((subs[i + 1], subs[i + 2:i + n]))
+                    i += n
+                case 'if' | 'unless':
+                    passed, n = self._condition(subs[i + 1:], contexts)
+                    if sub == 'unless':
+                        passed = [context for context in contexts if context not in passed]
+                    contexts = passed
+                    i += n + 1
+                case _ if sub in SKIPPED_SUBCOMMANDS:
+                    i += SKIPPED_SUBCOMMANDS[sub] + 1
+                case _:
+                    raise SimulatorError(f'unsupported execute subcommand {sub}: execute {" ".join(subs)}')
+        # no run: result of the trailing condition
+        result = len(contexts) or None
+        for context in contexts or [None]:
+            self._store(stores, result, context)
+        return result
+
+    def _run_forked(self, cmd: List[str], contexts: List[Context], stores) -> int | None:
+        result = None
+        for context in contexts:
+            context_result = self._run_command(cmd, context)
+            self._store(stores, context_result, context)
+            if context_result is not None:
+                result = (result or 0) + context_result
+        return result
+
+    def _store(self, stores: List[Tuple[str, List[str]]], result: int | None, context: Context):
+        for kind, target in stores:
+            val = (1 if result is not None else 0) if kind == 'success' else (result or 0)
+            if target[0] == 'score':
+                for holder in self._score_holders(target[1], context):
+                    self.objectives.setdefault(target[2], {})[holder] = val
+            elif target[0] == 'storage':
+                self.storage.setdefault(resource_name(target[1]), {})[target[2]] = str(int(val * float(target[4])))
+
+    def _condition(self, args: List[str], contexts: List[Context]) -> Tuple[List[Context], int]:
+        """
+        Contexts passing the condition and the number of arguments the condition consumed
+        """
+        match args:
+            case ['score', holder, objective, 'matches', match_range, *_]:
+                def check(context):
+                    score = self._score_of(holder, objective, context)
+                    return score is not None and in_range(score, match_range)
+                return [context for context in contexts if check(context)], 5
+            case ['score', holder1, objective1, operator, holder2, objective2, *_]:
+                def check(context):
+                    score1 = self._score_of(holder1, objective1, context)
+                    score2 = self._score_of(holder2, objective2, context)
+                    return score1 is not None and score2 is not None and SCORE_COMPARISONS[operator](score1, score2)
+                return [context for context in contexts if check(context)], 6
+            case ['data', 'storage', loc, path, *_]:
+                present = path in self.storage.get(resource_name(loc), {})
+                return (contexts if present else []), 4
+            case ['data', 'entity', *_]:
+                return [context for context in contexts if self.condition(args[:4])], 4
+            case ['data', 'block', *_]:
+                return [context for context in contexts if self.condition(args[:6])], 6
+            case ['entity', selector, *_]:
+                return [context for context in contexts if self.select(selector, context)], 2
+            case ['items', 'entity' | 'block' as kind, *_]:
+                n = 5 if kind == 'entity' else 7
+                return [context for context in contexts if self.condition(args[:n])], n
+            case [condition, *_] if condition in SKIPPED_CONDITIONS:
+                n = SKIPPED_CONDITIONS[condition] + 1
+                return [context for context in contexts if self.condition(args[:n])], n
+        raise SimulatorError(f'unsupported condition: {" ".join(args)}')
+
+    def _run_scoreboard(self, cmd: List[str], context: Context) -> int | None:
+        match cmd:
+            case ['objectives', 'add', objective, *_]:
+                if objective in self.objectives:
+                    return None
+                self.objectives[objective] = {}
+                return 1
+            case ['objectives', 'remove', objective]:
+                return 1 if self.objectives.pop(objective, None) is not None else None
+            case ['objectives', *_]:
+                return 1
+            case ['players', 'set' | 'add' | 'remove' as action, holder, objective, val]:
+                scores = self._objective(objective)
+                result = None
+                for name in self._score_holders(holder, context):
+                    if action == 'set':
+                        scores[name] = int(val)
+                    else:
+                        scores[name] = scores.get(name, 0) + (int(val) if action == 'add' else -int(val))
+                    result = scores[name]
+                return result
+            case ['players', 'reset', holder, *objective]:
+                for name in self._score_holders(holder, context):
+                    for objective_name, scores in self.objectives.items():
+                        if not objective or objective[0] == objective_name:
+                            scores.pop(name, None)
+                return 1
+            case ['players', 'get', holder, objective]:
+                return self._score_of(holder, objective, context)
+            case ['players', 'operation', holder1, objective1, operation, holder2, objective2]:
+                scores1, scores2 = self._objective(objective1), self._objective(objective2)
+                result = None
+                for name1 in self._score_holders(holder1, context):
+                    for name2 in self._score_holders(holder2, context):
+                        if name2 not in scores2:
+                            return None
+                        a, b = scores1.get(name1, 0), scores2[name2]
+                        if operation == '><':
+                            scores1[name1], scores2[name2] = b, a
+                        else:
+                            scores1[name1] = SCORE_OPERATIONS[operation](a, b)
+                        result = scores1[name1]
+                return result
+            case ['players', 'enable', *_]:
+                return 1
+        raise SimulatorError(f'unsupported scoreboard command: scoreboard {" ".join(cmd)}')
+
+    def _objective(self, objective: str) -> Dict[str, int]:
+        if objective not in self.objectives:
+            raise SimulatorError(f'unknown scoreboard objective {objective}')
+        return self.objectives[objective]
+
+    def _run_data(self, cmd: List[str], context: Context) -> int | None:
+        match cmd:
+            case ['modify', 'storage', loc, path, 'set', 'value', val]:
+                self.storage.setdefault(resource_name(loc), {})[path] = val
+                return 1
+            case ['remove', 'storage', loc, path]:
+                return 1 if self.storage.get(resource_name(loc), {}).pop(path, None) is not None else None
+            case ['get', 'storage', loc, path, *scale]:
+                val = self.storage.get(resource_name(loc), {}).get(path)
+                if val is None:
+                    return None
+                try:
+                    return int(float(val.rstrip('bBsSlLfFdD')) * (float(scale[0]) if scale else 1))
+                except ValueError:
+                    return 1
+            case [_, 'storage', *_]:
+                raise SimulatorError(f'unsupported data storage command: data {" ".join(cmd)}')
+        # entity/block nbt isn't modeled
+        return 1
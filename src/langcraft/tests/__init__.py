@@ -1,4 +1,6 @@
 from .misc import *
 from .tree import *
+from .passes import *
+from .simulator import *
 
 from .run import run_tests
@@ -1,7 +1,12 @@
+import tracemalloc
+from typing import List
+
 from langcraft import *
 from langcraft.base import PublicFun
-from .utils import test
+from langcraft.serialize import FunctionToken, TokenBase
+from .utils import test, check
 test = test(__name__)
+check = check(__name__)
 
 @test
 def test0():
@@ -57,3 +62,250 @@ def test2():
 
         parametric('asdf')
 
+
+
+@test
+def single_eval():
+    @public
+    def main():
+        If(Condition('entity @s[nbt={OnGround:1b}]'), single_eval=True)(
+            Statement('say on ground')
+        ).Else(
+            Statement('say in air')
+        )
+        If(Condition('block ~ ~ ~ air'), single_eval=True)(
+            Statement('say air')
+        ).Else(
+            Statement('say not air')
+        )
+
+@check
+def single_eval_reentry():
+    # the if branch runs the function again as an entity taking the else branch, which must not affect the outer run
+    for single_eval in (False, True):
+        GLOBALS.reset('test')
+        with PublicFun('f'):
+            If(Condition('entity @s[tag=a]'), single_eval=single_eval)(
+                Statement('say if'),
+                Statement('execute as @e[tag=b] run function test:f')
+            ).Else(
+                Statement('say else')
+            )
+
+        sim = Simulator(compile_all())
+        a = sim.add_entity(tags=['a'])
+        sim.add_entity(tags=['b'])
+        sim.call('test:f', a)
+        assert sim.output == ['if', 'else'], (single_eval, sim.output)
+
+@check
+def single_eval_auto():
+    # by default only conditions costing more than the function call are evaluated once, unless a branch returns
+    score = Score('i')
+    with PublicFun('main'):
+        Statement('scoreboard objectives add i dummy')
+        If(score == 1)(Statement('say one')).Else(Statement('say not one'))
+        tagged = If(Condition('entity @s[tag=a]'))(Statement('say tagged'))
+        if_cmd = tagged._if_cmds[-1]
+        block_tokens = if_cmd._block_tokens
+        tagged.Else(Statement('say untagged'))
+        If(Condition('entity @s[tag=a]'))(Statement('return 1')).Else(Statement('say untagged'))
+    # the if branch's command is copied into the function, not changed
+    assert if_cmd._block_tokens is block_tokens
+
+    out = compile_all()
+    assert out['$root/test/function/main'].split('\n')[1:] == [
+        'execute if score @s i matches 1 run say one',
+        'execute unless score @s i matches 1 run say not one',
+        'function test:main/x0',
+        'execute if entity @s[tag=a] run return 1',
+        'execute unless entity @s[tag=a] run say untagged',
+    ], out['$root/test/function/main']
+    assert out['$root/test/function/main/x0'] == 'execute if entity @s[tag=a] run return run say tagged\nsay untagged', out
+
+    for tags, said in ((['a'], ['not one', 'tagged']), ([], ['not one', 'untagged', 'untagged'])):
+        sim = Simulator(out)
+        sim.call('test:main', sim.add_entity(tags=tags))
+        assert sim.output == said, (tags, sim.output)
+
+
+class BrokenToken(TokenBase):
+    __slots__ = ()
+
+    def __str__(self):
+        raise ValueError('unrenderable token')
+
+def parallel_build(broken: bool):
+    GLOBALS.reset('test')
+    score = Score('i')
+
+    @ticking
+    @fun
+    def tree():
+        with ScoreTree('i'):
+            for i in range(8):
+                Statement(f'say {i}')
+
+    @public
+    def main():
+        for i in range(4):
+            If(score == i)(Statement(f'say {i}'), Statement('say again')).Else(Statement('say no'))
+        If((score == 9) | Condition('entity @s[tag=a]'))(Statement('say or'))
+        Statement(FunctionToken('test', ['missing']))
+        tree()
+
+    if broken:
+        with PublicFun('broken'):
+            Statement(BrokenToken())
+
+@check
+def parallel():
+    # workers render the same files as the serial path (score_flags: storage flags are random uuids), and raise the
+    # same errors
+    outputs = []
+    for jobs in (1, 2):
+        parallel_build(broken=False)
+        outputs.append(compile_all(jobs=jobs, score_flags=True))
+    assert outputs[0] == outputs[1], outputs
+
+    errors = []
+    for jobs in (1, 2):
+        parallel_build(broken=True)
+        try:
+            compile_all(jobs=jobs)
+        except ValueError as e:
+            errors.append(str(e))
+    assert errors == ['unrenderable token'] * 2, errors
+
+@check
+def build_report():
+    # without trace_memory, the peak of code tracing around the build survives it
+    tracemalloc.start()
+    try:
+        block = bytearray(16 * 2**20)
+        del block
+        parallel_build(broken=False)
+        report = BuildReport(trace_memory=False)
+        compile_all(report=report)
+        assert tracemalloc.get_traced_memory()[1] >= 16 * 2**20
+        assert all(stats.peak_memory == 0 for stats in report.phases.values())
+        assert 'setup' in report.phases, list(report.phases)
+    finally:
+        tracemalloc.stop()
+
+    # a failing build still stops the tracing it started
+    parallel_build(broken=True)
+    report = BuildReport(trace_memory=True)
+    try:
+        compile_all(report=report)
+    except ValueError:
+        pass
+    assert not tracemalloc.is_tracing()
+    assert report.traced_peak > 0
+
+@check
+def bench_scenario():
+    from langcraft.bench import generators, run_scenario
+
+    def run():
+        # freed before the build's last phase, so only a peak over the whole run sees it
+        block = bytearray(16 * 2**20)
+        del block
+        return generators.score_tree(100)
+
+    result = run_scenario(run)
+    assert result['peak_memory'] >= 16 * 2**20, result['peak_memory']
+    assert 0 <= result['retained_memory'] <= result['peak_memory']
+    assert 0 < result['compile_time'] <= result['total_time']
+    assert result['compile_time'] == sum(result['phases'].values())
+    assert 'serialize:function' in result['phases'], list(result['phases'])
+    assert result['files'] > 100 and result['bytes'] > 0, result
+
+@check
+def render_cache_replace():
+    from langcraft.commands import _ExecuteContainer
+    from langcraft.serialize import TokensContainer, CommandNameToken, CommandKeywordToken, StrToken
+
+    container = TokensContainer(CommandNameToken('say'), StrToken('a'), StrToken('b'))
+    assert container.serialize() == 'say a b'
+    try:
+        container._tokens[1] = StrToken('c')
+    except TypeError:
+        pass
+    else:
+        assert False, 'container tokens can be mutated in place'
+    # a same length replacement still re-renders
+    container._tokens = (*container._tokens[:1], StrToken('c'), *container._tokens[2:])
+    assert container.serialize() == 'say c b', container.serialize()
+
+    execute = _ExecuteContainer([CommandNameToken('execute')], [CommandKeywordToken('run'), StrToken('say a')])
+    assert execute.serialize() == 'execute run say a'
+    execute._block_tokens = (execute._block_tokens[0], StrToken('say b'))
+    assert execute.serialize() == 'execute run say b', execute.serialize()
+
+
+def ticks(sim: Simulator, n: int) -> List[List[str]]:
+    """
+    What each of the next n ticks said
+    """
+    said = []
+    for _ in range(n):
+        sim.output.clear()
+        sim.tick()
+        said.append(list(sim.output))
+    return said
+
+@check
+def schedule():
+    with PublicFun('main'):
+        with Schedule(3):
+            Statement('say 3 ticks')
+        Schedule(20)(Statement('say 1 second'))
+    out = compile_all()
+    main = out['$root/test/function/main'].split('\n')
+    assert [cmd.split(' ', 3)[3] for cmd in main] == ['3t replace', '1s replace'], main
+
+    sim = Simulator(out)
+    sim.call('test:main')
+    said = ticks(sim, 21)
+    assert said[3] == ['3 ticks'] and said[20] == ['1 second'], said
+    assert sum(map(len, said)) == 2, said
+
+@check
+def time_sliced():
+    # two loops share the per tick budget: 2 iterations per tick in total, and each marker dies once its loop ends
+    with PublicFun('main'):
+        with TimeSliced(2, iterations=5):
+            Statement('say step')
+
+    sim = Simulator(compile_all())
+    sim.load()
+    sim.call('test:main')
+    sim.call('test:main')
+    markers = [entity for entity in sim.entities if entity.type == 'minecraft:marker']
+    assert len(markers) == 2, sim.entities
+    said = ticks(sim, 8)
+    assert [len(tick) for tick in said] == [0, 2, 2, 2, 2, 2, 0, 0], said
+    assert not any(marker.alive for marker in markers), markers
+    assert sim.scheduled == [], sim.scheduled
+
+@check
+def sliced_line_stops():
+    from langcraft.lib import sliced_line
+
+    # stops once the condition fails or after max_len steps, whichever comes first, and runs final_block either way
+    for max_len, steps in ((10, 4), (3, 3)):
+        GLOBALS.reset('test')
+        with PublicFun('main'):
+            Statement('scoreboard objectives add i dummy')
+            Statement('scoreboard players set steps i 0')
+            sliced_line(lambda: Statement('scoreboard players add steps i 1'), Condition('score steps i matches ..3'),
+                        max_len, 2, final_block=lambda: Statement('say done'))
+
+        sim = Simulator(compile_all())
+        sim.load()
+        sim.call('test:main')
+        said = ticks(sim, 5)
+        assert sim.score('steps', 'i') == steps, (max_len, sim.objectives)
+        assert sum(said, []) == ['done'], (max_len, said)
+        assert not any(entity.alive for entity in sim.entities), sim.entities
@@ -0,0 +1,537 @@
+import io
+from contextlib import redirect_stdout
+from typing import Dict, List
+
+from langcraft import *
+from langcraft.serialize import CommandKeywordToken, CommandNameToken, FunctionToken, Program, RawToken, StrToken, \
+                                TokensContainer
+from .utils import check
+check = check(__name__)
+
+
+def ticked_and_called():
+    @ticking
+    @fun
+    def scanned():
+        Statement('say scanned tick')
+        with Entities(type='pig', tag='x'):
+            Statement('say scanned pig')
+
+    @ticking
+    @fun
+    def emptied():
+        with Entities(type='pig'):
+            Statement('say emptied pig')
+
+    @ticking
+    @fun
+    def hooked():
+        with Entities(type='pig'):
+            Statement('say hooked pig')
+
+    @public
+    def main():
+        scanned()
+        emptied()
+
+@check
+def tick_dispatch():
+    # functions also called directly keep their scans, the tick hook runs copies without them
+    outputs = []
+    for tick_dispatch in (False, True):
+        GLOBALS.reset('test')
+        ticked_and_called()
+        out = compile_all(tick_dispatch=tick_dispatch)
+
+        sim = Simulator(out)
+        sim.add_entity('pig', tags=['x'])
+        sim.call('test:main')
+        called = list(sim.output)
+        sim.output.clear()
+        sim.tick()
+        outputs.append((called, sorted(sim.output)))
+
+        if tick_dispatch:
+            assert '$root/_internal/function/tick/pig' in out, list(out)
+            assert out['$root/minecraft/tags/function/tick'] == \
+                '{"values": ["_internal:tick/hooked/test/x0", "_internal:tick"]}', out['$root/minecraft/tags/function/tick']
+    assert outputs[0] == outputs[1], outputs
+    assert outputs[0] == (['scanned tick', 'scanned pig', 'emptied pig'],
+                          ['emptied pig', 'hooked pig', 'scanned pig', 'scanned tick']), outputs[0]
+
+@check
+def tick_dispatch_spellings():
+    # type=arrow and type=minecraft:arrow scan the same entities, so they share one dispatcher
+    outputs = []
+    for tick_dispatch in (False, True):
+        GLOBALS.reset('test')
+        for i, entity_type in enumerate(('arrow', 'minecraft:arrow', 'arrow', 'minecraft:arrow')):
+            with Fun() as scanning:
+                with Entities(type=entity_type):
+                    Statement(f'say {i} {entity_type}')
+            ticking(scanning)
+        out = compile_all(tick_dispatch=tick_dispatch)
+
+        sim = Simulator(out)
+        sim.add_entity('arrow')
+        sim.tick()
+        outputs.append(sorted(sim.output))
+
+        if tick_dispatch:
+            dispatchers = [path for path in out if path.startswith('$root/_internal/function/tick/')]
+            assert dispatchers == ['$root/_internal/function/tick/arrow'], list(out)
+            assert out['$root/_internal/function/tick'] == 'execute as @e[type=arrow] run function _internal:tick/arrow', \
+                out['$root/_internal/function/tick']
+    assert outputs[0] == outputs[1] == ['0 arrow', '1 minecraft:arrow', '2 arrow', '3 minecraft:arrow'], outputs
+
+
+def duplicates(scheduled: bool):
+    with Fun() as f:
+        Statement('say same')
+        Statement('scoreboard players add @s i 1')
+    with Fun() as g:
+        Statement('say same')
+        Statement('scoreboard players add @s i 1')
+
+    with PublicFun('main'):
+        Statement('scoreboard objectives add i dummy')
+        if scheduled:
+            Schedule(1)(f)
+            Schedule(1)(g)
+        else:
+            f()
+            g()
+
+@check
+def dedup():
+    # identical functions share one file, and the call sites follow
+    outputs = []
+    for dedup in (False, True):
+        GLOBALS.reset('test')
+        duplicates(scheduled=False)
+        out = compile_all(dedup=dedup)
+        bodies = [content for content in out.values() if content.startswith('say same')]
+        assert len(bodies) == (1 if dedup else 2), out
+        if dedup:
+            assert out['$root/test/function/main'].endswith('function test:x0\nfunction test:x0'), out['$root/test/function/main']
+
+        sim = Simulator(out)
+        pig = sim.add_entity()
+        sim.call('test:main', pig)
+        outputs.append((sim.output, sim.score('@s', 'i', pig)))
+    assert outputs[0] == outputs[1] == (['same', 'same'], 2), outputs
+
+@check
+def dedup_scheduled():
+    # scheduling replaces the pending run of the same function, so scheduled functions keep their own
+    GLOBALS.reset('test')
+    duplicates(scheduled=True)
+    out = compile_all(dedup=True)
+    assert len([content for content in out.values() if content.startswith('say same')]) == 2, out
+
+    sim = Simulator(out)
+    sim.call('test:main')
+    sim.run(2)
+    assert sim.output == ['same', 'same'], sim.output
+
+
+def or_conditions():
+    score = Score('i')
+
+    @fun
+    def inner():
+        If((score == 7) | (score == 8))(Statement('say inner'))
+
+    @public
+    def main():
+        If((score == 3) | (score == 4))(Statement('say first'))
+        If((score == 1) | Condition('entity @s[tag=a]'))(inner(), Statement('say second'))
+
+@check
+def score_flags():
+    # flags share a slot unless one is live across a call to a function using the other
+    outputs = []
+    for score_flags in (False, True):
+        GLOBALS.reset('test')
+        or_conditions()
+        out = compile_all(score_flags=score_flags)
+        if score_flags:
+            assert '_internal:flags' not in ''.join(out.values()), out
+            assert out['$root/test/function/x0'].startswith('scoreboard players reset #f0 _lc'), out
+            assert 'scoreboard players reset #f1 _lc' in out['$root/test/function/main'], out
+
+        runs = []
+        for i in (1, 3, 4, 7):
+            sim = Simulator(out)
+            pig = sim.add_entity('pig', tags=['a'])
+            sim.load()
+            sim.objectives['i'] = {pig.holder: i}
+            sim.call('test:main', pig)
+            runs.append(sim.output)
+        outputs.append(runs)
+    assert outputs[0] == outputs[1], outputs
+    assert outputs[0] == [['second'], ['first', 'second'], ['first', 'second'], ['inner', 'second']], outputs[0]
+
+
+@check
+def cost_branches():
+    from langcraft.analysis import analyze_costs, score_tree_dispatch_cost
+
+    # the if branch can change the condition, so both branches of an if/unless pair count, but only one branch of a
+    # single-eval If/Else runs
+    for single_eval, worst_case in ((False, (1 + 2) + (1 + 3) + 1), (True, 1 + (1 + max(2, 3)) + 1)):
+        GLOBALS.reset('test')
+
+        @public
+        def main():
+            If(Condition('entity @s[tag=a]'), single_eval=single_eval)(Statement('say a'), Statement('say b')).Else(
+                Statement('say c'), Statement('say d'), Statement('say e')
+            )
+            Statement('say f')
+
+        compile_all()
+        cost = analyze_costs()[GLOBALS.get_function_path(path=['main'])]
+        assert cost.worst_case == worst_case, (single_eval, cost.to_dict())
+
+    # ScoreTree levels return, so only one leaf counts
+    GLOBALS.reset('test')
+
+    @public
+    def main():
+        with ScoreTree('i'):
+            for i in range(4):
+                Statement(f'say {i}')
+
+    compile_all()
+    cost = analyze_costs()[GLOBALS.get_function_path(path=['main'])]
+    assert cost.worst_case == score_tree_dispatch_cost(4, 'tree'), cost.to_dict()
+
+def call_chain(length: int, recursive: bool) -> Dict[str, Program]:
+    # f0 calls f1 ... calls f<length - 1>, which calls f0 again if recursive
+    programs = {}
+    for i in range(length):
+        callee = (i + 1) % length if recursive or i + 1 < length else None
+        programs[GLOBALS.get_function_path(path=[f'f{i}'])] = program = Program(
+            TokensContainer(CommandNameToken('say'), StrToken(str(i))),
+            *([TokensContainer(FunctionToken('test', [f'f{callee}']))] if callee is not None else [])
+        )
+        program.used = True
+    return programs
+
+@check
+def cost_call_chains():
+    from langcraft.analysis import MAX_COMMAND_CHAIN_LENGTH, analyze_costs
+
+    # a score condition keeps the if/unless pair
+    score = Score('i')
+
+    @public
+    def main():
+        If(score == 1)(Statement('say a'), Statement('say b')).Else(Statement('say c'))
+        Statement('say d')
+
+    compile_all()
+    costs = analyze_costs()
+    assert costs[GLOBALS.get_function_path(path=['main'])].to_dict() == \
+        {'commands': 3, 'worst_case': 5, 'call_depth': 2, 'recursive': False}, costs
+
+    # chains longer than python's recursion limit
+    costs = analyze_costs(call_chain(5000, recursive=False), {})
+    cost = costs[GLOBALS.get_function_path(path=['f0'])]
+    assert cost.to_dict() == {'commands': 2, 'worst_case': 2 * 5000 - 1, 'call_depth': 5000, 'recursive': False}, cost.to_dict()
+
+    costs = analyze_costs(call_chain(5000, recursive=True), {})
+    assert all(cost.recursive and cost.worst_case == MAX_COMMAND_CHAIN_LENGTH for cost in costs.functions.values())
+
+
+def calls():
+    @fun
+    def small():
+        Statement('scoreboard players add @s i 1')
+
+    @fun
+    def once():
+        Statement('say once')
+        Statement('scoreboard players add @s i 10')
+        Statement('say once done')
+        Statement('say really done')
+
+    @fun
+    def big():
+        for j in range(4):
+            Statement(f'say big {j}')
+
+    with Fun() as early:
+        Statement('scoreboard players add @s i 100')
+        Statement('return 1')
+
+    with Fun() as countdown:
+        Statement('scoreboard players remove @s n 1')
+        Statement('say count')
+        If(Condition('score @s n matches 1..'))(countdown())
+
+    with PublicFun('main'):
+        Statement('scoreboard objectives add i dummy')
+        Statement('scoreboard objectives add n dummy')
+        Statement('scoreboard players set @s n 3')
+        early()
+        small()
+        small()
+        once()
+        big()
+        big()
+        with Entities(type='pig'):
+            small()
+        countdown()
+
+@check
+def inline():
+    # small functions and functions called once are spliced into their callers, the rest keep their files
+    outputs = []
+    for inline in (False, True):
+        GLOBALS.reset('test')
+        calls()
+        out = compile_all(inline=inline)
+        main = out['$root/test/function/main']
+        if inline:
+            assert 'say once' in main and 'execute as @e[type=pig] at @s run scoreboard players add @s i 1' in main, main
+            # big is too large for two sites, early returns and countdown is recursive
+            assert main.count('function test:x2') == 2 and 'function test:x3' in main and 'function test:x4' in main, main
+            assert '$root/test/function/x0' not in out and '$root/test/function/x1' not in out, list(out)
+
+        sim = Simulator(out)
+        pig = sim.add_entity('pig')
+        sim.call('test:main', pig)
+        outputs.append((sim.output, sim.score('@s', 'i', pig), sim.score('@s', 'n', pig)))
+    assert outputs[0] == outputs[1], outputs
+    assert outputs[0] == (['once', 'once done', 'really done', *[f'big {j}' for j in range(4)] * 2, *['count'] * 3],
+                          113, 0), outputs[0]
+
+
+def rendered(cmds) -> List[str]:
+    return [str(cmd.serialize()) for cmd in cmds]
+
+@check
+def peephole_join():
+    from langcraft.commands import Teleport
+    from langcraft.peephole import JoinRule, peephole
+    from langcraft.serialize_types import Pos, _SelectorBase
+
+    def tp(**kwargs):
+        return Teleport(_SelectorBase(), Pos.relative(**kwargs), add=False)
+
+    assert rendered(JoinRule().apply([tp(x=1), tp(y=2)])) == ['tp @s ~1 ~2 ~0']
+    assert JoinRule().apply([tp(x=1), Statement('say a', add=False)]) is None
+    assert rendered(peephole([tp(x=1), tp(y=2), tp(z=3)], [JoinRule()])) == ['tp @s ~1 ~2 ~3']
+
+@check
+def peephole_remove_no_op():
+    from langcraft.peephole import RemoveNoOpRule, peephole
+
+    assert RemoveNoOpRule().apply([Pass(add=False)]) == []
+    assert RemoveNoOpRule().apply([TokensContainer(RawToken('  '))]) == []
+    assert RemoveNoOpRule().apply([TokensContainer()]) == []
+    assert RemoveNoOpRule().apply([Statement('say a', add=False)]) is None
+    assert rendered(peephole([Pass(add=False), Statement('say a', add=False), None, TokensContainer()],
+                             [RemoveNoOpRule()])) == ['say a']
+
+@check
+def peephole_merge_execute():
+    from langcraft.commands import _ExecuteContainer
+    from langcraft.peephole import MergeExecuteRule
+
+    execute, run = CommandNameToken('execute'), CommandKeywordToken('run')
+    nested = _ExecuteContainer([execute, RawToken('as @a')],
+                               [run, execute, RawToken('if entity @s[tag=a]'), run, RawToken('say a')])
+    merged, = MergeExecuteRule().apply([nested])
+    assert str(merged) == 'execute as @a if entity @s[tag=a] run say a', str(merged)
+    # the inner run stays the block, for passes looking at what the command runs
+    assert rendered([TokensContainer(*merged._block_tokens)]) == ['run say a']
+
+    raw = _ExecuteContainer([execute, RawToken('as @a')], [run, RawToken('execute at @s run say b')])
+    assert rendered(MergeExecuteRule().apply([raw])) == ['execute as @a at @s run say b']
+    assert MergeExecuteRule().apply([_ExecuteContainer([execute, RawToken('as @a')], [run, RawToken('say c')])]) is None
+    assert MergeExecuteRule().apply([Statement('execute as @a run execute at @s run say d', add=False)]) is None
+
+@check
+def peephole_fold_score_add():
+    from langcraft.peephole import FoldScoreAddRule, MAX_SCORE, peephole
+
+    def cmd(text: str):
+        return Statement(text, add=False)
+
+    rule = FoldScoreAddRule()
+    assert rendered(rule.apply([cmd('scoreboard players add @s i 3'), cmd('scoreboard players remove @s i 5')])) == \
+        ['scoreboard players remove @s i 2']
+    assert rendered(rule.apply([cmd('scoreboard players add #x i 3'), cmd('scoreboard players remove #x i 3')])) == \
+        ['scoreboard players add #x i 0']
+    # selectors that may resolve to other entities, other objectives and overflowing totals are kept
+    assert rule.apply([cmd('scoreboard players add @e i 1'), cmd('scoreboard players add @e i 1')]) is None
+    assert rule.apply([cmd('scoreboard players add @s i 1'), cmd('scoreboard players add @s j 1')]) is None
+    assert rule.apply([cmd(f'scoreboard players add @s i {MAX_SCORE}'), cmd('scoreboard players add @s i 1')]) is None
+    assert rendered(peephole([cmd(f'scoreboard players add @s i {n}') for n in range(1, 5)], [rule])) == \
+        ['scoreboard players add @s i 10']
+
+@check
+def peephole_dedup_flag_reset():
+    from langcraft.peephole import DedupFlagResetRule
+    from langcraft.serialize import Flag, ResetFlagToken
+
+    a, b = Flag('a'), Flag('b')
+    reset_a = TokensContainer(ResetFlagToken(a))
+    assert DedupFlagResetRule().apply([reset_a, TokensContainer(ResetFlagToken(Flag('a')))]) == [reset_a]
+    assert DedupFlagResetRule().apply([reset_a, TokensContainer(ResetFlagToken(b))]) is None
+    assert DedupFlagResetRule().apply([reset_a, Statement('say a', add=False)]) is None
+
+@check
+def peephole_statements():
+    from langcraft.peephole import FoldScoreAddRule, PeepholeRule, peephole
+
+    try:
+        PeepholeRule()
+    except TypeError:
+        pass
+    else:
+        assert False, 'PeepholeRule without apply can be instantiated'
+
+    def statement(*texts: str) -> Statement:
+        return Statement([TokensContainer(RawToken(text)) for text in texts], add=False)
+
+    # statements none of whose commands changed stay whole, the others are split into their commands
+    kept = statement('say a', 'scoreboard players add @s i 1')
+    folded = statement('scoreboard players add @s j 1', 'say b')
+    cmds = [kept, Statement('say c', add=False), statement('say d', 'scoreboard players add @s j 2'), folded]
+    optimized = peephole(cmds, [FoldScoreAddRule()])
+    assert optimized[:2] == cmds[:2], optimized
+    assert rendered(optimized[2:]) == ['say d', 'scoreboard players add @s j 3', 'say b'], rendered(optimized[2:])
+    program = Program(*cmds)
+    program.optimize([FoldScoreAddRule()])
+    assert program.cmds[0] is kept and rendered(program.cmds) == rendered(optimized)
+
+
+def entity_scans():
+    with PublicFun('main'):
+        Statement('scoreboard objectives add i dummy')
+        with Entities(type='pig'):
+            Statement('scoreboard players add @s i 1')
+        with Entities(type='pig'):
+            Statement('say pig')
+        with Entities(type='pig'):
+            If(Condition('entity @s[tag=x]'))(Statement('scoreboard players add @s i 10'))
+        with Entities(type='pig', tag='x'):
+            Statement('say x')
+        Statement('say between')
+        with Entities(type='cow'):
+            Statement('say cow')
+        with Entities(type='cow'):
+            Statement('scoreboard players add @s i 100')
+
+@check
+def factor_execute():
+    # runs of executes sharing a scan are hoisted into one scan, when that saves more scans than the call costs
+    outputs = []
+    for factor_execute, call_cost in ((False, 1), (True, 1), (True, 0)):
+        GLOBALS.reset('test')
+        entity_scans()
+        out = compile_all(factor_execute=factor_execute, factor_call_cost=call_cost)
+        main = out['$root/test/function/main']
+        if factor_execute:
+            assert main.count('execute as @e[type=pig] at @s') == 1, main
+            assert 'execute as @e[type=pig,tag=x] at @s' in main, main
+            assert main.count('execute as @e[type=cow] at @s') == (1 if call_cost == 0 else 2), main
+
+        sim = Simulator(out)
+        pigs = [sim.add_entity('pig', tags=['x']), sim.add_entity('pig')]
+        cows = [sim.add_entity('cow'), sim.add_entity('cow')]
+        sim.call('test:main')
+        # each entity runs the hoisted commands in turn, so only the order of their output changes
+        outputs.append((sorted(sim.output), [sim.score('@s', 'i', entity) for entity in pigs + cows]))
+    assert outputs[0] == outputs[1] == outputs[2], outputs
+    assert outputs[0][1] == [11, 1, 100, 100], outputs[0]
+
+
+def arrows(cache_nbt: bool, revalidate: int | None):
+    with PublicFun('main'):
+        Statement('scoreboard objectives add i dummy')
+        with Entities(type='arrow', nbt='{inGround:1b}', cache_nbt=cache_nbt, revalidate=revalidate):
+            Statement('scoreboard players add @s i 1')
+        with Entities(type='arrow', nbt='{inGround:1b}', cache_nbt=cache_nbt):
+            Statement('say landed')
+
+@check
+def nbt_cache():
+    # cached selectors match the same entities, until an entity's nbt changes: that is only seen on revalidation
+    counts = {}
+    for cache_nbt, revalidate in ((False, None), (True, None), (True, 5)):
+        GLOBALS.reset('test')
+        arrows(cache_nbt, revalidate)
+        out = compile_all()
+        if cache_nbt:
+            main = out['$root/test/function/main']
+            assert 'nbt=' not in main.split('\n')[-1] and main.count(',nbt={inGround:1b}] add') == 2, main
+
+        sim = Simulator(out)
+        landed = sim.add_entity('arrow', nbt=['{inGround:1b}'])
+        flying = sim.add_entity('arrow')
+        sim.load()
+        for t in range(10):
+            sim.tick()
+            if t == 3:
+                flying.nbt.add('{inGround:1b}')
+            sim.call('test:main')
+        assert sim.output.count('landed') == sum(filter(None, (sim.score('@s', 'i', landed), sim.score('@s', 'i', flying))))
+        counts[cache_nbt, revalidate] = (sim.score('@s', 'i', landed), sim.score('@s', 'i', flying))
+    assert counts == {(False, None): (10, 7), (True, None): (10, None), (True, 5): (10, 5)}, counts
+
+@check
+def nbt_cache_selector_args():
+    # cached selectors render their other arguments like any selector
+    for cache_nbt in (False, True):
+        GLOBALS.reset('test')
+        with PublicFun('main'):
+            Statement('scoreboard objectives add i dummy')
+            Statement('scoreboard players set @e i 1')
+            with Entities(type='arrow', name='Lost Arrow', scores={'i': '1..'}, nbt='{inGround:1b}', cache_nbt=cache_nbt):
+                Statement('say found')
+        out = compile_all()
+        main = out['$root/test/function/main'].split('\n')
+        assert main[-1].startswith('execute as @e[type=arrow,') and \
+            ',name="Lost Arrow",scores={i=1..}' + ('' if cache_nbt else ',nbt={inGround:1b}') + '] ' in main[-1], main
+
+        sim = Simulator(out)
+        sim.add_entity('arrow', name='Lost Arrow', nbt=['{inGround:1b}'])
+        sim.add_entity('arrow', name='Lost', nbt=['{inGround:1b}'])
+        sim.load()
+        sim.call('test:main')
+        assert sim.output == ['found'], (cache_nbt, sim.output)
+
+@check
+def lint_nbt_scans():
+    # nbt scans in tick functions are found in selectors and in command text, and only printed when asked to
+    @ticking
+    @fun
+    def tick():
+        with Entities(type='arrow', nbt='{inGround:1b}'):
+            Statement('say landed')
+        Statement('execute as @e[tag=x,nbt={Tags:["a,nbt=b"]}] run say tagged')
+        Statement('kill @e[name="nbt=x"]')
+        Statement('execute if entity @e[nbt={Item:{id:"minecraft:stone"}}] run say stone')
+
+    with PublicFun('main'):
+        Statement('say @e[nbt={OnGround:1b}]')
+
+    stdout = io.StringIO()
+    with redirect_stdout(stdout):
+        report = BuildReport()
+        compile_all(report=report)
+    assert stdout.getvalue() == '', stdout.getvalue()
+    scans = [warning.split(', which scans ', 1)[1] for warning in report.warnings]
+    assert scans == [
+        '@e[type=arrow,nbt={inGround:1b}]',
+        '@e[tag=x,nbt={Tags:["a,nbt=b"]}]',
+        '@e[nbt={Item:{id:"minecraft:stone"}}] without a type or tag',
+    ], report.warnings
+
+    with redirect_stdout(stdout):
+        compile_all(lint=True)
+    assert stdout.getvalue().count('WARN: ') == 3, stdout.getvalue()
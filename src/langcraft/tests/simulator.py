@@ -0,0 +1,130 @@
+import json
+
+from langcraft.simulator import Simulator, SimulatorError
+from .utils import check
+check = check(__name__)
+
+
+def simulate(tags=None, **functions: str) -> Simulator:
+    """
+    Simulator over test:<name> functions given as command text, and minecraft:<tag> function tags
+    """
+    files = {f'$root/test/function/{name}': content for name, content in functions.items()}
+    for tag, values in (tags or {}).items():
+        files[f'$root/minecraft/tags/function/{tag}'] = json.dumps({'values': values})
+    return Simulator(files)
+
+
+@check
+def simulator_scoreboard():
+    sim = simulate(main='''
+        scoreboard objectives add i dummy
+        scoreboard objectives add j dummy
+        scoreboard players set a i 5
+        scoreboard players add a i 3
+        scoreboard players remove a i 1
+        scoreboard players set b j 3
+        scoreboard players operation a i *= b j
+        scoreboard players operation c i = a i
+        scoreboard players operation c i %= b j
+        scoreboard players set d i 1
+        scoreboard players reset d
+    ''')
+    sim.call('test:main')
+    assert sim.score('a', 'i') == 21, sim.objectives
+    assert sim.score('c', 'i') == 0, sim.objectives
+    assert sim.score('d', 'i') is None, sim.objectives
+
+    sim = simulate(main='scoreboard players set a missing 1')
+    try:
+        sim.call('test:main')
+    except SimulatorError:
+        pass
+    else:
+        assert False, 'missing objectives are not reported'
+
+@check
+def simulator_execute():
+    sim = simulate(main='''
+        scoreboard objectives add i dummy
+        scoreboard players set a i 4
+        execute if score a i matches 1..5 run say in range
+        execute unless score a i matches 1..5 run say out of range
+        execute if score a i matches 5.. run say too high
+        execute as @e[type=pig,tag=x] run scoreboard players set @s i 7
+        execute as @e[type=pig] unless entity @s[tag=x] run say untagged
+        execute store result score b i if score a i matches 4
+        execute store success score c i if entity @e[type=cow]
+        execute store result storage test:data n int 2 run scoreboard players get a i
+    ''')
+    tagged = sim.add_entity('pig', tags=['x'])
+    untagged = sim.add_entity('pig')
+    sim.call('test:main')
+    assert sim.output == ['in range', 'untagged'], sim.output
+    assert sim.score('@s', 'i', tagged) == 7 and sim.score('@s', 'i', untagged) is None, sim.objectives
+    assert sim.score('b', 'i') == 1 and sim.score('c', 'i') == 0, sim.objectives
+    assert sim.storage['test:data'] == {'n': '8'}, sim.storage
+
+@check
+def simulator_functions():
+    sim = simulate(
+        main='''
+            scoreboard objectives add i dummy
+            execute store result score a i run function test:value
+            execute store success score b i run function test:fail
+            execute store result score c i run function test:nested
+            function test:value
+            function test:value
+        ''',
+        value='''
+            return 3
+            say unreachable
+        ''',
+        fail='return fail',
+        nested='return run function test:value',
+    )
+    executed = sim.call('test:main')
+    assert (sim.score('a', 'i'), sim.score('b', 'i'), sim.score('c', 'i')) == (3, 0, 3), sim.objectives
+    assert sim.output == []
+    assert sim.function_counts == {'test:main': 1, 'test:value': 4, 'test:fail': 1, 'test:nested': 1}, \
+        sim.function_counts
+    # run and return run count as commands of their own: main's 6 lines plus the 3 run function, 5 returns and
+    # nested's function call
+    assert executed == 6 + 3 + 5 + 2, executed
+
+@check
+def simulator_schedule():
+    sim = simulate(
+        main='''
+            schedule function test:a 1t append
+            schedule function test:a 1t append
+            schedule function test:b 2t
+            schedule function test:b 3t
+            schedule function test:c 1t
+            schedule clear test:c
+        ''',
+        a='say a',
+        b='say b',
+        c='say c',
+    )
+    sim.call('test:main')
+    sim.run(4)
+    # every appended run is queued, replacing drops the earlier run
+    assert sim.output == ['a', 'a', 'b'], sim.output
+    assert sim.scheduled == []
+
+@check
+def simulator_tags():
+    sim = simulate(
+        tags={'load': ['test:setup'], 'tick': ['test:count', 'test:say']},
+        setup='''
+            scoreboard objectives add i dummy
+            scoreboard players set ticks i 0
+        ''',
+        count='scoreboard players add ticks i 1',
+        say='say tick',
+    )
+    assert sim.load() == 2
+    assert sim.run(3) == [2, 2, 2]
+    assert sim.score('ticks', 'i') == 3
+    assert sim.output == ['tick'] * 3
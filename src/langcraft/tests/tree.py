@@ -1,8 +1,10 @@
 from math import cos, pi, sin
 
 from langcraft import *
-from .utils import test
+from langcraft.base import PublicFun
+from .utils import test, check
 test = test(__name__)
+check = check(__name__)
 
 @test
 def test0():
@@ -26,3 +28,37 @@ def test1():
                     for t in range(20):
                         x, y, z = f(t)
                         e.teleport(Pos.relative(x, y, z))
+
+@test
+def test2():
+    @public
+    def main():
+        with ScoreTree('i', dispatch='macro'):
+            for i in range(4):
+                Statement(f'say {i}')
+
+@test
+def test3():
+    @public
+    def main():
+        with ScoreTree('i', weights=[16, 8, 4, 2, 1, 1]):
+            for i in range(6):
+                Statement(f'say {i}')
+
+@check
+def state_machine():
+    # a leaf moving the score to a later leaf doesn't also run that leaf
+    GLOBALS.reset('test')
+    with PublicFun('main'):
+        with ScoreTree('i'):
+            for i in range(4):
+                Statement(f'say {i}' if i % 2 else f'scoreboard players set @s i {i + 1}')
+    out = compile_all()
+
+    for i in range(4):
+        sim = Simulator(out)
+        entity = sim.add_entity()
+        sim.objectives['i'] = {entity.holder: i}
+        sim.call('test:main', entity)
+        assert sim.output == ([] if i % 2 == 0 else [str(i)]), (i, sim.output)
+        assert sim.score('@s', 'i', entity) == (i + 1 if i % 2 == 0 else i), (i, sim.objectives)
@@ -1,4 +1,5 @@
 from inspect import getsource
+from traceback import print_exc
 from hashlib import sha256
 import json
 from pathlib import Path
@@ -54,4 +55,22 @@ def test(name: str):
         tests.append(inner)
     return wrapper
 
+def check(name: str):
+    """
+    Test asserting on the compiled functions itself (e.g. by running them in the Simulator) instead of comparing them
+    to the stored output
+    """
+    def wrapper(funct):
+        def inner():
+            GLOBALS.reset('test')
 
+            try:
+                funct()
+            except Exception:
+                cprint("!!!!!!!!!!!!!!", 'red', attrs=['reverse', 'blink', 'bold'])
+                cprint("!Test failure!", 'red', attrs=['reverse', 'blink', 'bold'])
+                cprint("!!!!!!!!!!!!!!", 'red', attrs=['reverse', 'blink', 'bold'])
+                cprint(f'{name}.{funct.__name__}', 'red')
+                print_exc()
+        tests.append(inner)
+    return wrapper
@@ -1,11 +1,25 @@
 import ast
-from typing import Any
+import copy
+import os
+from types import CodeType
+from typing import Any, TextIO
 
 from malparse import Parser
 from malast_types import Code
+from malsubst import postprocess_generated, write_generated
+import malc
 
 type Globals = dict[str, Any]
 
+def __CODE__(code_str: str, /):
+    return Code(code_str)
+
+OUTPUT_CATCH_IDENT = '$add_to_output'
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+# changes to these invalidate the .malc cache (basic_mal ships no parse.py, it's generated from mal.gram)
+VERSION_FILES = [os.path.join(_DIR, name) for name in ('mal.gram', 'malparse.py', 'malast.py')]
+
 class Runtime:
     def __init__(self):
         self.globals: Globals = {} | globals()
@@ -19,16 +33,41 @@ class Runtime:
     def set_variable(self, name, value):
         self.globals[name] = value
 
-def postprocess_generated(code: str, variables: Globals):
-    for key, value in variables.items():
-        code = code.replace(f"${key}$", str(value))
-    return code
+class CodeTransformer(ast.NodeTransformer):
+    """
+    Rewrites a tree to run as one code object capturing the same output as Interpreter's walk, like malpy's
+    CodeTransformer: expression statements pass their value to OUTPUT_CATCH_IDENT, code blocks become __CODE__ calls
+    """
+    def visit_Expr(self, node):
+        new_node = ast.Expr(
+            value=ast.Call(
+                func=ast.Name(id=OUTPUT_CATCH_IDENT, ctx=ast.Load()),
+                args=[self.visit(node.value)],
+                keywords=[]
+            )
+        )
+        return ast.copy_location(new_node, node)
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, Code):
+            return node
+        new_node = ast.Call(
+            func=ast.Name(id='__CODE__', ctx=ast.Load()),
+            args=[ast.Constant(value=str(node.value))],
+            keywords=[]
+        )
+        return ast.copy_location(new_node, node)
 
 class Interpreter(ast.NodeVisitor):
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, compiled=False):
+        """
+        compiled: run modules as one code object (see CodeTransformer) instead of walking them, so expressions
+                  aren't compiled again each time they run
+        """
         self.output = []
         self.runtime = Runtime()
         self.debug = debug
+        self.compiled = compiled
 
     def generic_visit(self, node):
         if self.debug:
@@ -112,18 +151,57 @@ class Interpreter(ast.NodeVisitor):
         
             node.args.posonlyargs
 
+    def compile(self, tree: ast.Module) -> CodeType:
+        transformed_tree = CodeTransformer().visit(copy.deepcopy(tree))
+        ast.fix_missing_locations(transformed_tree)
+        return compile(transformed_tree, filename="<malpy>", mode="exec")
+
+    def execute(self, node):
+        if not (self.compiled and isinstance(node, ast.Module)):
+            self.visit(node)
+            return
+
+        def add_to_output_if_code(value):
+            if isinstance(value, Code):
+                self.output.append(value)
+            return value
+
+        self.runtime.set_variable(OUTPUT_CATCH_IDENT, add_to_output_if_code)
+        try:
+            exec(self.compile(node), self.runtime.globals)
+        finally:
+            del self.runtime.globals[OUTPUT_CATCH_IDENT]
+
     def generate_code(self, node):
-        self.visit(node)
+        self.execute(node)
         out = '\n'.join(self.output)
         out = postprocess_generated(out, self.runtime.globals)
         return out
 
-def parse_interp(filename):
-    parser = Parser()
+    def write_code(self, node, file: TextIO):
+        """
+        generate_code, streamed to file
+        """
+        self.execute(node)
+        write_generated((f'\n{out}' if i else str(out) for i, out in enumerate(self.output)), self.runtime.globals, file)
+
+def parse_file(filename) -> ast.Module:
+    """
+    The parsed tree of a .mal file, cached in .malc (see malc) so unchanged files skip parsing
+    """
     with open(filename) as file:
         code = file.read()
 
-    tree = parser.parse(code, filename, debug=1)
+    key = malc.source_key(code, VERSION_FILES)
+    data = malc.load(filename, key)
+    if data is not None:
+        return malc.data_to_ast(data)
+    tree = Parser().parse(code, filename, debug=1)
+    malc.store(filename, key, malc.ast_to_data(tree))
+    return tree
+
+def parse_interp(filename):
+    tree = parse_file(filename)
 
     code_generator = Interpreter(debug=True)
 
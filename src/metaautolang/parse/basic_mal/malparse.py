@@ -1,5 +1,6 @@
 import ast
 import sys
+from io import StringIO
 import traceback
 from typing import Literal, TextIO
 import re
@@ -27,13 +28,10 @@ class Parser:
         return pattern.sub(replacement, code)
 
     def parse(self, code: str, filename: str = '', debug: Literal[0, 1, 2]=1):
-        with open('tmp.malpytmp', 'w') as f:
-            f.write(self.preprocess(code))
-        with open('tmp.malpytmp', 'r') as f:
-            tokengen = tokenize.generate_tokens(f.readline)
-            tokenizer = Tokenizer(tokengen, verbose=debug >= 2)
-            parser = MALpyParser(tokenizer, verbose=debug >= 2)
-            tree = parser.start()
+        tokengen = tokenize.generate_tokens(StringIO(self.preprocess(code)).readline)
+        tokenizer = Tokenizer(tokengen, verbose=debug >= 2)
+        parser = MALpyParser(tokenizer, verbose=debug >= 2)
+        tree = parser.start()
 
         if not tree:
             err = parser.make_syntax_error(filename)
@@ -0,0 +1,264 @@
+from argparse import ArgumentParser, SUPPRESS
+from io import StringIO
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from contextlib import redirect_stdout
+from hashlib import sha256
+import ast
+import json
+import platform
+import re
+import sys
+import token
+
+from pegen.build import build_parser, build_python_generator
+from pegen.tokenizer import tokenize, Tokenizer
+
+# python bench.py [-o results.json] [--full] [case ...]
+# Parses the pegen corpora and generated .mal files with each MAL parser (and malpy's with each malmemo policy), and
+# runs generated loop-heavy scripts with each basic_mal Interpreter mode; one process per case so that peak RSS is per
+# case and the parsers' sibling modules (parse, malast, ...) don't collide
+
+PARSE_DIR = Path(__file__).resolve().parent
+CORPUS_DIR = PARSE_DIR / 'pegen_copy' / 'data'
+PARSER_DIRS = {'malpy': PARSE_DIR / 'malpy', 'basic_mal': PARSE_DIR / 'basic_mal'}
+# class both malparse modules import from parse
+PARSER_CLASS = 'MALpyParser'
+# basic_mal Interpreter modes: {name: compiled}
+INTERPRETERS = {'basic_mal:walk': False, 'basic_mal:compiled': True}
+# malmemo policies malpy's parser is installed with: {name: policy}, see memo_policy
+MEMO_POLICIES = {'malpy:memo-all': 'all', 'malpy:memo-window': 'window', 'malpy:memo-selected': 'selected'}
+
+
+def expressions(lines: int) -> str:
+    """
+    Flat expressions of numbers, strings and code blocks, which every MAL parser accepts
+    """
+    return ''.join(f'{i} + {i % 7} * "{i}" - `say {i}` % {i % 3 + 1}\n' for i in range(lines))
+
+def program(lines: int) -> str:
+    """
+    Functions, calls, conditions and loops building commands (malpy only)
+    """
+    return ''.join(
+        f'def f{i}(x: str):\n'
+        f'    return `say ` + x + `{i}`\n'
+        f'if {i} % 2:\n'
+        f'    f{i}(`tp @s ~ ~{i % 16} ~`)\n'
+        f'for j in range({i % 4 + 1}):\n'
+        f'    f{i}(str(j))\n'
+        for i in range(max(1, lines // 6))
+    )
+
+def loops(lines: int) -> str:
+    """
+    Loops computing and emitting commands (interpreter cases: basic_mal's grammar has no compound statements, so these
+    are parsed as python with code blocks turned into __CODE__ calls, the tree malpy's grammar builds)
+    """
+    return ''.join(
+        f'for i in range(100):\n'
+        f'    x = i * {i % 5 + 2} + {i}\n'
+        f'    if x % 3 == 0:\n'
+        f'        `scoreboard players set @s x ` + str(x % 64)\n'
+        for i in range(max(1, lines // 4))
+    )
+
+GENERATORS = {'expressions': expressions, 'program': program, 'loops': loops}
+
+
+def cases(full=False) -> list[tuple[str, str]]:
+    """
+    (parser or interpreter, input) pairs; inputs are corpus file names or <generator>_<lines>.mal; full includes xl.txt
+    and the largest generated files, which take minutes
+    """
+    corpora = ['tiny.txt', 'small.txt', 'medium.txt', 'large.txt'] + (['xl.txt'] if full else [])
+    sizes = [100, 1000] + ([10000] if full else [])
+    generated = [f'{name}_{lines}.mal' for name in ('expressions', 'program') for lines in sizes]
+    scripts = [f'loops_{lines}.mal' for lines in sizes]
+    return [(parser, input_) for parser in (*PARSER_DIRS, *MEMO_POLICIES) for input_ in corpora + generated] + \
+           [(interpreter, input_) for interpreter in INTERPRETERS for input_ in scripts]
+
+def input_source(input_: str) -> str:
+    if input_.endswith('.mal'):
+        name, lines = input_.removesuffix('.mal').rsplit('_', 1)
+        return GENERATORS[name](int(lines))
+    return (CORPUS_DIR / input_).read_text()
+
+
+def load_parser(parser: str, tmp_dir: str):
+    """
+    (preprocess, parser class) of a MAL parser; basic_mal ships no generated parser, so it is generated into tmp_dir
+    """
+    parser_dir = str(PARSER_DIRS[parser])
+    if not (PARSER_DIRS[parser] / 'parse.py').exists():
+        grammar, _, _ = build_parser(str(PARSER_DIRS[parser] / 'mal.gram'))
+        grammar.metas.setdefault('class', PARSER_CLASS)
+        build_python_generator(grammar, 'mal.gram', str(Path(tmp_dir) / 'parse.py'))
+        sys.path.insert(0, parser_dir)
+        sys.path.insert(0, tmp_dir)
+    else:
+        sys.path.insert(0, parser_dir)
+    import malparse
+    return malparse.Parser().preprocess, getattr(sys.modules['parse'], PARSER_CLASS)
+
+def peak_rss() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux, bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def new_tokenizer(code: str) -> Tokenizer:
+    return Tokenizer(tokenize.generate_tokens(StringIO(code).readline))
+
+def memo_policy(name: str, parser_class, code: str):
+    """
+    all: every rule memoized with nothing dropped (as generated), window: malmemo's defaults, selected: the default
+    window over the rules a counted parse of the same code found worth memoizing
+    """
+    import malmemo
+    if name == 'all':
+        return malmemo.MemoPolicy(window=None)
+    if name == 'window':
+        return malmemo.MemoPolicy()
+    parser_ = parser_class(new_tokenizer(code))
+    malmemo.install(parser_, malmemo.MemoPolicy(window=None), count=True)
+    try:
+        parser_.start()
+    except Exception:
+        pass
+    return malmemo.MemoPolicy(malmemo.select_rules([parser_._cache]))
+
+def measure(target: str, input_: str) -> dict:
+    """
+    Tokenize time (reading every token from memory, as Parser.parse does), parse time (fresh tokenizer + start rule,
+    so tokenizing included), both as tokens/sec too, memo entries left once the parse returns and the process' peak RSS
+    With a memo policy, also the MemoTable's stats and the memo hits and misses (per rule and in total) of a second,
+    counted parse, as counting slows the timed one down
+    """
+    with TemporaryDirectory() as tmp_dir:
+        preprocess, parser_class = load_parser(target.split(':')[0], tmp_dir)
+        code = preprocess(input_source(input_))
+        policy = memo_policy(MEMO_POLICIES[target], parser_class, code) if target in MEMO_POLICIES else None
+
+        start = perf_counter()
+        tokenizer = new_tokenizer(code)
+        while tokenizer.getnext().type != token.ENDMARKER:
+            pass
+        tokenize_time = perf_counter() - start
+
+        parser_ = parser_class(new_tokenizer(code))
+        if policy is not None:
+            import malmemo
+            table = malmemo.install(parser_, policy)
+        error = None
+        start = perf_counter()
+        try:
+            tree = parser_.start()
+        except Exception as e:
+            tree = None
+            error = repr(e)
+        parse_time = perf_counter() - start
+
+        memo = None
+        if policy is not None:
+            counted = parser_class(new_tokenizer(code))
+            malmemo.install(counted, policy, count=True)
+            try:
+                counted.start()
+            except Exception:
+                pass
+            rules = counted._cache.stats()
+            memo = {**table.stats(),
+                    'hits': sum(stats['hits'] for stats in rules.values()),
+                    'misses': sum(stats['misses'] for stats in rules.values()),
+                    'rules': rules}
+
+    return {
+        'parsed': tree is not None,
+        'error': error,
+        'bytes': len(code.encode()),
+        'tokens': len(tokenizer._tokens),
+        'tokenize_time': tokenize_time,
+        'parse_time': parse_time,
+        'tokenize_tokens_per_sec': len(tokenizer._tokens) / tokenize_time,
+        'parse_tokens_per_sec': len(tokenizer._tokens) / parse_time,
+        'memo_size': len(parser_._cache),
+        'memo': memo,
+        'peak_rss': peak_rss(),
+    }
+
+def measure_interpreter(interpreter: str, input_: str) -> dict:
+    """
+    Run time of Interpreter.generate_code (stdout discarded), the output's size and hash (equal across modes)
+    and the process' peak RSS
+    """
+    with TemporaryDirectory() as tmp_dir:
+        load_parser('basic_mal', tmp_dir)
+        import interpret
+        code = re.sub(r'`([^`]*)`', lambda match: f'__CODE__({match.group(1)!r})', input_source(input_))
+        tree = ast.parse(code)
+
+        start = perf_counter()
+        with redirect_stdout(StringIO()):
+            output = interpret.Interpreter(compiled=INTERPRETERS[interpreter]).generate_code(tree)
+        run_time = perf_counter() - start
+
+    return {
+        'run_time': run_time,
+        'output_bytes': len(output.encode()),
+        'output_hash': sha256(output.encode()).hexdigest(),
+        'peak_rss': peak_rss(),
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(prog='python bench.py', description='Time the MAL parsers over the pegen corpora and generated .mal files')
+    arg_parser.add_argument('cases', nargs='*', help='parser/input cases to run, or parsers or inputs (default: all)')
+    arg_parser.add_argument('-o', '--out', default='bench_results.json', help='JSON file to write results to')
+    arg_parser.add_argument('--full', action='store_true', help='include xl.txt and the largest generated files')
+    arg_parser.add_argument('--worker', nargs=2, metavar=('PARSER', 'INPUT'), help=SUPPRESS)
+    args = arg_parser.parse_args()
+
+    # nested groups recurse through every precedence level
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10_000))
+
+    if args.worker:
+        print(json.dumps((measure_interpreter if args.worker[0] in INTERPRETERS else measure)(*args.worker)))
+        sys.exit()
+
+    selected = [(parser, input_) for parser, input_ in cases(full=args.full)
+                if not args.cases or {parser, input_, f'{parser}/{input_}'} & set(args.cases)]
+
+    commit = run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=PARSE_DIR).stdout.strip()
+    results = {'commit': commit or None, 'python': platform.python_version(), 'cases': {}}
+    for target, input_ in selected:
+        worker = run([sys.executable, __file__, '--worker', target, input_], capture_output=True, text=True, cwd=PARSE_DIR)
+        if worker.returncode:
+            print(f'WARN: {target}/{input_} failed:\n{worker.stderr}')
+            continue
+        result = json.loads(worker.stdout.splitlines()[-1])
+        results['cases'][f'{target}/{input_}'] = result
+        if target in INTERPRETERS:
+            print(f'{target + "/" + input_:<40}{result["run_time"]:>9.3f}s run{result["output_bytes"]:>11} bytes out'
+                  f'{(result["peak_rss"] or 0) / 2**20:>9.1f} MiB rss')
+        else:
+            print(f'{target + "/" + input_:<40}{result["tokenize_time"]:>9.3f}s tokenize{result["parse_time"]:>9.3f}s parse'
+                  f'{result["tokenize_tokens_per_sec"]:>11.0f} tok/s{result["parse_tokens_per_sec"]:>9.0f} parsed tok/s'
+                  f'{result["memo_size"]:>10} memo{(result["peak_rss"] or 0) / 2**20:>9.1f} MiB rss'
+                  + (f'{result["memo"]["hits"]:>10} hits{result["memo"]["misses"]:>10} misses'
+                     f'{result["memo"]["peak_size"]:>10} peak memo' if result['memo'] else '')
+                  + f'{"" if result["parsed"] else "  (no parse)"}')
+
+    for input_ in {input_ for target, input_ in selected if target in INTERPRETERS}:
+        hashes = {results['cases'][f'{target}/{input_}']['output_hash'] for target in INTERPRETERS
+                  if f'{target}/{input_}' in results['cases']}
+        if len(hashes) > 1:
+            print(f'WARN: the interpreter modes generated different code for {input_}')
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'wrote {args.out}')
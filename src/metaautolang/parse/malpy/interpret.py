@@ -1,8 +1,13 @@
 import ast
+import os
+from types import CodeType
 from typing import Any
 
 from malparse import Parser
+from malmemo import MemoPolicy
 from malast_types import Code, CodeHook
+from malsubst import postprocess_generated
+import malc
 
 type Globals = dict[str, Any]
 
@@ -11,6 +16,10 @@ def __CODE__(code_str: str, /):
 
 OUTPUT_CATCH_IDENT = '$add_to_output'
 
+_DIR = os.path.dirname(os.path.abspath(__file__))
+# changes to these invalidate the .malc cache
+VERSION_FILES = [os.path.join(_DIR, name) for name in ('parse.py', 'malpy.gram', 'malparse.py', 'malast.py', 'interpret.py')]
+
 class Runtime:
     def __init__(self):
         self.output = []
@@ -34,19 +43,19 @@ class Runtime:
 
     
 
-def postprocess_generated(code: str, variables: Globals):
-    for key, value in variables.items():
-        code = code.replace(f"${key}$", str(value))
-    return code
-
 class CodeTransformer(ast.NodeTransformer):
     def __init__(self):
         self.runtime = Runtime()
 
     def __call__(self, tree):
+        return self.run(self.compile(tree))
+
+    def compile(self, tree) -> CodeType:
         transformed_tree = self.visit(tree)
         ast.fix_missing_locations(transformed_tree)
-        code = compile(transformed_tree, filename="<malpy>", mode="exec")
+        return compile(transformed_tree, filename="<malpy>", mode="exec")
+
+    def run(self, code: CodeType) -> str:
         exec(code, self.runtime.globals)
 
         print(self.runtime.output)
@@ -77,16 +86,23 @@ class CodeTransformer(ast.NodeTransformer):
         )
         return ast.copy_location(new_node, node)
 
-def parse_interp(filename):
-    parser = Parser()
+def compile_file(filename) -> CodeType:
+    """
+    The transformed, compiled code of a .mal file, cached in .malc (see malc) so unchanged files skip parsing
+    """
     with open(filename) as file:
         code = file.read()
 
-    tree = parser.parse(code, filename, debug=1)
-
-    code_transformer = CodeTransformer()
+    key = malc.source_key(code, VERSION_FILES)
+    compiled = malc.load(filename, key)
+    if compiled is None:
+        tree = Parser(memo=MemoPolicy()).parse(code, filename, debug=1)
+        compiled = CodeTransformer().compile(tree)
+        malc.store(filename, key, compiled)
+    return compiled
 
+def parse_interp(filename):
     transformer = CodeTransformer()
-    autogened_code = transformer(tree)
+    autogened_code = transformer.run(compile_file(filename))
     
     print(autogened_code)
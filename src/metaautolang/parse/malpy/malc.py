@@ -0,0 +1,64 @@
+import marshal
+import os
+import sys
+import warnings
+from hashlib import sha256
+from typing import Any, Iterable
+
+# The cache format is shared with basic_mal/malc.py, which copies everything up to its ast codec from this file,
+# the canonical copy: change both (each MAL flavor's directory is imported on its own, so they can't share it)
+# compiled sources are cached like .pyc files: <source dir>/.malc/<source name>.malc, holding the key they were
+# compiled with (source + parser/grammar version + python version) followed by the marshalled result
+MALC_DIR = '.malc'
+KEY_SIZE = 32
+
+_version_keys: dict[tuple[str, ...], bytes] = {}
+
+def version_key(version_files: Iterable[str]) -> bytes:
+    """
+    Hash of the files whose changes invalidate every cached result (parser, grammar, transformer)
+    and of the running python, as code objects and marshal are version specific
+    A missing file raises FileNotFoundError rather than silently leaving it out of the key
+    """
+    version_files = tuple(version_files)
+    if version_files not in _version_keys:
+        h = sha256(sys.implementation.cache_tag.encode())
+        for path in version_files:
+            h.update(path.encode())
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        _version_keys[version_files] = h.digest()
+    return _version_keys[version_files]
+
+def source_key(source: str, version_files: Iterable[str]) -> bytes:
+    return sha256(version_key(version_files) + source.encode()).digest()
+
+def cache_path(filename: str) -> str:
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, MALC_DIR, name + '.malc')
+
+def load(filename: str, key: bytes) -> Any | None:
+    """
+    The result cached for filename, if it was compiled with key
+    """
+    try:
+        with open(cache_path(filename), 'rb') as f:
+            if f.read(KEY_SIZE) != key:
+                return None
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+def store(filename: str, key: bytes, value: Any):
+    path = cache_path(filename)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent runs never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(key)
+            marshal.dump(value, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        warnings.warn(f'could not write {path}: {e}', RuntimeWarning)
+
@@ -0,0 +1,154 @@
+import types
+from typing import Dict, Iterable, Iterator, List
+
+from pegen.parser import Parser as PegenParser
+from pegen.tokenizer import tokenize
+
+# tokens behind the furthest token read whose memo entries are kept; backtracking further than that reparses
+DEFAULT_WINDOW = 256
+# rules selected by select_rules: at least this fraction of their calls are answered from the memo
+DEFAULT_MIN_HIT_RATE = 0.1
+
+
+class MemoPolicy:
+    """
+    Which rule results a parser memoizes, and for how long
+    rules: names of the rules to memoize (None: all of them, as generated); left-recursive rules are always memoized,
+           as their seed growing loop relies on the memo
+    window: drop the memo entries more than window tokens behind the furthest token read (None: keep everything)
+    Entries that are not memoized or dropped only cost reparsing, the resulting tree is the same
+    """
+    def __init__(self, rules: Iterable[str] | None = None, window: int | None = DEFAULT_WINDOW):
+        self.rules = None if rules is None else frozenset(rules)
+        self.window = window
+
+
+def memoized_rules(parser_class: type) -> Dict[str, bool]:
+    """
+    {rule name: left-recursive} of the rules decorated with @memoize or @memoize_left_rec
+    """
+    rules = {}
+    for name in dir(parser_class):
+        wrapper = getattr(getattr(parser_class, name), '__name__', None)
+        if wrapper in ('memoize_wrapper', 'memoize_left_rec_wrapper'):
+            rules[name] = wrapper == 'memoize_left_rec_wrapper'
+    return rules
+
+
+class MemoTable:
+    """
+    Applies a MemoPolicy to a pegen parser: rules that aren't memoized are rebound on the parser to their undecorated
+    method, and the memo (the parser's _cache, keyed by (mark, rule, args)) is trimmed as tokens are read
+    Trimming waits until no left-recursive rule is growing, as those rely on their memo entries until they return
+    """
+    def __init__(self, parser: PegenParser, policy: MemoPolicy):
+        self.parser = parser
+        self.policy = policy
+        self.unmemoized: List[str] = []
+        for name, left_recursive in memoized_rules(type(parser)).items():
+            if not left_recursive and policy.rules is not None and name not in policy.rules:
+                setattr(parser, name, types.MethodType(getattr(type(parser), name).__wrapped__, parser))
+                self.unmemoized.append(name)
+        self.evictions = 0
+        self.evicted = 0
+        self.peak_size = 0
+        self._evicted_at = 0
+        if policy.window is not None:
+            tokenizer = parser._tokenizer
+            tokenizer._tokengen = self._read(tokenizer._tokengen)
+
+    def _read(self, tokengen: Iterator[tokenize.TokenInfo]) -> Iterator[tokenize.TokenInfo]:
+        tokens = self.parser._tokenizer._tokens
+        for tok in tokengen:
+            # new tokens are only read at the furthest mark
+            furthest = len(tokens)
+            if furthest - self._evicted_at >= self.policy.window and not self.parser.in_recursive_rule:
+                self._evict(furthest - self.policy.window)
+                self._evicted_at = furthest
+            yield tok
+
+    def _evict(self, before: int):
+        cache = self.parser._cache
+        self.peak_size = max(self.peak_size, len(cache))
+        stale = [key for key in cache if key[0] < before]
+        for key in stale:
+            del cache[key]
+        self.evictions += 1
+        self.evicted += len(stale)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.parser._cache),
+            'peak_size': max(self.peak_size, len(self.parser._cache)),
+            'tokens': len(self.parser._tokenizer._tokens),
+            'evictions': self.evictions,
+            'evicted': self.evicted,
+            'unmemoized_rules': len(self.unmemoized),
+        }
+
+
+class RuleStats:
+    __slots__ = ('hits', 'misses')
+
+    def __init__(self):
+        self.hits = 0  # calls answered from the memo
+        self.misses = 0  # calls parsed
+
+    @property
+    def hit_rate(self) -> float:
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.
+
+    def to_dict(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+
+class CountingCache(dict):
+    """
+    Memo dict counting hits and misses per rule (slower, for measuring which rules are worth memoizing)
+    """
+    def __init__(self):
+        super().__init__()
+        self.rules: Dict[str, RuleStats] = {}
+
+    def _rule(self, name: str) -> RuleStats:
+        stats = self.rules.get(name)
+        if stats is None:
+            stats = self.rules[name] = RuleStats()
+        return stats
+
+    def __contains__(self, key) -> bool:
+        found = super().__contains__(key)
+        if found:
+            self._rule(key[1]).hits += 1
+        return found
+
+    def __setitem__(self, key, value):
+        # left-recursive rules store several times per parse, count the first one
+        if not super().__contains__(key):
+            self._rule(key[1]).misses += 1
+        super().__setitem__(key, value)
+
+    def stats(self) -> dict:
+        return {name: stats.to_dict() for name, stats in sorted(self.rules.items())}
+
+
+def install(parser: PegenParser, policy: MemoPolicy, count: bool = False) -> MemoTable:
+    """
+    Call before parsing; with count, parser._cache becomes a CountingCache
+    """
+    if count:
+        parser._cache = CountingCache()
+    return MemoTable(parser, policy)
+
+def select_rules(caches: Iterable[CountingCache], min_hit_rate: float = DEFAULT_MIN_HIT_RATE) -> List[str]:
+    """
+    Rules worth memoizing according to parses run with every rule memoized
+    """
+    totals: Dict[str, RuleStats] = {}
+    for cache in caches:
+        for name, stats in cache.rules.items():
+            total = totals.setdefault(name, RuleStats())
+            total.hits += stats.hits
+            total.misses += stats.misses
+    return sorted(name for name, stats in totals.items() if stats.hit_rate >= min_hit_rate)
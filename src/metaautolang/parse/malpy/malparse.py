@@ -1,11 +1,13 @@
 import ast
 import sys
+from io import StringIO
 import traceback
 from typing import Literal, TextIO
 import re
 
 from pegen.tokenizer import tokenize, Tokenizer
 from parse import MALpyParser
+from malmemo import MemoPolicy, MemoTable, install as install_memo
 # python -m pegen mcpy.gram
 
 CODE_BLOCK_OPEN = '__CODE_BLOCK_OPEN__'
@@ -13,8 +15,10 @@ CODE_BLOCK_CLOSE = '__CODE_BLOCK_CLOSE__'
 DOLLAR_SIGN_TOKEN = '__HOOK__ '
 
 class Parser:
-    def __init__(self):
-        pass
+    def __init__(self, memo: MemoPolicy | None = None):
+        # None: memoize every rule for the whole parse, as generated
+        self.memo = memo
+        self.memo_table: MemoTable | None = None
 
     def preprocess(self, code: str):
         def code_block_replacement(match: re.Match[str]) -> str:
@@ -29,13 +33,12 @@ class Parser:
         return code
 
     def parse(self, code: str, filename: str = '', debug: Literal[0, 1, 2]=1):
-        with open('tmp.malpytmp', 'w') as f:
-            f.write(self.preprocess(code))
-        with open('tmp.malpytmp', 'r') as f:
-            tokengen = tokenize.generate_tokens(f.readline)
-            tokenizer = Tokenizer(tokengen, verbose=debug >= 2)
-            parser = MALpyParser(tokenizer, verbose=debug >= 2)
-            tree = parser.start()
+        tokengen = tokenize.generate_tokens(StringIO(self.preprocess(code)).readline)
+        tokenizer = Tokenizer(tokengen, verbose=debug >= 2)
+        parser = MALpyParser(tokenizer, verbose=debug >= 2)
+        if self.memo is not None:
+            self.memo_table = install_memo(parser, self.memo)
+        tree = parser.start()
 
         if not tree:
             err = parser.make_syntax_error(filename)
@@ -0,0 +1,49 @@
+import re
+from typing import Any, Iterable, List, TextIO
+
+# basic_mal/malsubst.py is a copy of this file, the canonical copy: change both
+# $name$ placeholders in generated code are replaced with str() of the variable name once it has run
+PLACEHOLDER = re.compile(r'\$(\w+)\$')
+# a placeholder that may continue in the next chunk
+PARTIAL_PLACEHOLDER = re.compile(r'\$\w*\Z')
+
+
+def _substitute(code: str, variables: dict[str, Any], out: List[str], final: bool = True) -> str:
+    """
+    Appends code with its placeholders substituted to out, in one scan; unless final, holds back (and returns)
+    a trailing partial placeholder
+    """
+    pos = 0
+    while (match := PLACEHOLDER.search(code, pos)) is not None:
+        name = match.group(1)
+        if name in variables:
+            out.append(code[pos:match.start()])
+            out.append(str(variables[name]))
+            pos = match.end()
+        else:
+            # its closing $ may open a known placeholder
+            out.append(code[pos:match.start() + 1])
+            pos = match.start() + 1
+    if not final and (partial := PARTIAL_PLACEHOLDER.search(code, pos)) is not None:
+        out.append(code[pos:partial.start()])
+        return code[partial.start():]
+    out.append(code[pos:])
+    return ''
+
+def postprocess_generated(code: str, variables: dict[str, Any]) -> str:
+    out = []
+    _substitute(code, variables, out)
+    return ''.join(out)
+
+def write_generated(chunks: Iterable[str], variables: dict[str, Any], file: TextIO):
+    """
+    postprocess_generated(''.join(chunks)) written to file as the chunks come
+    """
+    rest = ''
+    for chunk in chunks:
+        out = []
+        rest = _substitute(rest + chunk, variables, out, final=False)
+        file.writelines(out)
+    out = []
+    _substitute(rest, variables, out)
+    file.writelines(out)